@@ -34,6 +34,9 @@ setup(name='WebTeachingEnvironment',
       long_description=README + '\n\n' + CHANGES,
       classifiers=[
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
         "Framework :: Pyramid",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
@@ -46,6 +49,7 @@ setup(name='WebTeachingEnvironment',
       package_dir = {'': 'src'},
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.7',
       test_suite='wte',
       install_requires=requires,
       entry_points="""\
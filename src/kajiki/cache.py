@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+'''Persistent cache for the code generated from templates.
+
+Compiling a template means parsing it, generating Python source code and
+compiling that. A :class:`BytecodeCache` stores the resulting code objects
+on disk using :mod:`marshal`, so that other processes (or the same process
+after a restart) only need to execute the cached code.
+
+Cache entries are keyed by the template filename, the compilation options,
+the Kajiki and generated code versions and the Python bytecode version. Each entry also
+records a hash of the template source, so that entries for templates that
+have changed since they were cached are ignored.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import marshal
+import os
+import sys
+import tempfile
+from hashlib import sha1
+
+from .ir import CODEGEN_VERSION
+from .version import __release__
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:  # pragma no cover
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class BytecodeCache(object):
+    '''Stores the compiled templates as marshalled files in *directory*.'''
+
+    suffix = '.kjc'
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._version = ('%s %s %s %s' % (__release__, CODEGEN_VERSION, sys.version_info[:2],
+                                          MAGIC_NUMBER)).encode('utf-8')
+
+    def _path(self, filename, options):
+        key = sha1(self._version)
+        key.update(('%s\n%r' % (os.path.abspath(filename), options)).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest() + self.suffix)
+
+    @staticmethod
+    def _hash(source):
+        return sha1(source.encode('utf-8')).hexdigest()
+
+    def load(self, filename, source, options):
+        '''Returns the (filename, py_text, code, py_linenos) tuple stored for
+        the template, or None if there is no valid cache entry.
+        '''
+        try:
+            with open(self._path(filename, options), 'rb') as f:
+                source_hash, compiled = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if source_hash != self._hash(source):
+            return None
+        return compiled
+
+    def store(self, filename, source, options, compiled):
+        '''Writes the *compiled* template to the cache. The entry is written
+        to a temporary file first, so that concurrent readers never see a
+        partially written entry. Errors are ignored, as the cache is only an
+        optimisation.
+        '''
+        path = self._path(filename, options)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump((self._hash(source), tuple(compiled)), f)
+                _replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError, ValueError):
+            pass
+
+    def clear(self):
+        '''Removes all entries from the cache.'''
+        if os.path.isdir(self.directory):
+            for fn in os.listdir(self.directory):
+                if fn.endswith(self.suffix):
+                    os.unlink(os.path.join(self.directory, fn))
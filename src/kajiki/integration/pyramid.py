@@ -16,6 +16,21 @@ application section of your Pyramid application's .ini file::
     kajiki.extensions = .kajiki .genshi
     # The Kajiki output mode can be "html5", "html" or "xml"
     kajiki.mode = html5
+    # Optional directory in which the compiled templates are cached
+    kajiki.cache_dir = %(here)s/tmp/kajiki
+    # How often (in seconds) changed templates are checked for, if inotify
+    # is not available
+    kajiki.reload_interval = 1
+    # Optionally log where the time goes while rendering each page
+    kajiki.profile = False
+
+When ``pyramid.reload_templates`` is enabled, a single file watcher reloads
+the templates that change (see :mod:`kajiki.watcher`), so that templates do
+not need to be checked each time they are used.
+
+When ``kajiki.profile`` is enabled, each render is profiled (see
+:mod:`kajiki.profile`) and the report is logged at INFO level by the
+``kajiki.profile`` logger.
 
 Then configure your views just like the other Pyramid templating
 languages, passing an asset specification to the ``renderer`` argument::
@@ -31,12 +46,18 @@ languages, passing an asset specification to the ``renderer`` argument::
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from os import stat
+import logging
+from os import walk
+from os.path import abspath, join, splitext
 from paste.deploy.converters import asbool
 from zope.interface import implementer
 from pyramid.interfaces import IRenderer, ITemplateRenderer
 from pyramid.resource import abspath_from_resource_spec
+from ..cache import BytecodeCache
 from ..loader import Loader
+from ..profile import TemplateProfiler
+from ..template import TplFunc
+from ..watcher import watcher
 from .. import XMLTemplate
 
 
@@ -50,9 +71,13 @@ def includeme(config):
     extensions = settings.get('kajiki.extensions', '.kajiki').split()
     for extension in extensions:
         config.add_renderer(extension, renderer_factory)
+    cache_dir = settings.get('kajiki.cache_dir')
     config.registry.kajiki_loader = PyramidKajikiLoader(
         auto_reload=asbool(settings.get('pyramid.reload_templates')),
         mode=settings.get('kajiki.mode', 'html5'),
+        bytecode_cache=BytecodeCache(cache_dir) if cache_dir else None,
+        reload_interval=float(settings.get('kajiki.reload_interval', 1)),
+        profile=asbool(settings.get('kajiki.profile')),
     )
 
 
@@ -64,29 +89,48 @@ class PyramidKajikiLoader(Loader):
     def implementation(self):  # ITemplateRenderer implementation
         return self
 
-    def __init__(self, auto_reload=False, mode='html5'):
+    def __init__(self, auto_reload=False, mode='html5', bytecode_cache=None,
+                 reload_interval=1, profile=False):
         self.auto_reload = auto_reload
         self.mode = mode
-        self._timestamps = {}
+        self.bytecode_cache = bytecode_cache
+        self.profile = profile
+        if profile:
+            TplFunc.profiling = True
+        self._paths = {}
+        self._watcher = watcher(self.discard, reload_interval) if auto_reload else None
         super(PyramidKajikiLoader, self).__init__()
 
     def _load(self, name, *a, **kw):
         '''Called when the template actually needs to be (re)compiled.'''
-        return XMLTemplate(source=None, filename=name,
-                           mode=self.mode, *a, **kw)
+        return XMLTemplate(source=None, filename=name, mode=self.mode,
+                           bytecode_cache=self.bytecode_cache, *a, **kw)
 
     def import_(self, name, *a, **kw):
         '''Overrides Loader.import_().
 
         * Resolves the resource spec into an absolute path for the template.
-        * Checks the template modification time to decide whether to reload it.
+        * Watches the template for changes, if templates are reloaded.
         '''
-        name = abspath_from_resource_spec(name)
-        if self.auto_reload and name in self.modules:
-            mtime = stat(name).st_mtime
-            if mtime > self._timestamps.get(name, 0):
-                del self.modules[name]
-        return super(PyramidKajikiLoader, self).import_(name, *a, **kw)
+        path = self._paths.get(name)
+        if path is None:
+            path = self._paths[name] = abspath(abspath_from_resource_spec(name))
+        if self._watcher is not None and path not in self.modules:
+            self._watcher.watch(path)
+        return super(PyramidKajikiLoader, self).import_(path, *a, **kw)
+
+    def preload(self, specs, extensions=('.kajiki',)):
+        '''Loads all templates found in the *specs* directories, so that
+        they are compiled (or loaded from the bytecode cache) up front,
+        for example before a server forks its worker processes.
+        Returns the number of templates loaded.
+        '''
+        count = 0
+        for spec in specs:
+            for filename in find_templates(spec, extensions):
+                self.import_(filename)
+                count += 1
+        return count
 
     def __call__(self, value, system, is_fragment=False):
         """IRenderer implementation.
@@ -110,8 +154,21 @@ class PyramidKajikiLoader(Loader):
             raise ValueError('The Kajiki template renderer was passed a '
                              'non-dictionary as value.')
         # self._save_template_as_python(template, system, name)  # to debug
+        if self.profile:
+            return self._render_profiled(template, system, name)
         return template(system).render()
 
+    def _render_profiled(self, template, system, name):
+        '''Renders the template with a TemplateProfiler and logs its report.'''
+        with TemplateProfiler() as profiler:
+            result = template(system).render()
+        request = system.get('request')
+        logging.getLogger('kajiki.profile').info(
+            'Rendered %s%s\n%s', name,
+            ' for %s' % request.path_qs if request is not None else '',
+            profiler.report())
+        return result
+
     def _save_template_as_python(self, template, context, name,
                                  dir='kajiki_debug', encoding='utf-8'):
         'Just a debugging device used in the development of Kajiki itself.'
@@ -137,6 +194,18 @@ class PyramidKajikiLoader(Loader):
             view=view, context=dic))
 
 
+def find_templates(spec, extensions=('.kajiki',)):
+    '''Yields the absolute paths of all templates with one of the
+    *extensions* in the directory identified by the resource *spec*
+    (for example ``myapp:templates``) and its sub-directories.
+    '''
+    for root, dirs, files in walk(abspath_from_resource_spec(spec)):
+        dirs.sort()
+        for fn in sorted(files):
+            if splitext(fn)[1] in extensions:
+                yield join(root, fn)
+
+
 def renderer_factory(info):
     '''*info* contains::
 
@@ -2,12 +2,18 @@
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+from ast import literal_eval
 from itertools import chain
 import re
 
-from .util import gen_name, flattener, window
+from .html_utils import HTML_EMPTY_ATTRS
+from .util import gen_name, flattener, html_escape, window
 from nine import nine
 
+CODEGEN_VERSION = 2
+'''Version of the generated code. Increase this whenever the code generated
+for a template changes, so that cached templates are compiled again.'''
+
 
 def generate_python(ir):
     cur_indent = 0
@@ -49,14 +55,18 @@ class HierNode(Node):
         self.body = tuple(x for x in body if x is not None)
 
     def body_iter(self):
-        for x in optimize(flattener(map(flattener, self.body))):
+        for x in optimize(flattener(map(flattener, fold_constants(self.body)))):
             yield x
 
     def __iter__(self):
         yield self
         yield IndentNode()
+        is_empty = True
         for x in self.body_iter():
             yield x
+            is_empty = False
+        if is_empty:  # In Python, a block without a body is a SyntaxError.
+            yield PassNode()
         yield DedentNode()
 
 
@@ -137,17 +147,6 @@ class DefNode(HierNode):
         yield self.line(self.prefix)
         yield self.line('def %s:' % (self.decl))
 
-    def __iter__(self):
-        yield self
-        yield IndentNode()
-        is_empty = True
-        for x in self.body_iter():
-            yield x
-            is_empty = False
-        if is_empty:  # In Python, a function without a body is a SyntaxError.
-            yield PassNode()  # Prevent creation of a function without a body
-        yield DedentNode()
-
 
 class InnerDefNode(DefNode):
     prefix = '@__kj__.flattener.decorate'
@@ -336,6 +335,20 @@ class AttrNode(HierNode):
                 % (x, self.p.attr, gen, self.p.mode))
             yield self.line('    yield %s' % x)
 
+    class ExprAttr(Node):
+        '''Renders an attribute whose value is a single expression, without
+        wrapping the expression in a generator.'''
+        def __init__(self, parent):
+            super(AttrNode.ExprAttr, self).__init__()
+            self.p = parent
+
+        def py(self):
+            x = gen_name()
+            yield self.line(
+                'for %s in self.__kj__.render_attrs({%r:self.__kj__.collect((%s,))}, %r):'
+                % (x, self.p.attr, self.p.body[0].text, self.p.mode))
+            yield self.line('    yield %s' % x)
+
     def __init__(self, attr, value, guard=None, mode='xml'):
         super(AttrNode, self).__init__(value)
         self.attr = attr
@@ -346,21 +359,41 @@ class AttrNode(HierNode):
     def py(self):
         yield self.line('def %s():' % self.genname)
 
+    def static_text(self):
+        '''Returns the rendered attribute if its value only consists of text,
+        otherwise None.'''
+        if not all(type(x) is TextNode for x in self.body):
+            return None
+        if self.mode.startswith('html') and self.attr in HTML_EMPTY_ATTRS:
+            return ' ' + self.attr.lower()
+        value = ''.join(x.text for x in self.body)
+        return ' %s="%s"' % (self.attr, html_escape(value))
+
     def __iter__(self):
-        if self.guard:
+        text = self.static_text()
+        if text is not None:
+            # Rendered at compile time, so that it can be merged with the
+            # surrounding text into a single literal.
+            node = TextNode(text, self.guard)
+            node.filename, node.lineno = self.filename, self.lineno
+            yield node
+        elif self.guard:
             new_body = IfNode(
                 self.guard,
                 AttrNode(self.attr, value=self.body, mode=self.mode))
             for x in new_body:
                 yield x
+        elif (len(self.body) == 1 and type(self.body[0]) is ExprNode and
+              self.body[0].safe):
+            attr = self.ExprAttr(self)
+            attr.filename = self.filename
+            attr.lineno = self.body[0].lineno or self.lineno
+            yield attr
         else:
             yield self
             yield IndentNode()
-            if self.body:
-                for part in self.body_iter():
-                    yield part
-            else:
-                yield TextNode('')
+            for part in self.body_iter():
+                yield part
             yield DedentNode()
             yield self.AttrTail(self)
 
@@ -419,6 +452,40 @@ class PythonNode(Node):
             yield line[len(prefix):]
 
 
+_NOT_CONSTANT = object()
+
+
+def _constant(expr):
+    '''Returns the value of *expr* if it is a literal, otherwise _NOT_CONSTANT.'''
+    try:
+        return literal_eval(expr.strip())
+    except (ValueError, SyntaxError, TypeError):
+        return _NOT_CONSTANT
+
+
+def fold_constants(body):
+    '''Replaces the IfNodes in *body* whose test is a literal (for example
+    py:if="False") and their ElseNodes by the body of the branch that is
+    taken, so that no test is needed when the template is executed.'''
+    body = list(body)
+    i = 0
+    while i < len(body):
+        node = body[i]
+        if type(node) is IfNode:
+            value = _constant(node.decl)
+            if value is not _NOT_CONSTANT:
+                end = i + 1
+                else_body = ()
+                if end < len(body) and type(body[end]) is ElseNode:
+                    else_body = body[end].body
+                    end = end + 1
+                # Not advancing i means that the inserted nodes are folded too
+                body[i:end] = list(node.body if value else else_body)
+                continue
+        i = i + 1
+    return body
+
+
 def optimize(iter_node):
     last_node = None
     for node in iter_node:
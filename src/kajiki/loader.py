@@ -8,8 +8,23 @@ import pkg_resources
 
 
 class Loader(object):
+    # Whether templates may memoise the templates they import or extend.
+    # Loaders that check for changed templates on every import must set
+    # this to False; loaders that reload templates when they change call
+    # discard() instead.
+    cache_imports = True
+
     def __init__(self):
         self.modules = {}
+        self.generation = 0
+
+    def discard(self, name):
+        '''Removes the template from the cache, so that it is loaded again
+        the next time it is imported. Also invalidates the templates that
+        templates have memoised.
+        '''
+        self.modules.pop(name, None)
+        self.generation += 1
 
     def import_(self, name, *args, **kwargs):
         '''Returns the template if it is already in the cache,
@@ -41,7 +56,8 @@ class MockLoader(Loader):
 
 class FileLoader(Loader):
     def __init__(self, path, reload=True, force_mode=None,
-                 autoescape_text=False, xml_autoblocks=None):
+                 autoescape_text=False, xml_autoblocks=None,
+                 bytecode_cache=None):
         super(FileLoader, self).__init__()
         from kajiki import XMLTemplate, TextTemplate
         if isinstance(path, basestring):
@@ -50,15 +66,20 @@ class FileLoader(Loader):
             self.path = path
         self._timestamps = {}
         self._reload = reload
+        self.cache_imports = not reload
         self._force_mode = force_mode
         self._autoescape_text = autoescape_text
         self._xml_autoblocks = xml_autoblocks
+        self._bytecode_cache = bytecode_cache
         self.extension_map = dict(
             txt=lambda *a, **kw: TextTemplate(
                 autoescape=self._autoescape_text, *a, **kw),
-            xml=XMLTemplate,
-            html=lambda *a, **kw: XMLTemplate(mode='html', *a, **kw),
-            html5=lambda *a, **kw: XMLTemplate(mode='html5', *a, **kw))
+            xml=lambda *a, **kw: XMLTemplate(
+                bytecode_cache=self._bytecode_cache, *a, **kw),
+            html=lambda *a, **kw: XMLTemplate(
+                mode='html', bytecode_cache=self._bytecode_cache, *a, **kw),
+            html5=lambda *a, **kw: XMLTemplate(
+                mode='html5', bytecode_cache=self._bytecode_cache, *a, **kw))
 
     def _filename(self, name):
         for base in self.path:
@@ -72,7 +93,7 @@ class FileLoader(Loader):
         if self._reload and name in self.modules:
             mtime = os.stat(filename).st_mtime
             if mtime > self._timestamps.get(name, 0):
-                del self.modules[name]
+                self.discard(name)
         return super(FileLoader, self).import_(name, *args, **kwargs)
 
     def _load(self, name, encoding='utf-8', *args, **kwargs):
@@ -90,6 +111,7 @@ class FileLoader(Loader):
             return XMLTemplate(filename=filename,
                                mode=self._force_mode,
                                autoblocks=self._xml_autoblocks,
+                               bytecode_cache=self._bytecode_cache,
                                *args, **kwargs)
         else:
             ext = os.path.splitext(filename)[1][1:]
@@ -98,8 +120,9 @@ class FileLoader(Loader):
 
 
 class PackageLoader(FileLoader):
-    def __init__(self, reload=True, force_mode=None):
-        super(PackageLoader, self).__init__(None, reload, force_mode)
+    def __init__(self, reload=True, force_mode=None, bytecode_cache=None):
+        super(PackageLoader, self).__init__(None, reload, force_mode,
+                                            bytecode_cache=bytecode_cache)
 
     def _filename(self, name):
         package, module = name.rsplit('.', 1)
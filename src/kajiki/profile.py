@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+'''Measures where the time goes while templates are rendered.
+
+While a :class:`TemplateProfiler` is active, each call of a template
+function (the template's ``__main__``, its ``py:def`` functions and its
+``py:block`` blocks) is timed. The time is recorded per function and per
+template line, using the template line numbers that the compiled code is
+annotated with. A line is charged with the time spent producing the output
+it yields, which includes evaluating its expressions. The output of nested
+template functions is produced by those functions and is charged to them.
+
+Profiling is switched on for the process by setting
+``TplFunc.profiling = True``; otherwise template functions are not timed::
+
+    TplFunc.profiling = True
+    with TemplateProfiler() as profiler:
+        output = tpl(context).render()
+    print(profiler.report())
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import threading
+
+try:
+    from time import perf_counter as clock
+except ImportError:  # pragma no cover
+    from time import time as clock
+
+_local = threading.local()
+
+
+def active():
+    '''Returns the :class:`TemplateProfiler` active in this thread, or None.'''
+    return getattr(_local, 'profiler', None)
+
+
+class TemplateProfiler(object):
+    '''Records the time spent in template functions and on template lines.
+
+    ``functions`` maps (filename, line, function name) to [calls, seconds]
+    and ``lines`` maps (filename, line) to [yields, seconds].
+    '''
+    def __init__(self):
+        self.functions = {}
+        self.lines = {}
+        self.elapsed = 0
+        self._previous = None
+        self._start = None
+
+    def __enter__(self):
+        self._previous = active()
+        _local.profiler = self
+        self._start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed += clock() - self._start
+        _local.profiler = self._previous
+
+    def wrap(self, func, gen):
+        '''Returns a generator that yields the output of the generator *gen*,
+        which was returned by calling the template function *func*, timing
+        the work done to produce each item.'''
+        code = func.__code__
+        key = (code.co_filename, code.co_firstlineno, code.co_name)
+        stats = self.functions.get(key)
+        if stats is None:
+            stats = self.functions[key] = [0, 0]
+        stats[0] += 1
+        return self._timed(gen, code.co_filename, stats)
+
+    def _timed(self, gen, filename, stats):
+        lines = self.lines
+        frame = gen.gi_frame
+        while True:
+            # Output may be produced after the profiler was left (for example
+            # when it is streamed), so make it active while gen runs.
+            previous = active()
+            _local.profiler = self
+            start = clock()
+            try:
+                item = next(gen)
+            except StopIteration:
+                stats[1] += clock() - start
+                return
+            finally:
+                _local.profiler = previous
+            elapsed = clock() - start
+            stats[1] += elapsed
+            key = (filename, frame.f_lineno)
+            line = lines.get(key)
+            if line is None:
+                lines[key] = [1, elapsed]
+            else:
+                line[0] += 1
+                line[1] += elapsed
+            yield item
+
+    def report(self, limit=15):
+        '''Returns a text report of the *limit* functions and lines that took
+        the most time.'''
+        out = ['Total: %.2f ms' % (self.elapsed * 1000),
+               '%10s %8s  %s' % ('ms', 'calls', 'function')]
+        functions = sorted(self.functions.items(),
+                           key=lambda item: item[1][1], reverse=True)
+        for (filename, lineno, name), (calls, seconds) in functions[:limit]:
+            out.append('%10.2f %8d  %s:%d(%s)' % (
+                seconds * 1000, calls, filename, lineno, name))
+        out.append('%10s %8s  %s' % ('ms', 'yields', 'line'))
+        lines = sorted(self.lines.items(),
+                       key=lambda item: item[1][1], reverse=True)
+        for (filename, lineno), (count, seconds) in lines[:limit]:
+            out.append('%10.2f %8d  %s:%d' % (
+                seconds * 1000, count, filename, lineno))
+        return '\n'.join(out)
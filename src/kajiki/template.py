@@ -2,36 +2,18 @@
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-import re
 import types
 from nine import IS_PYTHON2, basestring, str, iteritems
 
-try:
-    from functools import update_wrapper
-except:
-    def update_wrapper(wrapper, wrapped,
-                       assigned=('__module__', '__name__', '__doc__'),
-                       updated = ('__dict__',)):
-        for attr in assigned:
-            setattr(wrapper, attr, getattr(wrapped, attr))
-        for attr in updated:
-            getattr(wrapper, attr).update(getattr(wrapped, attr))
-        return wrapper
-
 import kajiki
-from .util import flattener, literal
+from .util import flattener, html_escape, literal
 from .html_utils import HTML_EMPTY_ATTRS
 from .ir import generate_python
 from . import lnotab
+from . import profile
 from kajiki import i18n
 
 
-class _obj(object):
-    def __init__(self, **kw):
-        for k, v in iteritems(kw):
-            setattr(self, k, v)
-
-
 class _Template(object):
     __methods__ = ()
     loader = None
@@ -42,33 +24,32 @@ class _Template(object):
         if context is None:
             context = {}
         self._context = context
-        base_globals = self.base_globals or {}
-        self.__globals__ = dict(base_globals, local=self, self=self,
-            defined=lambda x: x in self.__globals__,
-            literal=literal, Markup=literal,
-            __builtins__=__builtins__, __kj__=kajiki)
+        # The globals shared by all instances of the class are prepared
+        # once, so each render only copies them and adds its own values.
+        # Function globals must be a real dict, so this copy takes the
+        # place of a ChainMap-style lookup.
+        self.__globals__ = dict(self._shared_globals(), local=self, self=self)
+        self.__globals__['defined'] = self.__globals__.__contains__
         self.__globals__['value_of'] = self.__globals__.get
         for k, v in self.__methods__:
-            v = v.bind_instance(self)
+            v = TplFunc(v._func, self)
             setattr(self, k, v)
             self.__globals__[k] = v
-        self.__kj__ = _obj(
-            extend=self._extend,
-            push_switch=self._push_switch,
-            pop_switch=self._pop_switch,
-            case=self._case,
-            import_=self._import,
-            escape=self._escape,
-            gettext=i18n.gettext,
-            render_attrs=self._render_attrs,
-            push_with=self._push_with,
-            pop_with=self._pop_with,
-            collect=self._collect,
-        )
+        self.__kj__ = _Helpers(self)
         self._switch_stack = []
         self._with_stack = []
         self.__globals__.update(context)
 
+    @classmethod
+    def _shared_globals(cls):
+        shared = cls.__dict__.get('_class_globals')
+        if shared is None:
+            shared = dict(cls.base_globals or {},
+                literal=literal, Markup=literal,
+                __builtins__=__builtins__, __kj__=kajiki)
+            cls._class_globals = shared
+        return shared
+
     def __iter__(self):
         '''We convert the chunk to string because it can be of any type
         -- after all, the template supports expressions such as ${x+y}.
@@ -78,7 +59,7 @@ class _Template(object):
             yield str(chunk)
 
     def render(self):
-        return ''.join(self)
+        return self.__main__().accumulate_str()
 
     def _push_with(self, locals_, vars):
         self._with_stack.append([locals_.get(k, ()) for k in vars])
@@ -86,9 +67,27 @@ class _Template(object):
     def _pop_with(self):
         return self._with_stack.pop()
 
+    def _load(self, name):
+        '''Returns the template class that this template imports or extends
+        as *name*. The classes are memoised per template class, until the
+        loader discards a template.
+        '''
+        loader = self.loader
+        if not loader.cache_imports:
+            return loader.import_(name)
+        cls = type(self)
+        generation, resolved = cls.__dict__.get('_resolved', (None, None))
+        if generation != loader.generation:
+            resolved = {}
+            cls._resolved = (loader.generation, resolved)
+        tpl_cls = resolved.get(name)
+        if tpl_cls is None:
+            tpl_cls = resolved[name] = loader.import_(name)
+        return tpl_cls
+
     def _extend(self, parent):
         if isinstance(parent, basestring):
-            parent = self.loader.import_(parent)
+            parent = self._load(parent)
         p_inst = parent(self._context)
         p_globals = p_inst.__globals__
         # Find overrides
@@ -107,13 +106,10 @@ class _Template(object):
             if k not in self.__globals__:
                 self.__globals__[k] = v
             if not hasattr(self, k):
-                def _(k=k):
-                    '''Capture the 'k' variable in a closure'''
-                    def trampoline(*a, **kw):
-                        global parent
-                        return getattr(parent, k)(*a, **kw)
-                    return trampoline
-                setattr(self, k, TplFunc(_()).bind_instance(self))
+                # The parent's globals may already hold an override from a
+                # child further down, so look the function up on the parent
+                # instance itself when it is called.
+                setattr(self, k, _ParentFunc(p_inst, k))
         p_globals['child'] = self
         p_globals['local'] = p_inst
         p_globals['self'] = self.__globals__['self']
@@ -131,34 +127,32 @@ class _Template(object):
         return obj == self._switch_stack[-1]
 
     def _import(self, name, alias, gbls):
-        tpl_cls = self.loader.import_(name)
+        tpl_cls = self._load(name)
         if alias is None:
             alias = self.loader.default_alias_for(name)
         r = gbls[alias] = tpl_cls(gbls)
         return r
 
-    def _escape(self, value):
+    @staticmethod
+    def _escape(value):
         "Returns the given HTML with ampersands, carets and quotes encoded."
-        if value is None or isinstance(value, flattener):
-            return value
-        if hasattr(value, '__html__'):
-            return value.__html__()
-        uval = str(value)
-        if self._re_escape.search(uval):  # Scan the string before working.
-            # stdlib escape() is inconsistent between Python 2 and Python 3.
-            # In 3, html.escape() translates the single quote to '&#39;'
-            # In 2.6 and 2.7, cgi.escape() does not touch the single quote.
-            # Preserve our tests and Kajiki behaviour across Python versions:
-            return uval.replace('&', '&amp;').replace('<', '&lt;') \
-                .replace('>', '&gt;').replace('"', '&quot;')
-            # .replace("'", '&#39;'))
-            # Above we do NOT escape the single quote; we don't need it because
-            # all HTML attributes are double-quoted in our output.
-        else:
-            return uval
-    _re_escape = re.compile(r'&|<|>|"')
-
-    def _render_attrs(self, attrs, mode):
+        # Fast paths for the most common types, checked by exact type so
+        # that subclasses (such as markupsafe.Markup) still reach __html__
+        value_type = type(value)
+        if value_type is not str:
+            if value is None or value_type is flattener:
+                return value
+            if value_type is int:
+                return str(value)
+            if hasattr(value, '__html__'):
+                return value.__html__()
+            if isinstance(value, flattener):
+                return value
+            value = str(value)
+        return html_escape(value)
+
+    @staticmethod
+    def _render_attrs(attrs, mode):
         if hasattr(attrs, 'items'):
             attrs = attrs.items()
         if attrs is not None:
@@ -168,13 +162,16 @@ class _Template(object):
                 if mode.startswith('html') and k in HTML_EMPTY_ATTRS:
                     yield ' ' + k.lower()
                 else:
-                    yield ' %s="%s"' % (k, self._escape(v))
+                    yield ' %s="%s"' % (k, _Template._escape(v))
 
-    def _collect(self, it):
+    @staticmethod
+    def _collect(it):
         result = []
         for part in it:
             if part is None:
                 continue
+            if type(part) is flattener:
+                part = part.accumulate_str()
             result.append(str(part))
         if result:
             return ''.join(result)
@@ -190,6 +187,45 @@ class _Template(object):
         return name in self._context
 
 
+class _ParentFunc(object):
+    '''Calls the function *name* of the *parent* template instance. This
+    is what ``parent_block()`` reaches for blocks that a template inherits
+    from its parent, which may in turn inherit them from its own parent.
+    '''
+    __slots__ = ('_parent', '_name')
+
+    def __init__(self, parent, name):
+        self._parent = parent
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        return getattr(self._parent, self._name)(*args, **kwargs)
+
+
+class _Helpers(object):
+    '''The helpers that the generated code accesses as ``self.__kj__``.
+    The stateless helpers are class attributes shared by all templates, so
+    only the helpers that need the template instance are bound per render.
+    '''
+    __slots__ = ('_tpl',)
+
+    def __init__(self, tpl):
+        self._tpl = tpl
+
+    def __getattr__(self, name):
+        # extend, push_switch, pop_switch, case, import_, push_with and
+        # pop_with are looked up on the template when they are used.
+        return getattr(self._tpl, '_' + name.rstrip('_'))
+
+    escape = staticmethod(_Template._escape)
+    render_attrs = staticmethod(_Template._render_attrs)
+    collect = staticmethod(_Template._collect)
+
+    @property
+    def gettext(self):
+        return i18n.gettext
+
+
 def Template(ns):
     dct = {}
     methods = dct['__methods__'] = []
@@ -201,6 +237,14 @@ def Template(ns):
 
 
 def from_ir(ir_node):
+    return from_code(*compile_ir(ir_node))
+
+
+def compile_ir(ir_node):
+    """Generates and compiles the Python code for ``ir_node``. Returns the
+    (filename, py_text, code, py_linenos) tuple expected by :func:`from_code`,
+    which only contains marshallable values.
+    """
     py_lines = list(generate_python(ir_node))
     py_text = '\n'.join(map(str, py_lines))
     py_linenos = []
@@ -209,22 +253,31 @@ def from_ir(ir_node):
         lno = max(last_lineno, l._lineno or 0)
         py_linenos.append((i + 1, lno))
         last_lineno = lno
-    dct = dict(kajiki=kajiki)
     try:
-        exec(py_text, dct)
+        code = compile(py_text, '<string>', 'exec')
     except (SyntaxError, IndentationError):  # pragma no cover
         for i, line in enumerate(py_text.splitlines()):
             print('%3d %s' % (i + 1, line))
         raise
+    return ir_node.filename, py_text, code, py_linenos
+
+
+def from_code(filename, py_text, code, py_linenos):
+    dct = dict(kajiki=kajiki)
+    exec(code, dct)
     tpl = dct['template']
     tpl.base_globals = dct
     tpl.py_text = py_text
-    tpl.filename = ir_node.filename
+    tpl.filename = filename
     tpl.annotate_lnotab(py_linenos)
     return tpl
 
 
 class TplFunc(object):
+    __slots__ = ('_func', '_inst', '_bound_func')
+    # Whether calls are timed by the active profile.TemplateProfiler
+    profiling = False
+
     def __init__(self, func, inst=None):
         self._func = func
         self._inst = inst
@@ -241,25 +294,28 @@ class TplFunc(object):
             return '<unbound tpl_function %r>' % (self._func.__name__)
 
     def __call__(self, *args, **kwargs):
-        if self._bound_func is None:
-            self._bound_func = self._bind_globals(
+        func = self._bound_func
+        if func is None:
+            func = self._bound_func = self._bind_globals(
                 self._inst.__globals__)
-        return self._bound_func(*args, **kwargs)
+        if self.profiling:
+            profiler = profile.active()
+            if profiler is not None:
+                return flattener(profiler.wrap(
+                    self._func, func(*args, **kwargs)))
+        return flattener(func(*args, **kwargs))
 
     def _bind_globals(self, globals):
-        '''Return a function which has the globals dict set to 'globals'
-        and which flattens the result of self._func'.
+        '''Return a copy of self._func which has the globals dict set to
+        'globals'.
         '''
-        func = types.FunctionType(
+        return types.FunctionType(
             self._func.__code__,
             globals,
             self._func.__name__,
             self._func.__defaults__,
             self._func.__closure__
         )
-        return update_wrapper(
-            lambda *a, **kw: flattener(func(*a, **kw)),
-            func)
 
     def annotate_lnotab(self, filename, py_to_tpl, py_to_tpl_dct):
         if not py_to_tpl:
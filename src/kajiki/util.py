@@ -4,6 +4,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from collections import deque
 import sys
+from nine import str as text_type
 from random import randint
 from threading import local
 
@@ -55,32 +56,63 @@ class flattener(object):
         return inner
 
     def accumulate_str(self):
-        if type(self.iterator) == flattener:
-            return self.iterator.accumulate_str()
-        s = ''
-        iter_stack = [self.iterator]
-        while iter_stack:
-            try:
-                x = iter_stack[-1].next()
-            except StopIteration:
-                iter_stack.pop()
-                continue
-            if type(x) == flattener:
-                iter_stack.append(x.iterator)
-            elif x is None:
-                pass
+        '''Returns all chunks joined into a single string. Nested
+        flatteners are walked iteratively using an explicit stack.
+        '''
+        result = []
+        append = result.append
+        stack = []
+        it = iter(self.iterator)
+        while True:
+            for x in it:
+                if type(x) is flattener:
+                    stack.append(it)
+                    it = iter(x.iterator)
+                    break
+                elif x is not None:
+                    append(x)
             else:
-                s += x
-        return s
+                if not stack:
+                    break
+                it = stack.pop()
+        try:
+            return ''.join(result)
+        except TypeError:
+            # Non-string chunks, e.g. from literal(42)
+            return ''.join(map(text_type, result))
 
     def __iter__(self):
-        for x in self.iterator:
-            if type(x) == flattener:
-                for xx in x:
-                    if xx is not None:
-                        yield xx
-            elif x is not None:
-                yield x
+        stack = []
+        it = iter(self.iterator)
+        while True:
+            for x in it:
+                if type(x) is flattener:
+                    stack.append(it)
+                    it = iter(x.iterator)
+                    break
+                elif x is not None:
+                    yield x
+            else:
+                if not stack:
+                    return
+                it = stack.pop()
+
+
+def html_escape(text):
+    '''Returns the *text* with ampersands, carets and double quotes encoded.'''
+    # Scanning with "in" is much faster than a regex search or
+    # str.translate and most values do not need escaping at all.
+    if '&' in text or '<' in text or '>' in text or '"' in text:
+        # stdlib escape() is inconsistent between Python 2 and Python 3.
+        # In 3, html.escape() translates the single quote to '&#39;'
+        # In 2.6 and 2.7, cgi.escape() does not touch the single quote.
+        # Preserve our tests and Kajiki behaviour across Python versions:
+        return text.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;').replace('"', '&quot;')
+        # .replace("'", '&#39;'))
+        # Above we do NOT escape the single quote; we don't need it because
+        # all HTML attributes are double-quoted in our output.
+    return text
 
 
 def literal(text):
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+'''Watches template files for changes, so that a loader can reload changed
+templates without checking the modification time of every template each
+time that it is used.
+
+On Linux the directories containing the watched files are monitored with
+inotify. Elsewhere a background thread polls the modification times of the
+watched files. In both cases the *callback* is called, from the watcher's
+thread, with the filename of each watched file that changed.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import struct
+import sys
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct(str('iIII'))
+
+
+def _libc_inotify():
+    '''Returns the C library if it provides inotify, otherwise None.'''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+def watcher(callback, interval=1.0):
+    '''Returns an :class:`InotifyWatcher` if inotify is available, otherwise a
+    :class:`PollingWatcher` that checks the files every *interval* seconds.
+    '''
+    libc = _libc_inotify()
+    if libc is not None:
+        try:
+            return InotifyWatcher(callback, libc)
+        except OSError:
+            pass
+    return PollingWatcher(callback, interval)
+
+
+class _Watcher(ABCMeta(str('_WatcherBase'), (object,), {})):
+    '''Abstract base for the watchers. The thread is started when the first
+    file is watched and again in a child process after a fork. Subclasses
+    implement :meth:`_add` and :meth:`_run`.'''
+    def __init__(self, callback):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._thread = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def watch(self, filename):
+        '''Starts watching *filename*. Call this before reading the file, so
+        that no change is missed.'''
+        filename = os.path.abspath(filename)
+        with self._lock:
+            self._add(filename)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='kajiki-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self._thread is not None:
+            self._thread = None
+            self._restart()
+            self._thread = threading.Thread(
+                target=self._run, name='kajiki-watcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _changed(self, filename):
+        try:
+            self.callback(filename)
+        except Exception:  # pragma no cover
+            # The watcher must keep running for the other templates
+            pass
+
+    @abstractmethod
+    def _add(self, filename):
+        '''Adds *filename* to the watched files. Called with the lock held.'''
+
+    def _restart(self):
+        '''Called in a child process after a fork, before the thread is
+        started again.'''
+
+    @abstractmethod
+    def _run(self):
+        '''Watches the files until the process ends, calling
+        :meth:`_changed` for each file that changed.'''
+
+
+class PollingWatcher(_Watcher):
+    '''Checks the modification times of the watched files every *interval*
+    seconds.'''
+    def __init__(self, callback, interval=1.0):
+        super(PollingWatcher, self).__init__(callback)
+        self.interval = interval
+        self._mtimes = {}
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def _add(self, filename):
+        if filename not in self._mtimes:
+            self._mtimes[filename] = self._mtime(filename)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                mtimes = list(self._mtimes.items())
+            for filename, mtime in mtimes:
+                current = self._mtime(filename)
+                if current != mtime:
+                    self._mtimes[filename] = current
+                    self._changed(filename)
+
+
+class InotifyWatcher(_Watcher):
+    '''Uses inotify to watch the directories that contain the watched files.
+    Directories are watched instead of the files themselves, because many
+    editors save a file by replacing it.'''
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, callback, libc):
+        super(InotifyWatcher, self).__init__(callback)
+        self._libc = libc
+        self._files = set()
+        self._directories = {}
+        self._fd = self._init()
+
+    def _init(self):
+        fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        return fd
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self._fd, directory.encode(sys.getfilesystemencoding()),
+            self.mask)
+        if wd >= 0:
+            self._directories[wd] = directory
+
+    def _add(self, filename):
+        self._files.add(filename)
+        directory = os.path.dirname(filename)
+        if directory not in self._directories.values():
+            self._add_watch(directory)
+
+    def _restart(self):
+        # The inotify instance is shared with the parent process
+        directories = set(self._directories.values())
+        self._directories = {}
+        os.close(self._fd)
+        self._fd = self._init()
+        for directory in directories:
+            self._add_watch(directory)
+
+    def _run(self):
+        fd = self._fd
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self._directories.get(wd)
+                if directory is None or not name:
+                    continue
+                filename = os.path.join(
+                    directory, name.decode(sys.getfilesystemencoding()))
+                if filename in self._files:
+                    self._changed(filename)
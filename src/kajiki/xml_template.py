@@ -5,13 +5,8 @@ from __future__ import (absolute_import, division, print_function,
 import re
 from codecs import open
 from xml import sax
-from xml.dom import minidom as dom
-from nine import IS_PYTHON2, basestring, str, iteritems, native_str
-
-if IS_PYTHON2:
-    from cStringIO import StringIO as BytesIO
-else:
-    from io import BytesIO
+from xml.parsers import expat
+from nine import basestring, str, iteritems
 
 from . import ir
 from . import template
@@ -22,22 +17,28 @@ from .html_utils import (HTML_OPTIONAL_END_TAGS, HTML_REQUIRED_END_TAGS,
                          HTML_CDATA_TAGS)
 from .markup_template import QDIRECTIVES, QDIRECTIVES_DICT
 
-impl = dom.getDOMImplementation(' ')
-
 
 def XMLTemplate(source=None, filename=None, mode=None, is_fragment=False,
-                encoding='utf-8', autoblocks=None, cdata_scripts=True):
+                encoding='utf-8', autoblocks=None, cdata_scripts=True,
+                bytecode_cache=None):
     if source is None:
         with open(filename, encoding=encoding) as f:
             source = f.read()  # source is a unicode string
     if filename is None:
         filename = '<string>'
+    options = ('xml', mode, is_fragment, autoblocks, cdata_scripts)
+    if bytecode_cache is not None:
+        compiled = bytecode_cache.load(filename, source, options)
+        if compiled is not None:
+            return template.from_code(*compiled)
     doc = _Parser(filename, source).parse()
     expand(doc)
     compiler = _Compiler(filename, doc, mode=mode, is_fragment=is_fragment,
                          autoblocks=autoblocks, cdata_scripts=cdata_scripts)
-    ir_ = compiler.compile()
-    return template.from_ir(ir_)
+    compiled = template.compile_ir(compiler.compile())
+    if bytecode_cache is not None:
+        bytecode_cache.store(filename, source, options, compiled)
+    return template.from_code(*compiled)
 
 
 def annotate(gen):
@@ -121,11 +122,11 @@ class _Compiler(object):
         return True
 
     def _compile_node(self, node):
-        if isinstance(node, dom.Comment):
+        if isinstance(node, _Comment):
             return self._compile_comment(node)
-        elif isinstance(node, dom.Text):
+        elif isinstance(node, _Text):
             return self._compile_text(node)
-        elif isinstance(node, dom.ProcessingInstruction):
+        elif isinstance(node, _ProcessingInstruction):
             return self._compile_pi(node)
         elif self._is_autoblock(node):
             # Set the name of the block equal to the tag itself.
@@ -152,11 +153,10 @@ class _Compiler(object):
                 merge_node = None
                 merged_nodes.append(node)
             else:
-                if isinstance(node, dom.Text):
+                if isinstance(node, _Text):
                     if merge_node is None:
-                        merge_node = node.ownerDocument.createTextNode(node.data)
-                        merge_node.lineno = node.lineno
-                        merge_node.escaped = node.escaped
+                        merge_node = _Text(node.data, node.lineno,
+                                           node.escaped)
                         merged_nodes.append(merge_node)
                     else:
                         merge_node.data = merge_node.data + node.data
@@ -205,7 +205,7 @@ class _Compiler(object):
                         # CDATA for scripts and styles are automatically managed.
                         if getattr(child, '_cdata', False):
                             continue
-                        assert isinstance(child, dom.Text)
+                        assert isinstance(child, _Text)
                         for x in self._compile_text(child):
                             if child.escaped:  # If user declared CDATA no escaping happened.
                                 x.text = unescape(x.text)
@@ -439,134 +439,222 @@ class _TextCompiler(object):
             return self.expr(text)
 
 
-class _Parser(sax.ContentHandler):
-    DTD = '<!DOCTYPE kajiki SYSTEM "kajiki.dtd">'
+class _Node(object):
+    '''Base for the nodes of the parsed template. The nodes only implement
+    the small subset of the DOM API that the compiler uses.'''
+    __slots__ = ('lineno',)
+
+
+class _Parent(_Node):
+    __slots__ = ('childNodes',)
+
+    @property
+    def firstChild(self):
+        return self.childNodes[0] if self.childNodes else None
+
+    def appendChild(self, node):
+        self.childNodes.append(node)
+        return node
+
+    def replaceChild(self, newChild, oldChild):
+        for i, child in enumerate(self.childNodes):
+            if child is oldChild:
+                self.childNodes[i] = newChild
+                return oldChild
+        raise ValueError('%r is not a child of %r' % (oldChild, self))
+
+
+class _Document(_Parent):
+    __slots__ = ('_dtd',)
+
+    def __init__(self):
+        self.lineno = 0
+        self.childNodes = []
+        self._dtd = None
+
+
+class _Element(_Parent):
+    __slots__ = ('tagName', 'attributes')
+
+    def __init__(self, tagName, attributes=None, lineno=0):
+        self.tagName = tagName
+        self.attributes = {} if attributes is None else attributes
+        self.childNodes = []
+        self.lineno = lineno
+
+    def hasAttribute(self, name):
+        return name in self.attributes
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, '')
+
+    def setAttribute(self, name, value):
+        self.attributes[name] = value
+
+    def removeAttribute(self, name):
+        del self.attributes[name]
+
+
+class _Text(_Node):
+    '''Text, escaped unless it is the content of a CDATA section. The
+    delimiters of CDATA sections are text nodes marked as _cdata.'''
+    __slots__ = ('data', 'escaped', '_cdata')
+
+    def __init__(self, data, lineno=0, escaped=True, cdata=False):
+        self.data = data
+        self.lineno = lineno
+        self.escaped = escaped
+        self._cdata = cdata
+
+
+class _Comment(_Node):
+    __slots__ = ('data',)
+
+    def __init__(self, data, lineno=0):
+        self.data = data
+        self.lineno = lineno
 
+
+class _ProcessingInstruction(_Node):
+    __slots__ = ('target', 'data')
+
+    def __init__(self, target, data, lineno=0):
+        self.target = target
+        self.data = data
+        self.lineno = lineno
+
+
+class _Locator(sax.xmlreader.Locator):
+    def __init__(self, filename, lineno, column):
+        self._filename = filename
+        self._lineno = lineno
+        self._column = column
+
+    def getColumnNumber(self):
+        return self._column
+
+    def getLineNumber(self):
+        return self._lineno
+
+    def getSystemId(self):
+        return self._filename
+
+
+_ENTITY_RE = re.compile(r'&([A-Za-z][A-Za-z0-9]*);')
+
+
+class _Parser(object):
     def __init__(self, filename, source):
-        '''XML defines only a few entities; HTML defines many more.
-        The XML parser errors out when it finds HTML entities, unless the
-        template contains a reference to an external DTD (in which case
-        skippedEntity() gets called, this is what we want). In other words,
-        we want to trick expat into parsing XML + HTML entities for us.
-        We wouldn't force our users to declare everyday HTML entities!
-
-        So, for the parsing stage, we detect the doctype in the template and
-        replace it with our own; then in the compiling stage we put the
-        user's doctype back in. The XML parser is thus tricked and nobody
-        needs to know this implementation detail of Kajiki.
+        '''XML defines only a few entities; HTML defines many more. The
+        XML parser errors out when it finds HTML entities, unless the
+        document may refer to an external DTD. We tell expat to assume such
+        a DTD and give it one that declares the HTML entities used in the
+        template (see :data:`kajiki.entities.html5`), so that they are also
+        resolved in attribute values. Unknown entities in the text are
+        reported by expat as skipped entities and raise an error.
+
+        The parser streams the expat events straight into a tree of
+        lightweight nodes, merging consecutive text as it goes.
         '''
         if not isinstance(source, str):
             raise TypeError('The template source must be a unicode string.')
-        self._els = []
-        self._doc = dom.Document()
         self._filename = filename
+        self._doc = _Document()
         # Store the original DTD in the document for the compiler to use later
-        self._doc._dtd, position, source = extract_dtd(source)
-        # Use our own DTD just for XML parsing
-        self._source = source[:position] + self.DTD + source[position:]
-        self._cdata_stack = []
+        self._doc._dtd, position, self._source = extract_dtd(source)
+        self._els = [self._doc]
+        self._in_cdata = False
 
     def parse(self):
-        self._parser = parser = sax.make_parser()
-        parser.setFeature(sax.handler.feature_external_pes, False)
-        parser.setFeature(sax.handler.feature_external_ges, False)
-        parser.setFeature(sax.handler.feature_namespaces, False)
-        parser.setProperty(sax.handler.property_lexical_handler, self)
-        parser.setContentHandler(self)
-        source = sax.xmlreader.InputSource()
-        # Sweet XMLReader.parse() documentation says:
-        # "As a limitation, the current implementation only accepts byte
-        # streams; processing of character streams is for further study."
-        # So if source is unicode, we pre-encode it:
-        # TODO Is this dance really necessary? Can't I just call a function?
-        byts = self._source.encode('utf-8')
-        source.setEncoding(native_str('utf-8'))
-        source.setByteStream(BytesIO(byts))
-        source.setSystemId(self._filename)
-        parser.parse(source)
+        self._parser = parser = expat.ParserCreate()
+        parser.UseForeignDTD(True)
+        parser.SetParamEntityParsing(
+            expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+        parser.ExternalEntityRefHandler = self._foreign_dtd
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._characters
+        parser.ProcessingInstructionHandler = self._processing_instruction
+        parser.SkippedEntityHandler = self._skipped_entity
+        parser.CommentHandler = self._comment
+        parser.StartCdataSectionHandler = self._start_cdata
+        parser.EndCdataSectionHandler = self._end_cdata
+        try:
+            parser.Parse(self._source.encode('utf-8'), True)
+        except expat.ExpatError as e:
+            raise sax.SAXParseException(
+                expat.ErrorString(e.code), e,
+                _Locator(self._filename, e.lineno, e.offset))
         return self._doc
 
-    # ContentHandler implementation
-    def startDocument(self):
-        self._els.append(self._doc)
-
-    def startElement(self, name, attrs):
-        el = self._doc.createElement(name)
-        el.lineno = self._parser.getLineNumber()
-        for k, v in attrs.items():
-            el.setAttribute(k, v)
-        self._els[-1].appendChild(el)
+    def _foreign_dtd(self, context, base, system_id, public_id):
+        '''Declares the HTML entities that the template uses.'''
+        declarations = []
+        for name in set(_ENTITY_RE.findall(self._source)):
+            text = html5.get(name + ';')
+            if text is not None:
+                declarations.append('<!ENTITY %s "%s">' % (
+                    name, ''.join('&#%d;' % ord(c) for c in text)))
+        self._parser.ExternalEntityParserCreate(context).Parse(
+            ''.join(declarations).encode('utf-8'), True)
+        return 1
+
+    def _start_element(self, name, attrs):
+        el = _Element(name, attrs, self._parser.CurrentLineNumber)
+        self._els[-1].childNodes.append(el)
         self._els.append(el)
 
-    def endElement(self, name):
-        popped = self._els.pop()
-        assert name == popped.tagName
-
-    def characters(self, content):
-        should_escape = not self._cdata_stack
-        if should_escape:
-            content = sax.saxutils.escape(content)
-        node = self._doc.createTextNode(content)
-        node.lineno = self._parser.getLineNumber()
-        node.escaped = should_escape
-        self._els[-1].appendChild(node)
-
-    def processingInstruction(self, target, data):
-        node = self._doc.createProcessingInstruction(target, data)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
-
-    def skippedEntity(self, name):
+    def _end_element(self, name):
+        self._els.pop()
+
+    def _characters(self, content):
+        escaped = not self._in_cdata
+        if escaped:
+            content = content.replace('&', '&amp;').replace('<', '&lt;') \
+                .replace('>', '&gt;')
+        children = self._els[-1].childNodes
+        last = children[-1] if children else None
+        if (type(last) is _Text and last.escaped is escaped and
+                not last._cdata):
+            last.data += content
+        else:
+            children.append(_Text(content, self._parser.CurrentLineNumber,
+                                  escaped))
+
+    def _processing_instruction(self, target, data):
+        self._els[-1].childNodes.append(_ProcessingInstruction(
+            target, data, self._parser.CurrentLineNumber))
+
+    def _skipped_entity(self, name, is_parameter_entity):
         '''Deals with an HTML entity such as &nbsp;
         (XML itself defines very few entities.)
-
-        The presence of a SYSTEM doctype makes expat say "hey, that MIGHT be
-        a valid entity, better pass it along to sax and find out!"
-        (Since expat is nonvalidating, it never reads the external doctypes.)
         '''
-        return self.characters(html5[name])
-
-    def startElementNS(self, name, qname, attrs):  # pragma no cover
-        raise NotImplementedError('startElementNS')
-
-    def endElementNS(self, name, qname):  # pragma no cover
-        raise NotImplementedError('startElementNS')
-
-    def startPrefixMapping(self, prefix, uri):  # pragma no cover
-        raise NotImplementedError('startPrefixMapping')
-
-    def endPrefixMapping(self, prefix):  # pragma no cover
-        raise NotImplementedError('endPrefixMapping')
-
-    # LexicalHandler implementation
-    def comment(self, text):
-        node = self._doc.createComment(text)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
-
-    def startCDATA(self):
-        node = self._doc.createTextNode('<![CDATA[')
-        node._cdata = True
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
-        self._cdata_stack.append(self._els[-1])
+        try:
+            text = html5[name + ';']
+        except KeyError:
+            raise sax.SAXParseException(
+                'undefined entity &%s;' % name, None,
+                _Locator(self._filename, self._parser.CurrentLineNumber,
+                         self._parser.CurrentColumnNumber))
+        return self._characters(text)
 
-    def endCDATA(self):
-        node = self._doc.createTextNode(']]>')
-        node._cdata = True
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
-        self._cdata_stack.pop()
+    def _comment(self, text):
+        self._els[-1].childNodes.append(
+            _Comment(text, self._parser.CurrentLineNumber))
 
-    def startDTD(self, name, pubid, sysid):
-        self._doc.doctype = impl.createDocumentType(name, pubid, sysid)
+    def _start_cdata(self):
+        self._els[-1].childNodes.append(_Text(
+            '<![CDATA[', self._parser.CurrentLineNumber, False, True))
+        self._in_cdata = True
 
-    def endDTD(self):
-        pass
+    def _end_cdata(self):
+        self._els[-1].childNodes.append(_Text(
+            ']]>', self._parser.CurrentLineNumber, False, True))
+        self._in_cdata = False
 
 
 def expand(tree, parent=None):
-    if isinstance(tree, dom.Document):
+    if isinstance(tree, _Document):
         expand(tree.firstChild, tree)
         return tree
     if not isinstance(getattr(tree, 'tagName', None), basestring):
@@ -578,9 +666,7 @@ def expand(tree, parent=None):
         tree.tagName = 'py:nop'
     if tree.tagName != 'py:nop' and tree.hasAttribute('py:extends'):
         value = tree.getAttribute('py:extends')
-        el = tree.ownerDocument.createElement('py:extends')
-        el.setAttribute('href', value)
-        el.lineno = tree.lineno
+        el = _Element('py:extends', {'href': value}, tree.lineno)
         tree.removeAttribute('py:extends')
         tree.childNodes.insert(0, el)
     for directive, attr in QDIRECTIVES:
@@ -589,8 +675,7 @@ def expand(tree, parent=None):
         value = tree.getAttribute(directive)
         tree.removeAttribute(directive)
         # nsmap = (parent is not None) and parent.nsmap or tree.nsmap
-        el = tree.ownerDocument.createElement(directive)
-        el.lineno = tree.lineno
+        el = _Element(directive, lineno=tree.lineno)
         if attr:
             el.setAttribute(attr, value)
         # el.setsourceline = tree.sourceline
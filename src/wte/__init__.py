@@ -10,11 +10,13 @@ the ``WSGIApplication``.
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from pywebtools.sqlalchemy import Base, DBSession, check_database_version
 from sqlalchemy import engine_from_config
 
-from wte import views, text_formatter
+from wte import archive, jobs, views, text_formatter
 from wte.models import (DB_VERSION)
+from wte.util import template_packages
 
 
 def main(global_config, **settings):
@@ -29,11 +31,17 @@ def main(global_config, **settings):
     # Init configuration
     config = Configurator(settings=settings)
     config.include('kajiki.integration.pyramid')
+    if asbool(settings.get('kajiki.preload', False)):
+        config.registry.kajiki_loader.preload(template_packages(settings),
+                                              settings.get('kajiki.extensions', '.kajiki').split())
     # Init routes
     config.add_static_view('static', 'static', cache_max_age=3600)
     views.init(config, settings)
     # Init docutils
     text_formatter.init(settings)
+    # Init archives
+    archive.init(settings)
+    jobs.init(settings)
 
     config.scan()
     return config.make_wsgi_app()
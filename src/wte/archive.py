@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+"""
+#####################################################
+:mod:`wte.archive` -- Streaming ZIP archive functions
+#####################################################
+
+The :mod:`~wte.archive` module provides the functions for creating ZIP
+archives that are sent to the client while they are being created, instead
+of being built in memory first. :func:`~wte.archive.zip_stream` turns an
+iterable of archive entries into an iterable of ``bytes`` chunks that can be
+used as the ``app_iter`` of a :class:`~pyramid.response.Response` and
+:func:`~wte.archive.asset_entries` creates the entries for
+:class:`~wte.models.Asset`, fetching their data in batches.
+
+Entries that are the same in many archives are only compressed once. The
+static files included in downloads are compressed once per process (see
+:func:`~wte.archive.static_entry`) and the compressed data of text
+:class:`~wte.models.Asset` is kept in the :data:`~wte.archive.ENTRY_CACHE`,
+keyed by the asset's etag. Only etags that match the asset's data are used
+as keys. Their compressed data is copied into the archives as it is.
+
+The size of the :data:`~wte.archive.ENTRY_CACHE` is configured using the
+``archive.entry_cache_size`` setting, in MB (default: 32).
+
+Uploaded archives are checked before they are read, using
+:func:`~wte.archive.directory_info` to check the size of the central
+directory without reading it and :func:`~wte.archive.load_json` to load JSON
+entries with a limit on their nesting depth.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import json
+import re
+import struct
+import time
+import zlib
+
+from collections import OrderedDict
+from hashlib import sha1, sha512
+from pkg_resources import resource_string
+from pywebtools.sqlalchemy import DBSession
+from sqlalchemy import case, func, null, select
+from threading import Lock
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+from wte.models import Asset, parts_assets
+
+CHUNK_SIZE = 64 * 1024
+"""The size of the chunks that archives are sent in."""
+BLOB_CHUNK_SIZE = 1024 * 1024
+"""The number of bytes of a large :class:`~wte.models.Asset` read with one
+query."""
+BATCH_SIZE = 100
+"""The number of :class:`~wte.models.Asset` fetched from the database with
+one query."""
+ZIP64_LIMIT = (1 << 31) - 1
+"""Entries, offsets, and sizes above this limit are recorded using the ZIP64
+extensions."""
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+DATA_DESCRIPTOR64 = struct.Struct('<4sLQQ')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+JSON_STRUCTURE = re.compile(br'[\[\]{}"\\]')
+
+
+class CompressedData(object):
+    """The compressed data of a ZIP archive entry, which can be copied into
+    any number of archives without compressing it again. Use
+    :func:`~wte.archive.compress_data` to create it.
+
+    :param compression: The compression type
+    :type compression: ``int``
+    :param crc: The CRC32 of the uncompressed data
+    :type crc: ``int``
+    :param size: The size of the uncompressed data
+    :type size: ``int``
+    :param data: The compressed data
+    :type data: ``bytes``
+    """
+
+    __slots__ = ('compression', 'crc', 'size', 'data')
+
+    def __init__(self, compression, crc, size, data):
+        self.compression = compression
+        self.crc = crc
+        self.size = size
+        self.data = data
+
+
+def compress_data(data, compression):
+    """Compresses the ``data`` for use in ZIP archives.
+
+    :param data: The data to compress
+    :type data: ``bytes``
+    :param compression: The compression type
+    :type compression: ``int``
+    :return: The compressed data
+    :rtype: :class:`~wte.archive.CompressedData`
+    """
+    if compression == ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    else:
+        compressed = bytes(data)
+    return CompressedData(compression, zlib.crc32(data) & 0xffffffff, len(data), compressed)
+
+
+class EntryCache(object):
+    """Least recently used cache for :class:`~wte.archive.CompressedData`,
+    which holds at most ``max_size`` bytes of compressed data.
+
+    :param max_size: The maximum size of the cached data in bytes
+    :type max_size: ``int``
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns the :class:`~wte.archive.CompressedData` cached for the
+        ``key`` or ``None``."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        """Adds the :class:`~wte.archive.CompressedData` ``entry`` for the
+        ``key``, removing the least recently used entries to make space.
+        Entries larger than an eighth of the cache are not cached."""
+        if len(entry.data) > self.max_size // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.size = self.size + len(entry.data)
+            while self.size > self.max_size:
+                _, removed = self._entries.popitem(last=False)
+                self.size = self.size - len(removed.data)
+
+
+ENTRY_CACHE = EntryCache(32 * 1024 * 1024)
+"""The :class:`~wte.archive.EntryCache` for the compressed data of
+:class:`~wte.models.Asset`, keyed by (asset id, etag, size, compression
+type). Entries are only added if the etag matches the asset's data."""
+STATIC_ENTRIES = {}
+"""The :class:`~wte.archive.CompressedData` of the static files, keyed by
+their resource path."""
+
+
+def init(settings):
+    """Initialises the :data:`~wte.archive.ENTRY_CACHE` from the
+    ``settings``."""
+    global ENTRY_CACHE
+    ENTRY_CACHE = EntryCache(int(float(settings.get('archive.entry_cache_size', 32)) * 1024 * 1024))
+
+
+def static_entry(source):
+    """Returns the compressed data of the static file ``source`` in the
+    :mod:`wte` package. Each static file is only read and compressed once.
+
+    :param source: The path of the static file
+    :type source: `unicode`
+    :return: The compressed data
+    :rtype: :class:`~wte.archive.CompressedData`
+    """
+    entry = STATIC_ENTRIES.get(source)
+    if entry is None:
+        entry = compress_data(resource_string('wte', source), ZIP_DEFLATED)
+        STATIC_ENTRIES[source] = entry
+    return entry
+
+
+def compress_type(mimetype):
+    """Returns the compression to use for data of the given ``mimetype``.
+    Text is compressed, while other formats (images, fonts, archives) are
+    mostly compressed already and are stored as they are.
+
+    :param mimetype: The mimetype of the data
+    :type mimetype: `unicode`
+    :return: The compression type
+    :rtype: ``int``
+    """
+    if mimetype and mimetype.startswith('text'):
+        return ZIP_DEFLATED
+    else:
+        return ZIP_STORED
+
+
+def dos_date_time(timestamp):
+    """Returns the MS-DOS (date, time) for the ``timestamp``, as used in ZIP
+    archives."""
+    date_time = time.localtime(timestamp)
+    return ((max(date_time[0], 1980) - 1980) << 9 | date_time[1] << 5 | date_time[2],
+            date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2)
+
+
+def rechunk(pieces, chunk_size):
+    """Combines the ``pieces`` of ``bytes`` into chunks of at least
+    ``chunk_size`` bytes and splits larger pieces into chunks of
+    ``chunk_size`` bytes."""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        if len(piece) > chunk_size:
+            if buffer:
+                yield b''.join(buffer)
+                buffer = []
+                buffered = 0
+            view = memoryview(piece)
+            for offset in range(0, len(view), chunk_size):
+                yield bytes(view[offset:offset + chunk_size])
+        elif piece:
+            buffer.append(piece)
+            buffered = buffered + len(piece)
+            if buffered >= chunk_size:
+                yield b''.join(buffer)
+                buffer = []
+                buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def zip_stream(entries, chunk_size=CHUNK_SIZE):
+    """Generates a ZIP archive containing the ``entries``. Each entry is a
+    (filename, data, compression type) ``tuple``, where the data is
+    ``bytes``, `unicode`, ``None``, a :class:`~wte.archive.BlobReader`, or
+    a :class:`~wte.archive.CompressedData`. The entries are consumed one at
+    a time and the archive is yielded in chunks of roughly ``chunk_size``
+    bytes as it is generated, with the central directory yielded at the end.
+    Thus at most the current entry's data and a single chunk are held in
+    memory.
+
+    The data of :class:`~wte.archive.CompressedData` entries is copied into
+    the archive as it is. All other entries are compressed while they are
+    written and their CRC and sizes are written in a data descriptor after
+    the data.
+
+    :param entries: The entries to add to the archive
+    :type entries: iterable of ``tuple``
+    :param chunk_size: The size of the chunks to yield
+    :type chunk_size: ``int``
+    :return: The chunks of the archive
+    :rtype: generator of ``bytes``
+    """
+    return rechunk(zip_pieces(entries, chunk_size), chunk_size)
+
+
+def zip_pieces(entries, chunk_size):
+    """Generates the pieces of the ZIP archive for
+    :func:`~wte.archive.zip_stream`."""
+    offset = 0
+    central = []
+    dos_date, dos_time = dos_date_time(time.time())
+    for filename, data, compression in entries:
+        try:
+            name = filename.encode('ascii')
+            flags = 0
+        except UnicodeEncodeError:
+            name = filename.encode('utf-8')
+            flags = 0x800
+        header_offset = offset
+        if isinstance(data, CompressedData):
+            crc, compressed_size, size = data.crc, len(data.data), data.size
+            compression = data.compression
+            zip64 = size > ZIP64_LIMIT or compressed_size > ZIP64_LIMIT
+            if zip64:
+                extra = struct.pack('<HHQQ', 1, 16, size, compressed_size)
+                header = LOCAL_HEADER.pack(b'PK\003\004', 45, 0, flags, compression, dos_time, dos_date, crc,
+                                           0xffffffff, 0xffffffff, len(name), len(extra))
+            else:
+                extra = b''
+                header = LOCAL_HEADER.pack(b'PK\003\004', 20, 0, flags, compression, dos_time, dos_date, crc,
+                                           compressed_size, size, len(name), 0)
+            yield header + name + extra
+            yield data.data
+            offset = offset + len(header) + len(name) + len(extra) + compressed_size
+        else:
+            if data is None:
+                data = b''
+            elif isinstance(data, str):
+                data = data.encode('utf-8')
+            flags = flags | 0x08
+            zip64 = len(data) * 1.05 > ZIP64_LIMIT
+            if zip64:
+                extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+                header = LOCAL_HEADER.pack(b'PK\003\004', 45, 0, flags, compression, dos_time, dos_date, 0,
+                                           0xffffffff, 0xffffffff, len(name), len(extra))
+            else:
+                extra = b''
+                header = LOCAL_HEADER.pack(b'PK\003\004', 20, 0, flags, compression, dos_time, dos_date, 0,
+                                           0, 0, len(name), 0)
+            yield header + name + extra
+            crc = 0
+            size = 0
+            compressed_size = 0
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) \
+                if compression == ZIP_DEFLATED else None
+            for chunk in ([data] if isinstance(data, bytes) else data):
+                view = memoryview(chunk)
+                for chunk_offset in range(0, len(view), chunk_size):
+                    piece = view[chunk_offset:chunk_offset + chunk_size]
+                    crc = zlib.crc32(piece, crc)
+                    size = size + len(piece)
+                    if compressor is not None:
+                        piece = compressor.compress(piece)
+                    else:
+                        piece = bytes(piece)
+                    compressed_size = compressed_size + len(piece)
+                    yield piece
+            if compressor is not None:
+                piece = compressor.flush()
+                compressed_size = compressed_size + len(piece)
+                yield piece
+            crc = crc & 0xffffffff
+            if not zip64 and (size > ZIP64_LIMIT or compressed_size > ZIP64_LIMIT):
+                raise ValueError('The entry %s is larger than expected' % filename)
+            if zip64:
+                descriptor = DATA_DESCRIPTOR64.pack(b'PK\007\010', crc, compressed_size, size)
+            else:
+                descriptor = DATA_DESCRIPTOR.pack(b'PK\007\010', crc, compressed_size, size)
+            yield descriptor
+            offset = offset + len(header) + len(name) + len(extra) + compressed_size + len(descriptor)
+        central.append((name, flags, compression, crc, compressed_size, size, header_offset))
+    yield b''.join(central_directory(central, offset, dos_date, dos_time))
+
+
+def central_directory(central, offset, dos_date, dos_time):
+    """Generates the central directory and end records for the entries in
+    ``central``, which start at ``offset``."""
+    directory_size = 0
+    for name, flags, compression, crc, compressed_size, size, header_offset in central:
+        zip64 = []
+        if size > ZIP64_LIMIT:
+            zip64.append(size)
+            size = 0xffffffff
+        if compressed_size > ZIP64_LIMIT:
+            zip64.append(compressed_size)
+            compressed_size = 0xffffffff
+        if header_offset > ZIP64_LIMIT:
+            zip64.append(header_offset)
+            header_offset = 0xffffffff
+        extra = struct.pack('<HH%iQ' % len(zip64), 1, 8 * len(zip64), *zip64) if zip64 else b''
+        version = 45 if zip64 else 20
+        header = CENTRAL_HEADER.pack(b'PK\001\002', version, 3, version, 0, flags, compression, dos_time, dos_date,
+                                     crc, compressed_size, size, len(name), len(extra), 0, 0, 0, 0o600 << 16,
+                                     header_offset)
+        directory_size = directory_size + len(header) + len(name) + len(extra)
+        yield header + name + extra
+    count = len(central)
+    if count >= 0xffff or directory_size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+        yield END_RECORD64.pack(b'PK\006\006', END_RECORD64.size - 12, 45, 45, 0, 0, count, count,
+                                directory_size, offset)
+        yield END_LOCATOR64.pack(b'PK\006\007', 0, offset + directory_size, 1)
+        yield END_RECORD.pack(b'PK\005\006', 0, 0, min(count, 0xffff), min(count, 0xffff),
+                              min(directory_size, 0xffffffff), min(offset, 0xffffffff), 0)
+    else:
+        yield END_RECORD.pack(b'PK\005\006', 0, 0, count, count, directory_size, offset, 0)
+
+
+def directory_info(fileobj):
+    """Reads the number of entries and the size of the central directory of
+    the ZIP archive in ``fileobj`` from the archive's end record, without
+    reading the central directory itself. Supports the ZIP64 extensions.
+
+    :param fileobj: The seekable file containing the archive
+    :type fileobj: ``file``
+    :return: The number of entries and the size of the central directory in
+             bytes or ``None`` if the ``fileobj`` is not a ZIP archive
+    :rtype: ``tuple``
+    """
+    try:
+        fileobj.seek(0, 2)
+        file_size = fileobj.tell()
+        tail_size = min(file_size, END_RECORD.size + 0xffff)
+        fileobj.seek(file_size - tail_size)
+        tail = fileobj.read(tail_size)
+        position = tail.rfind(b'PK\005\006')
+        if position < 0:
+            return None
+        record = END_RECORD.unpack(tail[position:position + END_RECORD.size])
+        count, directory_size = record[4], record[5]
+        if count == 0xffff or directory_size == 0xffffffff:
+            locator_position = file_size - tail_size + position - END_LOCATOR64.size
+            if locator_position < 0:
+                return None
+            fileobj.seek(locator_position)
+            locator = END_LOCATOR64.unpack(fileobj.read(END_LOCATOR64.size))
+            if locator[0] != b'PK\006\007':
+                return None
+            fileobj.seek(locator[2])
+            record = END_RECORD64.unpack(fileobj.read(END_RECORD64.size))
+            if record[0] != b'PK\006\006':
+                return None
+            count, directory_size = record[7], record[8]
+        return count, directory_size
+    except struct.error:
+        return None
+    finally:
+        fileobj.seek(0)
+
+
+def load_json(stream, max_depth, chunk_size=CHUNK_SIZE):
+    """Loads the JSON data from the ``stream``, which is read in chunks.
+    While the chunks are read, the nesting depth of the JSON data is tracked
+    and reading stops as soon as it is deeper than ``max_depth``, so that
+    deeply nested data is never decoded.
+
+    :param stream: The stream to read the UTF-8 encoded JSON data from
+    :type stream: ``file``
+    :param max_depth: The maximum nesting depth of objects and arrays
+    :type max_depth: ``int``
+    :param chunk_size: The number of bytes to read at a time
+    :type chunk_size: ``int``
+    :return: The decoded data
+    :raise ValueError: If the data is nested too deeply or is not valid JSON
+    """
+    chunks = []
+    depth = 0
+    in_string = False
+    escaped = -1
+    offset = 0
+    chunk = stream.read(chunk_size)
+    while chunk:
+        chunks.append(chunk)
+        for match in JSON_STRUCTURE.finditer(chunk):
+            position = offset + match.start()
+            if position == escaped:
+                continue
+            char = match.group()
+            if in_string:
+                if char == b'\\':
+                    escaped = position + 1
+                elif char == b'"':
+                    in_string = False
+            elif char == b'"':
+                in_string = True
+            elif char in (b'[', b'{'):
+                depth = depth + 1
+                if depth > max_depth:
+                    raise ValueError('The JSON data is nested too deeply')
+            elif char in (b']', b'}'):
+                depth = depth - 1
+        offset = offset + len(chunk)
+        chunk = stream.read(chunk_size)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def asset_metadata(dbsession, parts):
+    """Loads the metadata of the :class:`~wte.models.Asset` attached to the
+    ``parts`` without loading the assets' data.
+
+    :param dbsession: The database session to use
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param parts: The parts to load the asset metadata for
+    :type parts: ``list`` of :class:`~wte.models.Part`
+    :return: The asset metadata for each part id. Each asset is a row with
+             the ``id``, ``filename``, ``mimetype``, ``type``, ``order``,
+             ``etag``, and ``size`` of the :class:`~wte.models.Asset`
+    :rtype: ``dict``
+    """
+    metadata = dict([(part.id, []) for part in parts])
+    part_ids = list(metadata.keys())
+    for offset in range(0, len(part_ids), BATCH_SIZE):
+        query = dbsession.query(parts_assets.c.part_id, Asset.id, Asset.filename, Asset.mimetype, Asset.type,
+                                Asset.order, Asset.etag, func.length(Asset.data).label('size')).\
+            join(Asset, Asset.id == parts_assets.c.asset_id).\
+            filter(parts_assets.c.part_id.in_(part_ids[offset:offset + BATCH_SIZE])).\
+            order_by(parts_assets.c.part_id, Asset.id)
+        for row in query:
+            metadata[row.part_id].append(row)
+    return metadata
+
+
+def archive_version(parts, metadata, *extra):
+    """Returns a version for an archive of the ``parts``, which changes
+    whenever the content of the archive changes. The version is derived from
+    the ``parts``' attributes, their assets' ``metadata`` (as returned by
+    :func:`~wte.archive.asset_metadata`), and any ``extra`` values that
+    affect the archive.
+
+    :param parts: The parts in the archive
+    :type parts: ``list`` of :class:`~wte.models.Part`
+    :param metadata: The asset metadata for each part id
+    :type metadata: ``dict``
+    :return: The version
+    :rtype: `unicode`
+    """
+    version = sha1(repr(extra).encode('utf-8'))
+    for part in parts:
+        version.update(repr((part.id, part.parent_id, part.type, part.order, part.title, part.status,
+                             part.display_mode, part.content, part.compiled_content)).encode('utf-8'))
+        for asset in metadata.get(part.id, []):
+            version.update(repr(tuple(asset)).encode('utf-8'))
+    return version.hexdigest()
+
+
+class BlobReader(object):
+    """Reads the data of a large :class:`~wte.models.Asset` from the
+    database in chunks, so that it never has to be held in memory as a
+    whole. Iterating over the :class:`~wte.archive.BlobReader` yields the
+    chunks.
+
+    :param connection: The database connection to read with
+    :type connection: :class:`~sqlalchemy.engine.Connection`
+    :param asset_id: The id of the :class:`~wte.models.Asset` to read
+    :type asset_id: ``int``
+    :param size: The size of the data in bytes
+    :type size: ``int``
+    :param chunk_size: The number of bytes to read per query
+    :type chunk_size: ``int``
+    """
+
+    def __init__(self, connection, asset_id, size, chunk_size=BLOB_CHUNK_SIZE):
+        self.connection = connection
+        self.asset_id = asset_id
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        table = Asset.__table__
+        for offset in range(0, self.size, self.chunk_size):
+            query = select([func.substr(table.c.data, offset + 1, self.chunk_size)]).\
+                where(table.c.id == self.asset_id)
+            chunk = self.connection.execute(query).scalar()
+            if not chunk:
+                break
+            yield chunk if isinstance(chunk, bytes) else bytes(chunk)
+
+
+def stream_asset_data(asset_ids, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """Fetches the data of the :class:`~wte.models.Asset` with the given
+    ``asset_ids``. The data of up to ``batch_size`` assets that are no larger
+    than ``chunk_size`` is fetched with a single query, while the data of
+    larger assets is returned as a :class:`~wte.archive.BlobReader`, which
+    reads it in chunks. The assets are fetched using a
+    separate database connection, as the data is usually only fetched while
+    a response is streamed, after the request's transaction has ended.
+    Assets that no longer exist are skipped.
+
+    :param asset_ids: The ids of the assets to fetch
+    :type asset_ids: ``list`` of ``int``
+    :param batch_size: The number of assets to fetch per query
+    :type batch_size: ``int``
+    :param chunk_size: The maximum size of the data fetched per asset and query
+    :type chunk_size: ``int``
+    :return: The (asset id, mimetype, data) of each asset. The data is either
+             ``None``, ``bytes``, or a :class:`~wte.archive.BlobReader`
+    :rtype: generator of ``tuple``
+    """
+    asset_ids = sorted(set(asset_ids))
+    if not asset_ids:
+        return
+    table = Asset.__table__
+    size = func.length(table.c.data)
+    with DBSession.get_bind().connect() as connection:
+        for offset in range(0, len(asset_ids), batch_size):
+            query = select([table.c.id, table.c.mimetype, size,
+                            case([(size <= chunk_size, table.c.data)], else_=null())]).\
+                where(table.c.id.in_(asset_ids[offset:offset + batch_size]))
+            for asset_id, mimetype, data_size, data in connection.execute(query).fetchall():
+                if data_size is not None and data_size > chunk_size:
+                    yield asset_id, mimetype, BlobReader(connection, asset_id, data_size)
+                else:
+                    yield asset_id, mimetype, data
+
+
+def asset_etags(asset_ids):
+    """Computes the etags of the :class:`~wte.models.Asset` with the given
+    ``asset_ids`` from their data, in the same way as the etags that are
+    stored when an asset is created or edited. This is used for assets that
+    were created before the etags were stored. The data is fetched using
+    :func:`~wte.archive.stream_asset_data`.
+
+    :param asset_ids: The ids of the assets
+    :type asset_ids: ``list`` of ``int``
+    :return: The etag for each asset id
+    :rtype: ``dict``
+    """
+    etags = {}
+    for asset_id, _, data in stream_asset_data(asset_ids):
+        etag = sha512()
+        if isinstance(data, bytes):
+            etag.update(data)
+        elif data is not None:
+            for chunk in data:
+                etag.update(chunk)
+        etags[asset_id] = etag.hexdigest()
+    return etags
+
+
+def asset_entries(assets, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """Generates the archive entries for the :class:`~wte.models.Asset` in
+    ``assets``, which maps each asset id to its (mimetype, etag, size,
+    filenames). Each asset is added once for each of its filenames. Text
+    assets whose compressed data is in the :data:`~wte.archive.ENTRY_CACHE`
+    are added without fetching their data, the data of all other assets is
+    fetched using :func:`~wte.archive.stream_asset_data`. Small assets are
+    only compressed once, however many filenames they have, and the
+    compressed data of text assets is added to the
+    :data:`~wte.archive.ENTRY_CACHE` if their etag matches their data. As the
+    cache is keyed by the asset id, an asset whose stored etag does not match
+    its data never uses the cached data of another asset.
+
+    :param assets: The mimetype, etag, size, and filenames for each asset id
+    :type assets: ``dict``
+    :param batch_size: The number of assets to fetch per query
+    :type batch_size: ``int``
+    :param chunk_size: The maximum size of the data fetched per asset and query
+    :type chunk_size: ``int``
+    :return: The archive entries
+    :rtype: generator of ``tuple``
+    """
+    missing = []
+    for asset_id in sorted(assets.keys()):
+        mimetype, etag, size, filenames = assets[asset_id]
+        compression = compress_type(mimetype)
+        entry = ENTRY_CACHE.get((asset_id, etag, size, compression)) if etag and compression == ZIP_DEFLATED \
+            else None
+        if entry is not None:
+            for filename in filenames:
+                yield filename, entry, compression
+        else:
+            missing.append(asset_id)
+    for asset_id, mimetype, data in stream_asset_data(missing, batch_size=batch_size, chunk_size=chunk_size):
+        _, etag, size, filenames = assets[asset_id]
+        compression = compress_type(mimetype)
+        if isinstance(data, BlobReader):
+            for filename in filenames:
+                yield filename, data, compression
+        else:
+            entry = compress_data(data or b'', compression)
+            if etag and compression == ZIP_DEFLATED and sha512(data or b'').hexdigest() == etag:
+                ENTRY_CACHE.put((asset_id, etag, size, compression), entry)
+            for filename in filenames:
+                yield filename, entry, compression
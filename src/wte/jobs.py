@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+##########################################
+:mod:`wte.jobs` -- Background archive jobs
+##########################################
+
+The :mod:`~wte.jobs` module contains the :class:`~wte.jobs.ArchiveQueue`,
+which builds the archives for exporting and downloading
+:class:`~wte.models.Part` in a pool of worker processes and caches the
+finished archives in a directory, so that each archive is only built once
+for each version of a :class:`~wte.models.Part`.
+
+Each archive is identified by a key that combines the kind of archive, the
+id of the :class:`~wte.models.Part`, the role the archive was built for, and
+a version that changes whenever the archive's content changes (see
+:func:`~wte.views.part.archive_key`). The state of each job is kept in the
+cache directory, so that every web worker can report on the jobs started by
+any other web worker:
+
+* ``<key>.zip`` -- The finished archive
+* ``<key>.sha256`` -- The SHA-256 checksum of the finished archive, which is
+  used as its ETag, so that interrupted downloads can be resumed
+* ``<key>.pending`` -- The archive is being built
+* ``<key>.error`` -- Building the archive failed. Contains the error message
+
+The queue is configured using the following settings:
+
+* ``archive.cache_dir`` -- The directory to cache the archives in. If not set,
+  archives are built while they are sent and are not cached
+* ``archive.workers`` -- The number of worker processes. Set to 0 to build the
+  archives in the web worker (default: 1)
+* ``archive.timeout`` -- The time in seconds after which a job that has not
+  completed is treated as failed. The worker processes running such a job are
+  stopped and replaced (default: 600)
+
+Timeouts are only checked when the status of a job is requested using
+:meth:`~wte.jobs.ArchiveQueue.status`, which the status page does each time
+it is reloaded. A job that nobody polls keeps its worker process busy until
+it completes.
+"""
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import weakref
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pyramid.config import Configurator
+from pyramid.request import Request
+from pyramid.scripting import prepare
+from pywebtools.sqlalchemy import DBSession
+from sqlalchemy import engine_from_config
+from threading import Lock
+
+from wte.archive import CHUNK_SIZE, zip_stream
+
+QUEUE = None
+"""The :class:`~wte.jobs.ArchiveQueue` used for creating archives, if
+archives are cached."""
+REGISTRY = None
+"""The Pyramid registry used to render templates in the worker processes."""
+
+
+def init(settings):
+    """Initialises the :data:`~wte.jobs.QUEUE` from the ``settings``. The
+    worker processes are only started when the first job is submitted.
+    """
+    global QUEUE
+    if QUEUE is not None:
+        QUEUE.shutdown()
+        QUEUE = None
+    if settings.get('archive.cache_dir'):
+        QUEUE = ArchiveQueue(settings,
+                             settings['archive.cache_dir'],
+                             workers=int(settings.get('archive.workers', 1)),
+                             timeout=float(settings.get('archive.timeout', 600)))
+
+
+def init_worker(settings):
+    """Initialises a worker process. Sets up the database connection and a
+    Pyramid registry with all routes and the template renderer.
+    """
+    global REGISTRY
+    from wte import archive, views
+    settings = dict(settings)
+    settings['compiler.workers'] = '0'
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    archive.init(settings)
+    config = Configurator(settings=settings)
+    config.include('kajiki.integration.pyramid')
+    views.init(config, settings)
+    config.commit()
+    REGISTRY = config.registry
+
+
+def build_archive(cache_dir, key, kind, request, part):
+    """Builds the archive of the given ``kind`` for the ``part`` and stores
+    it as ``<key>.zip`` in the ``cache_dir``, with its checksum in
+    ``<key>.sha256``. The archive is written to a temporary file first, so
+    that it only becomes visible once it is complete. Archives with the same
+    kind, part, and role, but a different version are removed.
+    """
+    from wte.views.part import archive_entries
+    path = os.path.join(cache_dir, '%s.zip' % key)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    checksum = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as out_file:
+            for chunk in zip_stream(archive_entries(kind, request, part)):
+                checksum.update(chunk)
+                out_file.write(chunk)
+        write_checksum(os.path.join(cache_dir, '%s.sha256' % key), checksum.hexdigest())
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    prefix = '%s-' % key.rsplit('-', 1)[0]
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(prefix) and filename.endswith(('.zip', '.sha256')) and \
+                filename not in ('%s.zip' % key, '%s.sha256' % key):
+            try:
+                os.unlink(os.path.join(cache_dir, filename))
+            except OSError:
+                pass
+
+
+def run_job(cache_dir, key, kind, part_id, user_id, application_url):
+    """Runs a single archive job in a worker process. If building the archive
+    fails, then the error message is written to ``<key>.error``.
+    """
+    from wte.models import Part, User
+    env = None
+    try:
+        os.utime(os.path.join(cache_dir, '%s.pending' % key), None)
+    except OSError:
+        pass
+    try:
+        request = Request.blank('/', base_url=application_url)
+        env = prepare(request=request, registry=REGISTRY)
+        dbsession = DBSession()
+        request.current_user = dbsession.query(User).filter(User.id == user_id).first()
+        request.current_user.logged_in = True
+        part = dbsession.query(Part).filter(Part.id == part_id).first()
+        build_archive(cache_dir, key, kind, request, part)
+    except Exception as e:
+        logging.getLogger('wte').error('Creating the archive %s failed: %s' % (key, e))
+        write_marker(os.path.join(cache_dir, '%s.error' % key), str(e))
+    finally:
+        remove_marker(os.path.join(cache_dir, '%s.pending' % key))
+        DBSession.remove()
+        if env is not None:
+            env['closer']()
+
+
+def write_marker(path, text=''):
+    """Writes the ``text`` into the marker file at ``path``. Errors are
+    ignored."""
+    try:
+        with open(path, 'w') as out_file:
+            out_file.write(text)
+    except (IOError, OSError):
+        pass
+
+
+def write_checksum(path, checksum):
+    """Writes the ``checksum`` into the file at ``path``. The checksum is
+    written to a temporary file first, so that it is never read partially."""
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as out_file:
+            out_file.write(checksum)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove_marker(path):
+    """Removes the marker file at ``path``, if it exists."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class ArchiveQueue(object):
+    """The :class:`~wte.jobs.ArchiveQueue` dispatches archive jobs to a pool
+    of worker processes and tracks their state in the ``cache_dir``. The
+    time a job takes is measured from when a worker process starts it. If a
+    job takes longer than the ``timeout``, then the next call to
+    :meth:`~wte.jobs.ArchiveQueue.status` stops and replaces the worker
+    processes and the other jobs they had been given are submitted again.
+
+    :param settings: The application settings, used to initialise the workers
+    :type settings: ``dict``
+    :param cache_dir: The directory to cache the archives in
+    :type cache_dir: `unicode`
+    :param workers: The number of worker processes
+    :type workers: ``int``
+    :param timeout: The maximum time in seconds a job may take
+    :type timeout: ``float``
+    """
+
+    def __init__(self, settings, cache_dir, workers=1, timeout=600):
+        self.settings = dict(settings)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = Lock()
+        self._jobs = {}
+        self._terminated = weakref.WeakSet()
+
+    def _get_executor(self):
+        """Returns the ``ProcessPoolExecutor``, starting it if necessary."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=get_context('spawn'),
+                                                     initializer=init_worker,
+                                                     initargs=(self.settings,))
+            return self._executor
+
+    def path(self, key, suffix='.zip'):
+        """Returns the path of the file with the ``suffix`` for the archive
+        with the given ``key``."""
+        return os.path.join(self.cache_dir, '%s%s' % (key, suffix))
+
+    def status(self, key):
+        """Returns the status of the archive with the given ``key``. The status
+        is one of "ready" (with the path of the archive), "pending", "failed"
+        (with the error message), or ``None`` if no archive exists and no job
+        has been submitted.
+
+        :return: The status and the path or error message
+        :rtype: ``tuple``
+        """
+        self._check_timeouts()
+        path = self.path(key)
+        if os.path.exists(path):
+            return 'ready', path
+        with self._lock:
+            if key in self._jobs:
+                # Jobs submitted by this process time out in _check_timeouts
+                return 'pending', None
+        try:
+            if time.time() - os.path.getmtime(self.path(key, '.pending')) < self.timeout:
+                return 'pending', None
+            else:
+                return 'failed', 'The archive could not be created in time'
+        except OSError:
+            pass
+        try:
+            with open(self.path(key, '.error')) as in_file:
+                return 'failed', in_file.read()
+        except (IOError, OSError):
+            pass
+        return None, None
+
+    def checksum(self, key):
+        """Returns the SHA-256 checksum of the finished archive with the given
+        ``key``. For archives that were cached without a checksum, the
+        checksum is computed from the archive and stored.
+
+        :return: The hex-encoded checksum
+        :rtype: `unicode`
+        """
+        try:
+            with open(self.path(key, '.sha256')) as in_file:
+                checksum = in_file.read().strip()
+            if checksum:
+                return checksum
+        except (IOError, OSError):
+            pass
+        checksum = hashlib.sha256()
+        with open(self.path(key), 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+        checksum = checksum.hexdigest()
+        try:
+            write_checksum(self.path(key, '.sha256'), checksum)
+        except (IOError, OSError):
+            pass
+        return checksum
+
+    def submit(self, key, kind, request, part):
+        """Submits a job to build the archive with the given ``key``, unless
+        the archive already exists or is already being built. If there are
+        no worker processes, then the archive is built immediately.
+        """
+        if os.path.exists(self.path(key)):
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        pending = self.path(key, '.pending')
+        try:
+            os.close(os.open(pending, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if self.status(key)[0] == 'pending':
+                return
+            os.utime(pending, None)
+        remove_marker(self.path(key, '.error'))
+        if self.workers > 0:
+            self._dispatch(key, (self.cache_dir,
+                                 key,
+                                 kind,
+                                 part.id,
+                                 request.current_user.id,
+                                 request.application_url))
+        else:
+            try:
+                build_archive(self.cache_dir, key, kind, request, part)
+            except Exception as e:
+                logging.getLogger('wte').error('Creating the archive %s failed: %s' % (key, e))
+                write_marker(self.path(key, '.error'), str(e))
+            finally:
+                remove_marker(pending)
+
+    def _dispatch(self, key, args):
+        """Submits the job with the given ``key`` and :func:`~wte.jobs.run_job`
+        ``args`` to the worker processes."""
+        executor = self._get_executor()
+        try:
+            future = executor.submit(run_job, *args)
+        except BrokenProcessPool as e:
+            self._job_failed(key, executor, e)
+        else:
+            with self._lock:
+                self._jobs[key] = (args, future, executor)
+            future.add_done_callback(lambda future: self._job_done(key, executor, future))
+
+    def _job_done(self, key, executor, future):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job[1] is not future:
+                # The job timed out and has already been recorded as failed
+                return
+        if future.cancelled() or future.exception() is None:
+            with self._lock:
+                del self._jobs[key]
+        elif executor in self._terminated:
+            # The worker processes were stopped because another job timed out
+            try:
+                os.utime(self.path(key, '.pending'), None)
+            except OSError:
+                pass
+            self._dispatch(key, job[0])
+        else:
+            self._job_failed(key, executor, future.exception())
+
+    def _check_timeouts(self):
+        """Checks whether any running job submitted by this process has taken
+        longer than the ``timeout``. If so, then the job is recorded as
+        failed and the worker processes are stopped and replaced."""
+        with self._lock:
+            jobs = [(key, job[1], job[2]) for key, job in self._jobs.items()]
+        now = time.time()
+        for key, future, executor in jobs:
+            if executor in self._terminated or not future.running():
+                continue
+            try:
+                if now - os.path.getmtime(self.path(key, '.pending')) < self.timeout:
+                    continue
+            except OSError:
+                continue
+            with self._lock:
+                if self._jobs.get(key, (None, None))[1] is not future:
+                    continue
+                del self._jobs[key]
+                if self._executor is executor:
+                    self._executor = None
+            logging.getLogger('wte').error('Creating the archive %s timed out' % key)
+            write_marker(self.path(key, '.error'), 'The archive could not be created in time')
+            remove_marker(self.path(key, '.pending'))
+            self._terminate(executor)
+
+    def _terminate(self, executor):
+        """Stops the worker processes of the ``executor``. The ``executor``
+        then marks itself as broken and fails all jobs it had been given."""
+        self._terminated.add(executor)
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.kill()
+
+    def _job_failed(self, key, executor, error):
+        """Records a job that could not be run, because the worker process
+        stopped unexpectedly, and discards the ``executor``. Errors while
+        building the archive are recorded by the worker process itself."""
+        logging.getLogger('wte').error('Creating the archive %s failed: %s' % (key, error))
+        write_marker(self.path(key, '.error'), 'The archive could not be created')
+        remove_marker(self.path(key, '.pending'))
+        with self._lock:
+            self._jobs.pop(key, None)
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self):
+        """Stops all worker processes."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,44 @@
+"""
+####################################
+Store whether Parts need typesetting
+####################################
+
+Add the "requires_typesetting" column to the :class:`~wte.models.Part`, so
+that pages do not have to scan the ``compiled_content`` for formulas that
+need to be typeset in the browser on every view.
+
+Revision ID: 2f8c4e7d1a9b
+Revises: c9a72e7ff141
+Create Date: 2026-10-19 09:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from wte.text_formatter.prerender import requires_typesetting
+
+# revision identifiers, used by Alembic.
+revision = '2f8c4e7d1a9b'
+down_revision = 'c9a72e7ff141'
+branch_labels = None
+depends_on = None
+
+metadata = sa.MetaData()
+p = sa.Table('parts', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('compiled_content', sa.UnicodeText),
+             sa.Column('requires_typesetting', sa.Boolean))
+
+
+def upgrade():
+    op.add_column('parts', sa.Column('requires_typesetting', sa.Boolean, default=False))
+    bind = op.get_bind()
+    metadata.bind = bind
+    bind.execute(p.update().values(requires_typesetting=False))
+    for part in bind.execute(p.select().where(p.c.compiled_content != None)).fetchall():
+        if requires_typesetting(part[1]):
+            bind.execute(p.update().values(requires_typesetting=True).where(p.c.id == part[0]))
+
+
+def downgrade():
+    op.drop_column('parts', 'requires_typesetting')
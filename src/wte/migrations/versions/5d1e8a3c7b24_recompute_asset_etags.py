@@ -0,0 +1,48 @@
+"""
+######################
+Recompute Asset E-Tags
+######################
+
+Recompute the "etag" of all :class:`~wte.models.Asset` from their data. The
+etags of assets that were uploaded as new files were computed after their
+data had already been read and are thus the etag of no data at all.
+
+Revision ID: 5d1e8a3c7b24
+Revises: 2f8c4e7d1a9b
+Create Date: 2026-10-19 14:37:05.811342
+
+"""
+from alembic import op
+import hashlib
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5d1e8a3c7b24'
+down_revision = '2f8c4e7d1a9b'
+branch_labels = None
+depends_on = None
+
+metadata = sa.MetaData()
+a = sa.Table('assets', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('data', sa.LargeBinary),
+             sa.Column('etag', sa.Unicode(255)))
+
+
+def upgrade():
+    bind = op.get_bind()
+    metadata.bind = bind
+    last_id = 0
+    while True:
+        assets = bind.execute(a.select().where(a.c.id > last_id).order_by(a.c.id).limit(100)).fetchall()
+        if not assets:
+            break
+        for asset in assets:
+            etag = hashlib.sha512(asset[1]).hexdigest() if asset[1] is not None else None
+            if etag != asset[2]:
+                bind.execute(a.update().values(etag=etag).where(a.c.id == asset[0]))
+        last_id = assets[-1][0]
+
+
+def downgrade():
+    pass
@@ -21,7 +21,7 @@ from sqlalchemy.orm import (relationship, backref)
 
 from wte.helpers.frontend import confirm_delete, MenuBuilder, confirm_action
 
-DB_VERSION = 'c9a72e7ff141'
+DB_VERSION = '5d1e8a3c7b24'
 """The currently required database version."""
 
 
@@ -71,6 +71,7 @@ class Part(Base):
     * ``parent_id`` -- The unique database identifier of the parent :class:`~wte.models.Part`
     * ``parent`` -- The parent :class:`~wte.models.Part`
     * ``progress`` -- The :class:`~wte.models.UserPartProgress` linked to this :class:`~wte.models.Part`
+    * ``requires_typesetting`` -- Whether the ``compiled_content`` contains formulas to typeset in the browser
     * ``status`` -- The :class:`~wte.models.Part`'s availability status
     * ``summary`` -- The shortened summary derived from the ``compiled_content``
     * ``tasks`` -- List of :class:`~wte.models.TimedTask` that are attached to this
@@ -93,6 +94,7 @@ class Part(Base):
     label = Column(Unicode(255), index=True)
     content = Column(UnicodeText)
     compiled_content = Column(UnicodeText)
+    requires_typesetting = Column(Boolean, default=False)
     access_rights = Column(UnicodeText)
 
     children = relationship('Part',
@@ -135,7 +137,8 @@ class Part(Base):
 
     def allow(self, action, user):
         """Checks whether the given ``user`` is allowed to perform the given
-        ``action``. Supports the following actions: view, edit, delete, and users.
+        ``action``. Supports the following actions: view, edit, delete, users, and
+        progress (access the progress and files of all students).
 
         :param action: The action to check for
         :type action: `unicode`
@@ -186,6 +189,11 @@ class Part(Base):
                     return False
             elif self.parent:
                 self.parent.allow(action, user)
+        elif action == 'progress':
+            if user.has_permission('admin.modules.view'):
+                return True
+            elif self.root().has_role(['owner', 'tutor'], user):
+                return True
         return False
 
     def has_role(self, role, user):
@@ -385,6 +393,9 @@ class Part(Base):
                 # Import Menu Item
                 builder.menu('Import',
                              request.route_url('part.import', _query=[('parent_id', self.id)]))
+            # Update Menu Item
+            builder.menu('Update from Export',
+                         request.route_url('part.update', pid=self.id))
             # Export Menu Item
             builder.menu('Export',
                          request.route_url('part.export',
@@ -396,6 +407,10 @@ class Part(Base):
             builder.menu('Download',
                          request.route_url('part.download', pid=self.id),
                          attrs={'class': 'post-link'})
+        if self.type in ['module', 'part'] and self.allow('progress', request.current_user):
+            # Download Students' Files Menu Item
+            builder.menu('Download Students\' Files',
+                         request.route_url('part.progress.download_all', pid=self.id))
         if self.allow('delete', request.current_user):
             builder.group('Delete')
             # Delete Menu Item
@@ -43,13 +43,15 @@ def main():
     complete parser and then calls the appropriate function for the command
     the user provided on the command-line.
     """
-    from . import configuration, database, timed_tasks
+    from . import configuration, database, progress, template_cache, timed_tasks
 
     parser = ArgumentParser(description='WTE administration application')
     subparsers = parser.add_subparsers()
 
     configuration.init(subparsers)
     database.init(subparsers)
+    progress.init(subparsers)
+    template_cache.init(subparsers)
     timed_tasks.init(subparsers)
 
     args = parser.parse_args()
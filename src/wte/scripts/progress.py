@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+########################################################
+:mod:`wte.scripts.progress` -- Student progress scripts
+########################################################
+
+The :mod:`~wte.scripts.progress` module provides the functionality for
+downloading the files of all students for a :class:`~wte.models.Part`.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import logging
+
+from pyramid.paster import (get_appsettings, setup_logging)
+from pywebtools.sqlalchemy import DBSession
+from sqlalchemy import engine_from_config
+
+from wte.archive import zip_stream
+from wte.models import Part
+
+
+def init(subparsers):
+    """Initialises the :class:`~argparse.ArgumentParser`, adding the
+    "download-progress" command that runs :func:`~wte.scripts.progress.download_progress`.
+    """
+    parser = subparsers.add_parser('download-progress', help='Download the files of all students for a part')
+    parser.add_argument('configuration', help='WTE configuration file')
+    parser.add_argument('part_id', type=int, help='The id of the module or part')
+    parser.add_argument('output', help='The ZIP file to write the files to')
+    parser.set_defaults(func=download_progress)
+
+
+def download_progress(args):
+    """Writes the files of all students for the part into the output ZIP file
+    (see :func:`~wte.views.part.cohort_progress_entries`).
+    """
+    from wte.views.part import cohort_progress_entries
+    settings = get_appsettings(args.configuration)
+    setup_logging(args.configuration)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    dbsession = DBSession()
+    part = dbsession.query(Part).filter(Part.id == args.part_id).first()
+    if not part:
+        logging.getLogger('wte').error('Part %i does not exist' % (args.part_id))
+        return
+    with open(args.output, 'wb') as out_file:
+        for chunk in zip_stream(cohort_progress_entries(part)):
+            out_file.write(chunk)
+    dbsession.close()
+    logging.getLogger('wte').info('Students\' files for %s written to %s' % (part.title, args.output))
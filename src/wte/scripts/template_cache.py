@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+##################################################################
+:mod:`wte.scripts.template_cache` -- Template compilation scripts
+##################################################################
+
+The :mod:`~wte.scripts.template_cache` module provides the functionality for
+compiling all HTML templates ahead of time into the template cache
+configured by the "kajiki.cache_dir" setting.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import logging
+
+from kajiki.cache import BytecodeCache
+from kajiki.integration.pyramid import find_templates
+from kajiki.xml_template import XMLTemplate
+from pyramid.paster import (get_appsettings, setup_logging)
+
+from wte.util import template_packages
+
+
+def init(subparsers):
+    """Initialises the :class:`~argparse.ArgumentParser`, adding the
+    "compile-templates" command that runs :func:`~wte.scripts.template_cache.compile_templates`.
+    """
+    parser = subparsers.add_parser('compile-templates', help='Compile all HTML templates into the template cache')
+    parser.add_argument('configuration', help='WTE configuration file')
+    parser.add_argument('--clear', action='store_true', default=False, help='Remove all cached templates first')
+    parser.set_defaults(func=compile_templates)
+
+
+def compile_templates(args):
+    """Compiles all templates in the directories returned by
+    :func:`~wte.util.template_packages` and stores them in the template cache.
+    """
+    settings = get_appsettings(args.configuration)
+    setup_logging(args.configuration)
+    if not settings.get('kajiki.cache_dir'):
+        logging.getLogger('wte').error('Cannot compile templates as the "kajiki.cache_dir" setting is not specified')
+        return
+    cache = BytecodeCache(settings['kajiki.cache_dir'])
+    if args.clear:
+        cache.clear()
+    mode = settings.get('kajiki.mode', 'html5')
+    extensions = settings.get('kajiki.extensions', '.kajiki').split()
+    compiled_count = 0
+    failed_count = 0
+    for spec in template_packages(settings):
+        for filename in find_templates(spec, extensions):
+            try:
+                XMLTemplate(filename=filename, mode=mode, bytecode_cache=cache)
+                compiled_count = compiled_count + 1
+            except Exception as e:
+                logging.getLogger('wte').error('Failed to compile %s: %s' % (filename, e))
+                failed_count = failed_count + 1
+    if failed_count > 0:
+        logging.getLogger('wte').error('%i templates failed to compile' % (failed_count))
+    logging.getLogger('wte').info('%i templates compiled' % (compiled_count))
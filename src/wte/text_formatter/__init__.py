@@ -13,9 +13,11 @@ from copy import deepcopy
 from docutils import core
 from docutils.writers import html4css1
 
-from . import docutils_ext  # NOQA
+from . import docutils_ext, pool  # NOQA
+from .prerender import prerender
 
 SETTINGS = {}
+PRERENDER = {'enabled': True}
 
 
 def init(settings):
@@ -26,28 +28,71 @@ def init(settings):
     SETTINGS['initial_header_level'] = 2
     SETTINGS['raw_enabled'] = False
     SETTINGS['file_insertion_enabled'] = False
+    SETTINGS['wte_inline_images_max_size'] = int(settings.get('prerender.inline_images_max_size', 0))
+    PRERENDER['enabled'] = settings.get('prerender.math', 'true').lower() == 'true'
+    pool.init(settings)
 
 
-def compile_rst(text, request, part=None, line_numbers=False):
+def compile_rst(text, request, part=None, line_numbers=False, isolated=False):
     """Compiles the given ReStructuredText into HTML. Returns only the actual
-    content of the generated HTML document, without headers or footers.
+    content of the generated HTML document, without headers or footers, together
+    with the metadata for all quizzes in the document (see
+    :func:`~wte.text_formatter.docutils_ext.quiz_metadata`).
+
+    Unless disabled via the "prerender.math" setting, the generated HTML is
+    passed through :func:`~wte.text_formatter.prerender.prerender`.
+
+    If ``isolated`` is ``True`` and the :data:`~wte.text_formatter.pool.POOL`
+    is enabled, then the ReST is compiled in a worker process and any error is
+    raised as a :class:`~wte.text_formatter.pool.CompilationError`. As the
+    worker process uses its own database connection, the ``part`` must have been
+    committed to the database.
 
     :param text: The ReST to compile
     :type text: `unicode`
     :param line_numbers: Whether to generate a "data-source-ln" attribute with
                          source line-numbers (default: ``false``)
     :type line_numbers: ``boolean``
-    :return: The body content of the generated HTML
-    :return_type: `unicode`
+    :param isolated: Whether to compile in a worker process (default: ``false``)
+    :type isolated: ``boolean``
+    :return: The body content of the generated HTML and the quiz metadata
+    :return_type: (`unicode`, ``list``) ``tuple``
     """
+    if isolated and pool.POOL is not None:
+        return pool.POOL.compile(text, request, part=part, line_numbers=line_numbers)
     settings = deepcopy(SETTINGS)
     settings['pyramid_request'] = request
     settings['wte_part'] = part
+    docutils_ext.register_code_roles(text)
     writer = html4css1.Writer()
     if line_numbers:
         writer.translator_class = HTMLLineNumbersTranslator
     parts = core.publish_parts(source=text, writer=writer, settings_overrides=settings)
-    return parts['body']
+    body = parts['body']
+    if PRERENDER['enabled']:
+        body = prerender(body)
+    return body, docutils_ext.quiz_metadata(writer.document)
+
+
+def compile_parts(parts, request):
+    """Compiles the ``content`` of all ``parts``. If the :data:`~wte.text_formatter.pool.POOL`
+    is enabled, then the :class:`~wte.models.Part` are compiled in parallel in the
+    worker processes. Yields (:class:`~wte.models.Part`, result) pairs in the order
+    of the ``parts``, where the result is either the return value of
+    :func:`~wte.text_formatter.compile_rst` or the exception raised while compiling.
+
+    :param parts: The :class:`~wte.models.Part` to compile
+    :type parts: ``list``
+    """
+    if pool.POOL is not None:
+        for result in pool.POOL.compile_parts(parts, request):
+            yield result
+    else:
+        for part in parts:
+            try:
+                yield part, compile_rst(part.content, request, part=part)
+            except Exception as e:
+                yield part, e
 
 
 class HTMLLineNumbersTranslator(html4css1.HTMLTranslator):
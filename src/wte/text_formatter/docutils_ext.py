@@ -11,14 +11,19 @@ the additional formatting support required by the
 import json
 import re
 
+from base64 import b64encode
+from collections import OrderedDict
 from docutils import nodes, utils
 from docutils.parsers.rst import directives, roles, Directive
 from docutils.writers.html4css1 import HTMLTranslator
+from hashlib import sha1
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name, TextLexer, get_all_lexers
+from pygments.lexers import get_lexer_by_name, find_lexer_class_by_name, TextLexer
+from pygments.util import ClassNotFound
 from pywebtools.sqlalchemy import DBSession
 from sqlalchemy import and_
+from threading import Lock
 
 from wte.models import (Asset, Part)
 
@@ -26,6 +31,7 @@ from wte.models import (Asset, Part)
 def init(settings):
     """Initialise and load the docutils extensions.
     """
+    HIGHLIGHT_CACHE.resize(int(settings.get('pygments.cache_size', HIGHLIGHT_CACHE.max_size)))
     directives.register_directive('sourcecode', Pygments)
     directives.register_directive('youtube', YouTube)
     directives.register_directive('quiz', Quiz)
@@ -34,9 +40,6 @@ def init(settings):
     roles.register_local_role('asset', asset_ref_role)
     roles.register_local_role('crossref', crossref_role)
     roles.register_local_role('style', inline_css_role)
-    for _, aliases, _, _ in get_all_lexers():
-        for alias in aliases:
-            roles.register_local_role('code-%s' % (alias), inline_pygments_role)
     nodes._add_node_class_names([HtmlElementBlock.__name__])
     setattr(HTMLTranslator, 'visit_%s' % HtmlElementBlock.__name__, visit_htmlelementblock)
     setattr(HTMLTranslator, 'depart_%s' % HtmlElementBlock.__name__, depart_htmlelementblock)
@@ -95,6 +98,111 @@ def depart_htmlelementblock(self, node):
     self.body.append('</%s>\n' % element_name)
 
 
+LEXERS = {}
+"""Registry of :class:`~pygments.lexer.Lexer` instances, keyed by (language, options)."""
+FORMATTERS = {}
+"""Registry of :class:`~pygments.formatters.HtmlFormatter` instances, keyed by their options."""
+
+
+def get_lexer(language, options=None):
+    """Returns the cached :class:`~pygments.lexer.Lexer` for the ``language``
+    and ``options``. If no lexer exists for the ``language``, then a
+    :class:`~pygments.lexers.TextLexer` is returned.
+
+    :param language: The name or alias of the language to highlight
+    :type language: `unicode`
+    :param options: The options to pass to the lexer
+    :type options: ``dict``
+    :return: The lexer
+    :rtype: :class:`~pygments.lexer.Lexer`
+    """
+    options = options or {}
+    key = (language, tuple(sorted(options.items())))
+    if key not in LEXERS:
+        try:
+            LEXERS[key] = get_lexer_by_name(language, **options)
+        except ValueError:
+            # no lexer found - use the text one instead of an exception
+            LEXERS[key] = TextLexer()
+    return LEXERS[key]
+
+
+def get_formatter(**options):
+    """Returns the cached :class:`~pygments.formatters.HtmlFormatter` for the
+    given ``options``.
+
+    :return: The formatter
+    :rtype: :class:`~pygments.formatters.HtmlFormatter`
+    """
+    key = tuple(sorted(options.items()))
+    if key not in FORMATTERS:
+        FORMATTERS[key] = HtmlFormatter(**options)
+    return FORMATTERS[key]
+
+
+class HighlightCache(object):
+    """The :class:`~wte.text_formatter.docutils_ext.HighlightCache` is a
+    thread-safe least-recently-used cache for highlighted source code. Entries
+    are keyed by the SHA1 hash of the source code, the language, and the options
+    of the lexer and formatter, so that repeated snippets are only highlighted
+    once.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def resize(self, max_size):
+        """Set the maximum number of entries to ``max_size``, evicting the least
+        recently used entries if necessary."""
+        with self._lock:
+            self.max_size = max_size
+            while len(self._entries) > max(self.max_size, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def highlight(self, code, language, lexer, formatter):
+        """Returns the highlighted HTML for the ``code``, only running Pygments if
+        the ``code`` has not previously been highlighted with the same settings.
+
+        :param code: The source code to highlight
+        :type code: `unicode`
+        :param language: The language the ``code`` is in
+        :type language: `unicode`
+        :param lexer: The lexer to use for highlighting
+        :type lexer: :class:`~pygments.lexer.Lexer`
+        :param formatter: The formatter to use for highlighting
+        :type formatter: :class:`~pygments.formatters.HtmlFormatter`
+        :return: The highlighted HTML
+        :rtype: `unicode`
+        """
+        key = (sha1(code.encode('utf-8')).hexdigest(),
+               language,
+               tuple(sorted(lexer.options.items())),
+               tuple(sorted(formatter.options.items())))
+        with self._lock:
+            if key in self._entries:
+                # Re-insert the entry to mark it as the most recently used
+                parsed = self._entries.pop(key)
+                self._entries[key] = parsed
+                return parsed
+        parsed = highlight(code, lexer, formatter)
+        with self._lock:
+            self._entries[key] = parsed
+            while len(self._entries) > max(self.max_size, 0):
+                self._entries.popitem(last=False)
+        return parsed
+
+
+HIGHLIGHT_CACHE = HighlightCache()
+"""The process-wide :class:`~wte.text_formatter.docutils_ext.HighlightCache`."""
+
+
 class Pygments(Directive):
     """The Pygments reStructuredText directive
 
@@ -139,16 +247,14 @@ class Pygments(Directive):
 
     def run(self):
         self.assert_has_content()
-        try:
-            lexer = get_lexer_by_name(self.arguments[0], **self.options)
-        except ValueError:
-            # no lexer found - use the text one instead of an exception
-            lexer = TextLexer()
-        formatter = HtmlFormatter(noclasses=False,
+        lexer = get_lexer(self.arguments[0], self.options)
+        linenos = 'linenos' in self.options
+        start = self.options['linenos'] if linenos else 1
+        formatter = get_formatter(noclasses=False,
                                   style='native',
-                                  linenos='inline' if 'linenos' in self.options else False,
-                                  linenostart=self.options['linenos'] if 'linenos' in self.options else 1)
-        parsed = highlight('\n'.join(self.content), lexer, formatter)
+                                  linenos='inline' if linenos else False,
+                                  linenostart=start)
+        parsed = HIGHLIGHT_CACHE.highlight('\n'.join(self.content), self.arguments[0], lexer, formatter)
         css_classes = ['source', 'panel', lexer.name]
         if 'no-select' in self.options and self.options['no-select']:
             css_classes.append('no-select')
@@ -234,16 +340,39 @@ def inline_pygments_role(name, rawtext, text, lineno, inliner, options={}, conte
     using Pygments. The name of the language to use for highlighting is taken
     from the name of the role (which must be formatted ``code-language_name``).
     """
-    try:
-        lexer = get_lexer_by_name(name[5:])
-    except ValueError:
-        lexer = TextLexer()
-    formatter = HtmlFormatter(nowrap=True)
+    lexer = get_lexer(name[5:])
+    formatter = get_formatter(nowrap=True)
     text = text.replace('\x00', '')
-    parsed = highlight(text, lexer, formatter)
+    parsed = HIGHLIGHT_CACHE.highlight(text, name, lexer, formatter)
     return [nodes.raw('', '<span class="source">%s</span>' % (parsed), format='html')], []
 
 
+CODE_ROLE_PATTERN = re.compile(r'(?::|role::\s+)(code-[\w+#.-]+)', re.IGNORECASE)
+"""Regular expression matching the names of the ``code-language_name`` roles
+used in ReST text."""
+CODE_ROLES = set()
+"""The names of the ``code-language_name`` roles that have been checked."""
+
+
+def register_code_roles(text):
+    """Registers the :func:`~wte.text_formatter.docutils_ext.inline_pygments_role`
+    for each ``code-language_name`` role used in the ReST ``text`` that has not
+    been registered yet and for whose language Pygments has a lexer. Thus only
+    the roles that are used are registered, instead of one role for every alias
+    of every Pygments lexer. Roles for languages without a lexer remain unknown.
+
+    :param text: The ReST text that will be compiled
+    :type text: `unicode`
+    """
+    for role_name in set([name.lower() for name in CODE_ROLE_PATTERN.findall(text or '')]) - CODE_ROLES:
+        try:
+            find_lexer_class_by_name(role_name[5:])
+            roles.register_local_role(role_name, inline_pygments_role)
+        except ClassNotFound:
+            pass
+        CODE_ROLES.add(role_name)
+
+
 ASSET_PATTERN = re.compile(r'((?:(parent):)?([a-zA-Z0-9_\-.]+)$)|((.+)(?:<(?:(parent):)?([a-zA-Z0-9_\-.]+)>)$)')
 
 
@@ -252,7 +381,8 @@ def asset_ref_role(name, rawtext, text, lineno, inliner, options={}, content=[])
     provides a docutils role that handles linking in :class:`~wte.models.Asset`
     into the text. If the :class:`~wte.models.Asset` is an image, then the
     image is loaded inline, otherwise a download link for all other types
-    of :class:`~wte.models.Asset` is created.
+    of :class:`~wte.models.Asset` is created. Images that are no larger than
+    the "prerender.inline_images_max_size" setting are embedded as data URIs.
     """
     result = []
     messages = []
@@ -279,10 +409,15 @@ def asset_ref_role(name, rawtext, text, lineno, inliner, options={}, content=[])
             if data:
                 asset, part = data
                 if asset.mimetype.startswith('image/'):
+                    max_size = getattr(settings, 'wte_inline_images_max_size', 0)
+                    if asset.data and len(asset.data) <= max_size:
+                        uri = 'data:%s;base64,%s' % (asset.mimetype, b64encode(asset.data).decode('ascii'))
+                    else:
+                        uri = request.route_url('asset.view',
+                                                pid=part.id,
+                                                filename=asset.filename)
                     result.append(nodes.image(rawtext,
-                                              uri=request.route_url('asset.view',
-                                                                    pid=part.id,
-                                                                    filename=asset.filename),
+                                              uri=uri,
                                               alt=title if title else asset.filename))
                 else:
                     result.append(nodes.reference(rawtext,
@@ -323,6 +458,24 @@ def inline_css_role(name, rawtext, text, lineno, inliner, options={}, content=[]
     return result, messages
 
 
+def quiz_metadata(document):
+    """Returns the list of quiz metadata recorded on the ``document`` by the
+    :class:`~wte.text_formatter.docutils_ext.Quiz` and
+    :class:`~wte.text_formatter.docutils_ext.QuizQuestion` directives. Each quiz
+    is represented by a ``dict`` with the keys "name", "title", and "questions".
+    The "questions" are a ``list`` of ``dict`` with the key "name" and optionally
+    the key "title".
+
+    :param document: The document to get the quiz metadata for
+    :type document: :class:`~docutils.nodes.document`
+    :return: The quiz metadata
+    :rtype: ``list``
+    """
+    if not hasattr(document, 'wte_quizzes'):
+        document.wte_quizzes = []
+    return document.wte_quizzes
+
+
 class Quiz(Directive):
     """The :class:`~wte.text_formatter.docutils_ext.Quiz` is a directive to generate
     the outer wrapper for an in-part quiz. It takes a single required parameter that
@@ -347,9 +500,19 @@ class Quiz(Directive):
     has_content = True
 
     def run(self):
-        node = nodes.Element()
-        node.document = self.state.document
-        self.state.nested_parse(self.content, self.content_offset, node)
+        document = self.state.document
+        metadata = {'name': self.arguments[0],
+                    'title': self.options['title'].strip() if 'title' in self.options else None,
+                    'questions': []}
+        quiz_metadata(document).append(metadata)
+        parent_quiz = getattr(document, 'wte_current_quiz', None)
+        document.wte_current_quiz = metadata
+        try:
+            node = nodes.Element()
+            node.document = document
+            self.state.nested_parse(self.content, self.content_offset, node)
+        finally:
+            document.wte_current_quiz = parent_quiz
         quiz = HtmlElementBlock('', html_element='form', html_attributes={'class': 'quiz',
                                                                           'action': '',
                                                                           'data-quiz-id': self.arguments[0]})
@@ -400,6 +563,12 @@ class QuizQuestion(Directive):
     has_content = True
 
     def run(self):
+        current_quiz = getattr(self.state.document, 'wte_current_quiz', None)
+        if current_quiz is not None:
+            question_metadata = {'name': self.arguments[0]}
+            if 'question' in self.options:
+                question_metadata['title'] = self.options['question'].strip()
+            current_quiz['questions'].append(question_metadata)
         question = HtmlElementBlock('',
                                     html_element='section',
                                     html_attributes={'class': 'question',
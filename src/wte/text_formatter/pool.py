@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+##############################
+:mod:`wte.text_formatter.pool`
+##############################
+
+This module contains the :class:`~wte.text_formatter.pool.CompilerPool`,
+which compiles ReST in a bounded pool of worker processes, so that
+pathological ReST cannot block the web workers. Each compilation job is
+limited in the CPU time and memory it may use and the number of jobs that
+may wait for a worker is capped.
+
+The pool is configured using the following settings:
+
+* ``compiler.workers`` -- The number of worker processes. Set to 0 to compile
+  in the web worker (default: 2)
+* ``compiler.queue_size`` -- The number of jobs that may wait for a worker
+  (default: 8)
+* ``compiler.cpu_limit`` -- The CPU time in seconds a single job may use
+  (default: 10)
+* ``compiler.memory_limit`` -- The memory in MB a worker process may use
+  (default: 512)
+* ``compiler.timeout`` -- The time in seconds a job may take from when a
+  worker process starts it. The worker processes running a job that takes
+  longer are stopped and replaced (default: 20)
+
+The CPU time limit of a job is enforced with a soft ``RLIMIT_CPU`` limit. As a
+backstop, each worker process also has a hard limit of
+:data:`~wte.text_formatter.pool.WORKER_CPU_JOBS` times the job limit. If a
+worker process is stopped, then the jobs it had been given are run once more
+in new worker processes.
+"""
+import signal
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count
+from multiprocessing import get_context
+from pyramid.config import Configurator
+from pyramid.request import Request
+from pywebtools.sqlalchemy import DBSession
+from queue import Empty
+from sqlalchemy import engine_from_config
+from threading import Lock
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+POOL = None
+"""The :class:`~wte.text_formatter.pool.CompilerPool` used by
+:func:`~wte.text_formatter.compile_rst`, if it is enabled."""
+REGISTRY = None
+"""The Pyramid registry used to generate URLs in the worker processes."""
+STARTED = None
+"""The queue that the worker processes report the start of each job to."""
+WORKER_CPU_JOBS = 100
+"""The hard CPU time limit of a worker process as a multiple of the CPU time
+limit of a single job."""
+POLL_INTERVAL = 0.1
+"""The time in seconds between checks whether a waiting job has started."""
+
+
+class CompilationError(Exception):
+    """The :class:`~wte.text_formatter.pool.CompilationError` is raised if a
+    compilation job fails. The ``message`` contains the error message as
+    generated by docutils or a description of the limit that was exceeded.
+    """
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class CPUTimeExceeded(Exception):
+    """Raised in the worker process when the CPU time limit is reached."""
+    pass
+
+
+def cpu_time_exceeded(signum, frame):
+    """Signal handler that raises a :class:`~wte.text_formatter.pool.CPUTimeExceeded`
+    when the worker process receives a ``SIGXCPU``.
+    """
+    raise CPUTimeExceeded()
+
+
+def init(settings):
+    """Initialises the :data:`~wte.text_formatter.pool.POOL` from the ``settings``.
+    The worker processes are only started when the first job is submitted.
+    """
+    global POOL
+    if POOL is not None:
+        POOL.shutdown()
+        POOL = None
+    workers = int(settings.get('compiler.workers', 2))
+    if workers > 0:
+        POOL = CompilerPool(settings,
+                            workers=workers,
+                            queue_size=int(settings.get('compiler.queue_size', 8)),
+                            cpu_limit=int(settings.get('compiler.cpu_limit', 10)),
+                            memory_limit=int(settings.get('compiler.memory_limit', 512)),
+                            timeout=float(settings.get('compiler.timeout', 20)))
+
+
+def init_worker(settings, memory_limit, cpu_limit, started):
+    """Initialises a worker process. Sets up the database connection, a Pyramid
+    registry with all routes (for generating URLs), the docutils extensions,
+    the resource limits, and the ``started`` queue used to report the start
+    of each job.
+    """
+    global REGISTRY, STARTED
+    from wte import text_formatter, views
+    STARTED = started
+    settings = dict(settings)
+    settings['compiler.workers'] = '0'
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    config = Configurator(settings=settings)
+    views.init(config, settings)
+    config.commit()
+    REGISTRY = config.registry
+    text_formatter.init(settings)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, cpu_time_exceeded)
+        if cpu_limit > 0:
+            limit = cpu_limit * WORKER_CPU_JOBS
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, limit))
+        if memory_limit > 0:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit * 1024 * 1024, hard))
+
+
+def run_job(job_id, text, application_url, part_id, line_numbers, cpu_limit):
+    """Runs a single compilation job in a worker process. Any error is
+    re-raised as a :class:`~wte.text_formatter.pool.CompilationError`, so
+    that it can be passed back to the web worker.
+    """
+    from wte.models import Part
+    from wte.text_formatter import compile_rst
+    if STARTED is not None:
+        STARTED.put((job_id, time.time()))
+    if resource is not None and cpu_limit > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (min(int(usage.ru_utime + usage.ru_stime) + cpu_limit + 1, hard),
+                                                 hard))
+    try:
+        request = Request.blank('/', base_url=application_url)
+        request.registry = REGISTRY
+        part = DBSession().query(Part).filter(Part.id == part_id).first() if part_id is not None else None
+        return compile_rst(text, request, part=part, line_numbers=line_numbers)
+    except CPUTimeExceeded:
+        raise CompilationError('Compilation aborted: The text took more than %i seconds to compile' % cpu_limit)
+    except MemoryError:
+        raise CompilationError('Compilation aborted: The text used too much memory to compile')
+    except Exception as e:
+        raise CompilationError(str(e))
+    finally:
+        if resource is not None and cpu_limit > 0:
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        DBSession.remove()
+
+
+class CompilerPool(object):
+    """The :class:`~wte.text_formatter.pool.CompilerPool` dispatches compilation
+    jobs to a pool of worker processes.
+
+    :param settings: The application settings, used to initialise the workers
+    :type settings: ``dict``
+    :param workers: The number of worker processes
+    :type workers: ``int``
+    :param queue_size: The maximum number of jobs waiting for a worker
+    :type queue_size: ``int``
+    :param cpu_limit: The maximum CPU time in seconds per job
+    :type cpu_limit: ``int``
+    :param memory_limit: The maximum memory in MB per worker process
+    :type memory_limit: ``int``
+    :param timeout: The maximum time in seconds a job may take from when a
+                    worker process starts it
+    :type timeout: ``float``
+    """
+
+    def __init__(self, settings, workers=2, queue_size=8, cpu_limit=10, memory_limit=512, timeout=20):
+        self.settings = dict(settings)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self._executor = None
+        self._pending = {}
+        self._started = {}
+        self._ids = count()
+        self._lock = Lock()
+
+    def _get_executor(self):
+        """Returns the ``ProcessPoolExecutor``, starting it if necessary."""
+        with self._lock:
+            if self._executor is None:
+                context = get_context('spawn')
+                started = context.Queue()
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=context,
+                                                     initializer=init_worker,
+                                                     initargs=(self.settings, self.memory_limit, self.cpu_limit,
+                                                               started))
+                self._executor.started = started
+            return self._executor
+
+    def _reset(self, executor):
+        """Discards the ``executor`` after a worker process died, so that a new
+        one is started for the next job."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _terminate(self, executor):
+        """Stops the worker processes of the ``executor`` and discards it. The
+        ``executor`` then shuts itself down and fails all jobs it had been given
+        with a ``BrokenProcessPool`` error."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.kill()
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending.pop(future.job_id, None)
+            self._started.pop(future.job_id, None)
+
+    def _start_time(self, future):
+        """Returns the time at which a worker process started the job of the
+        ``future`` or ``None`` if it has not been started yet."""
+        with self._lock:
+            while True:
+                try:
+                    job_id, started = future.executor.started.get_nowait()
+                except (Empty, OSError, ValueError):
+                    break
+                if job_id in self._pending:
+                    self._started[job_id] = started
+            return self._started.get(future.job_id)
+
+    def submit(self, text, request, part=None, line_numbers=False, limit_queue=True):
+        """Submits a compilation job. Raises a :class:`~wte.text_formatter.pool.CompilationError`
+        if ``limit_queue`` is ``True`` and too many jobs are already waiting.
+
+        :return: The future for the (`unicode`, ``list``) result
+        :return_type: :class:`~concurrent.futures.Future`
+        """
+        return self._dispatch((text, request.application_url, part.id if part is not None else None, line_numbers),
+                              limit_queue=limit_queue)
+
+    def _dispatch(self, args, limit_queue=True, attempt=1):
+        """Submits the job with the :func:`~wte.text_formatter.pool.run_job`
+        ``args`` to the worker processes."""
+        with self._lock:
+            if limit_queue and len(self._pending) >= self.workers + self.queue_size:
+                raise CompilationError('Compilation aborted: The server is busy, please try again later')
+            job_id = next(self._ids)
+            self._pending[job_id] = args
+        executor = self._get_executor()
+        try:
+            future = executor.submit(run_job, job_id, *(args + (self.cpu_limit,)))
+        except BrokenProcessPool:
+            with self._lock:
+                self._pending.pop(job_id, None)
+            self._reset(executor)
+            raise CompilationError('Compilation aborted: The compiler stopped unexpectedly')
+        future.job_id = job_id
+        future.args = args
+        future.attempt = attempt
+        future.executor = executor
+        future.add_done_callback(self._job_done)
+        return future
+
+    def result(self, future):
+        """Waits for the ``future`` returned by :meth:`~wte.text_formatter.pool.CompilerPool.submit`
+        and returns its result. Raises a :class:`~wte.text_formatter.pool.CompilationError`
+        if the job failed or took longer than the ``timeout`` from when a worker
+        process started it. In the latter case, the worker processes are stopped
+        and replaced. A job whose worker process was stopped is run once more.
+        """
+        while True:
+            started = self._start_time(future)
+            if started is None:
+                wait = POLL_INTERVAL
+            else:
+                wait = max(started + self.timeout - time.time(), 0)
+            try:
+                return future.result(timeout=wait)
+            except TimeoutError:
+                if started is not None and time.time() - started >= self.timeout:
+                    self._job_done(future)
+                    self._terminate(future.executor)
+                    raise CompilationError('Compilation aborted: The text took more than %i seconds to compile' %
+                                           self.timeout)
+            except BrokenProcessPool:
+                self._reset(future.executor)
+                if future.attempt > 1:
+                    raise CompilationError('Compilation aborted: The compiler stopped unexpectedly')
+                future = self._dispatch(future.args, limit_queue=False, attempt=future.attempt + 1)
+
+    def compile(self, text, request, part=None, line_numbers=False):
+        """Compiles the ``text`` in a worker process. Parameters and return
+        value are the same as for :func:`~wte.text_formatter.compile_rst`.
+        """
+        return self.result(self.submit(text, request, part=part, line_numbers=line_numbers))
+
+    def compile_parts(self, parts, request):
+        """Compiles the ``content`` of all ``parts``, using all worker processes
+        in parallel, without being limited by the queue size. Yields
+        (:class:`~wte.models.Part`, result) pairs in the order of ``parts``. The
+        result is either the (`unicode`, ``list``) tuple returned by
+        :func:`~wte.text_formatter.compile_rst` or the
+        :class:`~wte.text_formatter.pool.CompilationError` if compilation failed.
+        """
+        window = []
+        for part in parts:
+            window.append((part, self.submit(part.content, request, part=part, limit_queue=False)))
+            if len(window) >= self.workers:
+                yield self._window_result(window.pop(0))
+        while window:
+            yield self._window_result(window.pop(0))
+
+    def _window_result(self, job):
+        part, future = job
+        try:
+            return part, self.result(future)
+        except CompilationError as e:
+            return part, e
+
+    def shutdown(self):
+        """Stops all worker processes."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
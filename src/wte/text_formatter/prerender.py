@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+###################################
+:mod:`wte.text_formatter.prerender`
+###################################
+
+This module contains the save-time rendering stage that is applied to the
+HTML generated by :func:`~wte.text_formatter.compile_rst`. It pre-renders
+TeX formulas written using the MathJax delimiters ``\\(...\\)``, ``\\[...\\]``,
+and ``$$...$$`` into static MathML, so that the formulas do not need to be
+typeset in the browser every time a page is viewed.
+"""
+import re
+
+from html import unescape
+from inspect import signature
+
+try:
+    from docutils.utils.math.latex2mathml import tex2mathml as docutils_tex2mathml
+except ImportError:  # pragma: no cover
+    from docutils.utils.math.latex2mathml import parse_latex_math
+
+    def tex2mathml(tex, inline=True):
+        """Fallback for older docutils versions that do not provide ``tex2mathml``."""
+        return ''.join(parse_latex_math(tex, inline=inline).xml())
+else:
+    if 'as_block' in signature(docutils_tex2mathml).parameters:
+        def tex2mathml(tex, inline=True):
+            """Adapts the ``tex2mathml`` of docutils 0.21 and newer, which
+            takes an ``as_block`` parameter instead of ``inline``."""
+            return docutils_tex2mathml(tex, as_block=not inline)
+    else:
+        tex2mathml = docutils_tex2mathml
+try:
+    from docutils.utils.math import MathError
+except ImportError:
+    MathError = SyntaxError
+
+TEX_ERRORS = (SyntaxError, MathError)
+"""The errors raised by docutils for TeX formulas that cannot be parsed.
+Older docutils versions raise a ``SyntaxError`` and newer ones a
+``MathError``."""
+
+TAG_PATTERN = re.compile(r'(<[^>]*>)')
+TEX_PATTERN = re.compile(r'\\\((.+?)\\\)|\\\[(.+?)\\\]|\$\$(.+?)\$\$', re.DOTALL)
+SKIP_TAGS = ('pre', 'code', 'textarea', 'script', 'style', 'math')
+"""Elements whose content is never pre-rendered."""
+
+
+def split_text(html):
+    """Splits the ``html`` into tag and text segments. Yields
+    (``segment``, ``is_text``) pairs, where ``is_text`` is only ``True`` for
+    text segments that are not inside one of the :data:`~wte.text_formatter.prerender.SKIP_TAGS`.
+
+    :param html: The HTML to split
+    :type html: `unicode`
+    """
+    skip_depth = 0
+    for segment in TAG_PATTERN.split(html):
+        if segment.startswith('<'):
+            match = re.match(r'<(/?)([a-zA-Z0-9]+)', segment)
+            if match and match.group(2).lower() in SKIP_TAGS and not segment.endswith('/>'):
+                if match.group(1):
+                    skip_depth = max(skip_depth - 1, 0)
+                else:
+                    skip_depth = skip_depth + 1
+            yield segment, False
+        elif segment:
+            yield segment, skip_depth == 0
+
+
+def render_tex(match):
+    """Renders a single TeX formula matched by the :data:`~wte.text_formatter.prerender.TEX_PATTERN`
+    into MathML. If the formula cannot be rendered, then the original text is returned,
+    so that it can still be typeset in the browser.
+
+    :param match: The regular expression match
+    :type match: :class:`~re.MatchObject`
+    :return: The MathML or the original text
+    :rtype: `unicode`
+    """
+    inline = match.group(1) is not None
+    tex = unescape(match.group(1) if inline else match.group(2) or match.group(3))
+    try:
+        mathml = tex2mathml(tex.strip(), inline=inline)
+    except TEX_ERRORS:
+        return match.group(0)
+    if inline:
+        return '<span class="math">%s</span>' % mathml
+    else:
+        return '<span class="math display">%s</span>' % mathml
+
+
+def render_math(html):
+    """Pre-renders all TeX formulas in the ``html`` into MathML.
+
+    :param html: The HTML to pre-render
+    :type html: `unicode`
+    :return: The pre-rendered HTML
+    :rtype: `unicode`
+    """
+    if '\\(' not in html and '\\[' not in html and '$$' not in html:
+        return html
+    result = []
+    for segment, is_text in split_text(html):
+        if is_text:
+            segment = TEX_PATTERN.sub(render_tex, segment)
+        result.append(segment)
+    return ''.join(result)
+
+
+def requires_typesetting(html):
+    """Checks whether the ``html`` contains any TeX formulas that have not been
+    pre-rendered and thus need to be typeset in the browser.
+
+    :param html: The HTML to check
+    :type html: `unicode`
+    :return: Whether the browser needs to typeset formulas
+    :rtype: ``boolean``
+    """
+    if not html or ('\\(' not in html and '\\[' not in html and '$$' not in html):
+        return False
+    for segment, is_text in split_text(html):
+        if is_text and TEX_PATTERN.search(segment):
+            return True
+    return False
+
+
+def prerender(html):
+    """Applies all save-time rendering steps to the ``html`` generated by
+    :func:`~wte.text_formatter.compile_rst`.
+
+    :param html: The HTML to pre-render
+    :type html: `unicode`
+    :return: The pre-rendered HTML
+    :rtype: `unicode`
+    """
+    return render_math(html)
@@ -104,3 +104,16 @@ def ordered_counted_set(items):
             categories.append(item)
             counts.append(1)
     return list(zip(categories, counts))
+
+
+def template_packages(settings):
+    """Returns the resource specifications of all directories that contain
+    HTML templates. These are always "wte:templates" and any additional
+    resource specifications configured in the "kajiki.packages" setting.
+
+    :param settings: The application settings
+    :type settings: ``dict``
+    :return: The resource specifications of all template directories
+    :r_type: :func:`list`
+    """
+    return ['wte:templates'] + settings.get('kajiki.packages', 'pywebtools:kajiki').split()
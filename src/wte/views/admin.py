@@ -21,7 +21,9 @@ from pywebtools.pyramid.util import paginate
 from pywebtools.sqlalchemy import DBSession
 
 from wte.models import (Part)
-from wte.text_formatter import compile_rst
+from wte.text_formatter import compile_parts
+from wte.text_formatter.prerender import requires_typesetting
+from wte.views.quiz import sync_quizzes
 
 
 def init(config):
@@ -111,16 +113,26 @@ def content_list(request):
 @current_user()
 @require_logged_in()
 def content_regenerate(request):
-    """Handles the ``/admin/content/regenerate`` URL, regenerating the
+    r"""Handles the ``/admin/content/regenerate`` URL, regenerating the
     ``compiled_content`` attribute for all :class:`~wte.models.Part`\ s.
+    :class:`~wte.models.Part`\ s that fail to compile keep their existing
+    ``compiled_content``.
     """
     if request.current_user.has_permission('admin.modules.edit'):
         if request.method == 'POST':
             dbsession = DBSession()
+            failed = []
             with transaction.manager:
-                for part in dbsession.query(Part):
-                    if part.content:
-                        part.compiled_content = compile_rst(part.content, request, part)
+                parts = [part for part in dbsession.query(Part) if part.content]
+                for part, result in compile_parts(parts, request):
+                    if isinstance(result, Exception):
+                        failed.append(part.title)
+                    else:
+                        part.compiled_content, quizzes = result
+                        part.requires_typesetting = requires_typesetting(part.compiled_content)
+                        sync_quizzes(dbsession, part, quizzes)
+            if failed:
+                request.session.flash('Regeneration failed for: %s' % ', '.join(failed), queue='error')
             request.session.flash('Regeneration complete', queue='info')
         raise HTTPSeeOther(request.route_url('admin.content'))
     else:
@@ -26,7 +26,7 @@ from pywebtools.sqlalchemy import DBSession
 from sqlalchemy import and_
 
 from wte.models import (Part, Asset)
-from wte.views.part import (create_part_crumbs, get_user_part_progress)
+from wte.views.part import (create_part_crumbs, get_user_part_progress, recompile_image_users)
 
 
 def init(config):
@@ -117,15 +117,19 @@ def new(request):
                             new_order = [a.order for a in progress.files] if progress else []
                         new_order.append(0)
                         new_order = max(new_order) + 1
+                        data = params['data'].file.read() if params['data'] is not None else None
                         new_asset = Asset(filename=params['filename'],
                                           mimetype=mimetype[0] if mimetype[0] else 'application/binary',
                                           type=request.matchdict['new_type'],
                                           order=new_order,
-                                          data=params['data'].file.read() if params['data'] is not None else None,
-                                          etag=hashlib.sha512(params['data'].file.read()).hexdigest()
-                                          if params['data'] is not None else None)
+                                          data=data,
+                                          etag=hashlib.sha512(data).hexdigest() if data is not None else None)
                         dbsession.add(new_asset)
                         part.all_assets.append(new_asset)
+                    dbsession.add(part)
+                    dbsession.add(new_asset)
+                    if new_asset.mimetype.startswith('image/'):
+                        recompile_image_users(request, part.id, [new_asset.filename])
                     if request.is_xhr:
                         request.override_renderer = 'json'
                         dbsession.add(new_asset)
@@ -191,6 +195,9 @@ def edit(request):
                 try:
                     params = EditAssetSchema().to_python(request.params, State(request=request))
                     dbsession = DBSession()
+                    images = []
+                    if asset.mimetype.startswith('image/'):
+                        images.append(asset.filename)
                     with transaction.manager:
                         dbsession.add(asset)
                         asset.filename = params['filename']
@@ -220,6 +227,10 @@ def edit(request):
                         asset.mimetype = mimetype
                     dbsession.add(part)
                     dbsession.add(asset)
+                    if asset.mimetype.startswith('image/'):
+                        images.append(asset.filename)
+                    if images:
+                        recompile_image_users(request, part.id, images)
                     raise HTTPSeeOther(request.route_url('part.view', pid=part.id))
                 except formencode.Invalid as e:
                     return {'errors': e.error_dict,
@@ -262,11 +273,16 @@ def delete(request):
                 try:
                     CSRFSchema().to_python(request.params, State(request=request))
                     dbsession = DBSession()
+                    images = []
+                    if asset.mimetype.startswith('image/'):
+                        images.append(asset.filename)
                     with transaction.manager:
                         dbsession.add(asset)
                         asset.parts = []
                         dbsession.delete(asset)
                     dbsession.add(part)
+                    if images:
+                        recompile_image_users(request, part.id, images)
                     raise HTTPSeeOther(request.route_url('part.view', pid=part.id))
                 except formencode.Invalid as e:
                     return {'errors': e.error_dict,
@@ -11,34 +11,44 @@ Routes are defined in :func:`~wte.views.part.init`.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from nine import (IS_PYTHON2, str, native_str, nimport)  # Python 2.7 compatibility
+from nine import (str, native_str)  # Python 2.7 compatibility
 
+import base64
+import binascii
 import formencode
+import hashlib
 import math
 import json
+import os
 import re
 import transaction
 
 from pyramid.httpexceptions import (HTTPSeeOther, HTTPNotFound, HTTPForbidden)
 from pyramid.response import Response
 from pyramid.renderers import render_to_response
+from pyramid.request import Request
 from pyramid.view import view_config
 from pywebtools.formencode import State, CSRFSchema
 from pywebtools.pyramid.auth.decorators import unauthorised_redirect, require_logged_in
 from pywebtools.pyramid.auth.views import current_user
 from pywebtools.pyramid.decorators import require_method
 from pywebtools.sqlalchemy import DBSession
-from pkg_resources import resource_string
-from sqlalchemy import and_, distinct
-from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED, BadZipfile
-
+from sqlalchemy import and_, case, distinct, func, null, select
+from sqlalchemy.orm.attributes import set_committed_value
+from threading import Lock, Thread
+from webob.static import FileIter
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipfile
+from zope.sqlalchemy import mark_changed
+
+from wte import jobs
+from wte.archive import (BATCH_SIZE, CHUNK_SIZE, BlobReader, archive_version, asset_entries, asset_etags,
+                         asset_metadata, compress_type, directory_info, load_json, static_entry, zip_stream)
 from wte.models import (Part, UserPartRole, Asset, UserPartProgress, User,
-                        Quiz, QuizAnswer)
-from wte.text_formatter import compile_rst
-from wte.util import (ordered_counted_set, send_email, get_config_setting)
-from wte.views.quiz import extract_quizzes
-
-BytesIO = nimport('io:BytesIO')
+                        Quiz, QuizAnswer, parts_assets, progress_assets)
+from wte.text_formatter import compile_parts, compile_rst
+from wte.text_formatter.prerender import requires_typesetting
+from wte.util import (ordered_counted_set, send_email, get_config_setting, version)
+from wte.views.quiz import sync_quizzes
 
 
 def init(config):
@@ -72,12 +82,18 @@ def init(config):
       -- :func:`~wte.views.part.change_status`
     * ``part.export`` -- ``/parts/{pid}/export``
       -- :func:`~wte.views.part.export`
+    * ``part.update`` -- ``/parts/{pid}/update``
+      -- :func:`~wte.views.part.update_from_file`
     * ``part.download`` -- ``/parts/{pid}/download``
       -- :func:`~wte.views.part.download`
+    * ``part.archive`` -- ``/parts/{pid}/archive/{kind}``
+      -- :func:`~wte.views.part.archive`
     * ``part.reset-files`` -- ``/parts/{pid}/reset_files`` --
       :func:`~wte.views.part.reset_files`
     * ``part.progress.download`` -- ``/parts/{pid}/progress/download``
       -- :func:`~wte.views.part.download_part_progress`
+    * ``part.progress.download_all`` -- ``/parts/{pid}/progress/download_all``
+      -- :func:`~wte.views.part.download_all_progress`
     * ``part.progress.update`` -- ``/parts/{pid}/progress/update``
       -- :func:`~wte.views.part.update_part_progress`
     """
@@ -94,9 +110,12 @@ def init(config):
     config.add_route('part.deregister', '/parts/{pid}/deregister')
     config.add_route('part.change_status', '/parts/{pid}/change_status')
     config.add_route('part.export', '/parts/{pid}/export')
+    config.add_route('part.update', '/parts/{pid}/update')
     config.add_route('part.download', '/parts/{pid}/download')
+    config.add_route('part.archive', '/parts/{pid}/archive/{kind}')
     config.add_route('part.reset-files', '/parts/{pid}/reset_files')
     config.add_route('part.progress.download', '/parts/{pid}/progress/download')
+    config.add_route('part.progress.download_all', '/parts/{pid}/progress/download_all')
     config.add_route('part.progress.update', '/parts/{pid}/progress/update')
 
 
@@ -578,10 +597,11 @@ def edit(request):
                         part.display_mode = params['display_mode']
                         part.content = params['content']
                         try:
-                            part.compiled_content = compile_rst(params['content'],
-                                                                request,
-                                                                part=part)
-                            extract_quizzes(dbsession, part)
+                            part.compiled_content, quizzes = compile_rst(params['content'],
+                                                                         request,
+                                                                         part=part,
+                                                                         isolated=True)
+                            part.requires_typesetting = requires_typesetting(part.compiled_content)
                         except Exception as e:
                             msg = e.message.replace('<string>:', 'Invalid ReST: Line ').replace('(SEVERE/4) ', '')
                             msg = msg[:msg.find('\n')]
@@ -589,6 +609,7 @@ def edit(request):
                                                      params['content'],
                                                      None,
                                                      error_dict={'content': msg})
+                        sync_quizzes(dbsession, part, quizzes)
                         part.label = params['label']
                         if params['child_part_id']:
                             for idx, cpid in enumerate(params['child_part_id']):
@@ -773,7 +794,8 @@ def preview(request):
         if part.allow('edit', request.current_user):
             if 'content' in request.params:
                 try:
-                    content = compile_rst(request.params['content'], request, part=part, line_numbers=True)
+                    content, _ = compile_rst(request.params['content'], request, part=part, line_numbers=True,
+                                             isolated=True)
                 except Exception as e:
                     content = ['<div class="callout alert"><p>']
                     for line in e.message.split('\n'):
@@ -973,6 +995,17 @@ def change_status(request):
 
 
 CROSSREF_PATTERN = re.compile(r':crossref:`(?:([0-9]+)|(?:(.*)<([0-9]+)>))`')
+EXPORT_FORMAT = 2
+"""The version of the format of the archives created by :func:`~wte.views.part.export`.
+Archives without a manifest use the format 1, in which each asset's data is stored as
+``assets/<id>``."""
+DIRECTORY_ENTRY_SIZE = 1024
+"""The maximum average size in bytes of an entry in the central directory of an imported
+archive."""
+RATIO_CHECK_SIZE = 1024 * 1024
+"""The uncompressed size in bytes above which the compression ratio of an imported
+archive's entries is checked. Smaller entries cannot use much memory, whatever their
+compression ratio."""
 
 
 def crossref_replace(match, id_mapping):
@@ -1004,21 +1037,31 @@ def crossref_replace(match, id_mapping):
             return ':crossref:`external`'
 
 
-@view_config(route_name='part.export')
-@current_user()
-@require_logged_in()
-def export(request):
-    """Handles the ``/parts/{pid}/export`` URL, providing the UI and backend
-    for exporting a :class:`~wte.models.Part`.
+def export_entries(request, part):
+    """Returns the entries of the archive that exports the ``part``, in the
+    form expected by :func:`~wte.archive.zip_stream`. The ``part`` and its
+    children are converted immediately, while the data of the
+    :class:`~wte.models.Asset` is only fetched while the entries are
+    consumed.
 
-    The difference between exporting and downloading
-    (:func:`~wte.views.part.download`) is that exporting creates an archive
-    that can be imported into another WTE instance, while downloading creates
-    an HTML version for offline viewing.
+    The archive uses the export format :data:`~wte.views.part.EXPORT_FORMAT`
+    and contains the following entries:
 
-    Requires that the user has "edit" rights on the :class:`~wte.models.Part`.
+    * ``content.json`` -- The ``part`` and its children. Each asset refers to
+      its data by its etag
+    * ``manifest.json`` -- The format and the etag, size, and mimetype of
+      each payload
+    * ``payloads/<etag>`` -- The data of the assets. Assets with the same
+      data share a single payload
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param part: The part to export
+    :type part: :class:`~wte.models.Part`
+    :return: The archive entries
+    :rtype: generator of ``tuple``
     """
-    def part_as_dict(part, assets, id_mapping):
+    def part_as_dict(part, payloads, id_mapping, metadata, etags):
         data = {'id': len(id_mapping),
                 'type': part.type,
                 'display_mode': part.display_mode,
@@ -1029,18 +1072,32 @@ def export(request):
                 'content': part.content}
         id_mapping[str(part.id)] = data['id']
         if part.children:
-            data['children'] = [part_as_dict(child, assets, id_mapping) for child in part.children]
-        if part.all_assets:
+            data['children'] = [part_as_dict(child, payloads, id_mapping, metadata, etags)
+                                for child in part.children]
+        if metadata[part.id]:
             data['assets'] = []
-            for asset in part.all_assets:
-                data['assets'].append({'id': len(assets),
+            for asset in metadata[part.id]:
+                etag = asset.etag or etags[asset.id]
+                data['assets'].append({'etag': etag,
                                        'filename': asset.filename,
                                        'mimetype': asset.mimetype,
                                        'type': asset.type,
                                        'order': asset.order})
-                assets.append((len(assets), asset.id))
+                if etag not in payloads:
+                    payloads[etag] = asset
         return data
 
+    def entries(data, payloads):
+        yield 'content.json', json.dumps(data), ZIP_DEFLATED
+        manifest = {'format': EXPORT_FORMAT,
+                    'payloads': dict([(etag, {'size': asset.size or 0,
+                                              'mimetype': asset.mimetype})
+                                      for etag, asset in payloads.items()])}
+        yield 'manifest.json', json.dumps(manifest), ZIP_DEFLATED
+        for entry in asset_entries(dict([(asset.id, (asset.mimetype, etag, asset.size, ['payloads/%s' % (etag)]))
+                                         for etag, asset in payloads.items()])):
+            yield entry
+
     def fix_references(data, id_mapping):
         if 'content' in data and data['content']:
             data['content'] = re.sub(CROSSREF_PATTERN, lambda m: crossref_replace(m, id_mapping), data['content'])
@@ -1048,6 +1105,30 @@ def export(request):
             data['children'] = [fix_references(child, id_mapping) for child in data['children']]
         return data
 
+    dbsession = DBSession()
+    payloads = {}
+    id_mapping = {}
+    metadata = asset_metadata(dbsession, load_part_tree(dbsession, part))
+    etags = asset_etags([asset.id for assets in metadata.values() for asset in assets if not asset.etag])
+    data = part_as_dict(part, payloads, id_mapping, metadata, etags)
+    data = fix_references(data, id_mapping)
+    return entries(data, payloads)
+
+
+@view_config(route_name='part.export')
+@current_user()
+@require_logged_in()
+def export(request):
+    """Handles the ``/parts/{pid}/export`` URL, providing the UI and backend
+    for exporting a :class:`~wte.models.Part`.
+
+    The difference between exporting and downloading
+    (:func:`~wte.views.part.download`) is that exporting creates an archive
+    that can be imported into another WTE instance, while downloading creates
+    an HTML version for offline viewing.
+
+    Requires that the user has "edit" rights on the :class:`~wte.models.Part`.
+    """
     dbsession = DBSession()
     part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
     if part:
@@ -1057,29 +1138,7 @@ def export(request):
                                         {'title': 'Export',
                                          'url': request.current_route_url()})
             if request.method == 'POST':
-                body = BytesIO()
-                body_zip = ZipFile(body, 'w')
-                assets = []
-                id_mapping = {}
-                data = part_as_dict(part, assets, id_mapping)
-                data = fix_references(data, id_mapping)
-                body_zip.writestr('content.json', json.dumps(data), ZIP_DEFLATED)
-                for export_id, asset_id in assets:
-                    asset = dbsession.query(Asset).filter(Asset.id == asset_id).first()
-                    if asset:
-                        if asset.data:
-                            if asset.mimetype.startswith('text'):
-                                body_zip.writestr('assets/%s' % (export_id), asset.data, ZIP_DEFLATED)
-                            else:
-                                body_zip.writestr('assets/%s' % (export_id), asset.data, ZIP_STORED)
-                        else:
-                            body_zip.writestr('assets/%s' % (export_id), '', ZIP_DEFLATED)
-                body_zip.close()
-                return Response(body=body.getvalue(),
-                                headers=[('Content-Type', 'application/zip'),
-                                         ('Content-Disposition',
-                                          native_str('attachment; filename="%s.zip"' %
-                                                     (part.title.replace('/', '_'))))])
+                return archive_response(request, part, 'export')
 
             return render_to_response('wte:templates/part/export.kajiki',
                                       {'part': part,
@@ -1107,7 +1166,24 @@ class ImportPartConverter(formencode.FancyValidator):
     def _convert_to_python(self, value, state):
         """Convert the submitted ``value`` into a (``dict``, :class:`~zipfile.ZipFile`)
         ``tuple``. Checks that the uploaded file is a valid ZIP file and contains the
-        "content.json" file.
+        "content.json" file. If the ZIP file contains a "manifest.json" file, then checks
+        that its format is supported and that it contains all the payloads listed in the
+        manifest with the listed sizes.
+
+        To limit the memory and time needed to check the uploaded file, the number of
+        entries and the size of the ZIP file's central directory are checked before the
+        directory is read. Then the total uncompressed size and the compression ratio of
+        the entries are checked, before any entry is read. The "content.json" and
+        "manifest.json" files are only loaded if they are not too large and their data is
+        not nested too deeply. The limits are configured using the following settings:
+
+        * ``import.max_entries`` -- The maximum number of entries (default: 10000)
+        * ``import.max_size`` -- The maximum total uncompressed size in MB (default: 1024)
+        * ``import.max_ratio`` -- The maximum compression ratio of entries larger than
+          1MB (default: 100)
+        * ``import.max_json_size`` -- The maximum size of the JSON files in MB (default: 16)
+        * ``import.max_json_depth`` -- The maximum nesting depth of the JSON files
+          (default: 32)
 
         :param value: The uploaded file
         :type value: `~cgi.FieldStorage`
@@ -1115,24 +1191,76 @@ class ImportPartConverter(formencode.FancyValidator):
         :return: The converted part import data
         :rtype: (``dict``, :class:`~zipfile.ZipFile`) ``tuple``
         """
+        max_entries = get_config_setting(state.request, 'import.max_entries', target_type='int', default=10000)
+        max_json_size = get_config_setting(state.request, 'import.max_json_size', target_type='int',
+                                           default=16) * 1024 * 1024
+        max_json_depth = get_config_setting(state.request, 'import.max_json_depth', target_type='int', default=32)
+        directory = directory_info(value.file)
+        if directory is None:
+            raise formencode.api.Invalid(self.message('notzip', state), value, state)
+        if directory[0] > max_entries or directory[1] > max_entries * DIRECTORY_ENTRY_SIZE:
+            raise formencode.api.Invalid(self.message('invalidstructure', state), value, state)
         try:
             zip_file = ZipFile(value.file)
-            zip_file.getinfo('content.json')
-            with zip_file.open('content.json') as data:
-                data = data.read()
-                if not IS_PYTHON2:
-                    data = data.decode('utf-8')
-            data = json.loads(data)
-            return (data, zip_file)
         except BadZipfile:
             raise formencode.api.Invalid(self.message('notzip', state), value, state)
-        except KeyError:
+        try:
+            self._check_entries(zip_file, state, max_entries)
+            if zip_file.getinfo('content.json').file_size > max_json_size:
+                raise formencode.api.Invalid(self.message('invalidstructure', state), value, state)
+            with zip_file.open('content.json') as data:
+                data = load_json(data, max_json_depth)
+            if 'manifest.json' in zip_file.namelist():
+                self._check_manifest(zip_file, state, max_json_size, max_json_depth)
+            return (data, zip_file)
+        except formencode.api.Invalid as e:
+            zip_file.close()
+            raise formencode.api.Invalid(e.msg, value, state)
+        except (BadZipfile, KeyError):
             zip_file.close()
             raise formencode.api.Invalid(self.message('invalidstructure', state), value, state)
         except ValueError:
             zip_file.close()
             raise formencode.api.Invalid(self.message('nopart', state), value, state)
 
+    def _check_entries(self, zip_file, state, max_entries):
+        """Checks the number of entries in the ``zip_file``, their total uncompressed
+        size, and the compression ratio of the entries that are larger than
+        :data:`~wte.views.part.RATIO_CHECK_SIZE`, using only the ZIP file's central
+        directory.
+        """
+        max_size = get_config_setting(state.request, 'import.max_size', target_type='int', default=1024) * 1024 * 1024
+        max_ratio = get_config_setting(state.request, 'import.max_ratio', target_type='int', default=100)
+        entries = zip_file.infolist()
+        if len(entries) > max_entries:
+            raise formencode.api.Invalid(self.message('invalidstructure', state), None, state)
+        total_size = 0
+        for entry in entries:
+            total_size = total_size + entry.file_size
+            if entry.file_size > RATIO_CHECK_SIZE and entry.file_size > entry.compress_size * max_ratio:
+                raise formencode.api.Invalid(self.message('invalidstructure', state), None, state)
+        if total_size > max_size:
+            raise formencode.api.Invalid(self.message('invalidstructure', state), None, state)
+
+    def _check_manifest(self, zip_file, state, max_json_size, max_json_depth):
+        """Checks that the "manifest.json" in the ``zip_file`` uses a supported export
+        format and that the ``zip_file`` contains each listed payload with the listed size.
+        """
+        manifest = None
+        if zip_file.getinfo('manifest.json').file_size <= max_json_size:
+            try:
+                with zip_file.open('manifest.json') as data:
+                    manifest = load_json(data, max_json_depth)
+            except ValueError:
+                pass
+        if not isinstance(manifest, dict) or manifest.get('format') != EXPORT_FORMAT or \
+                not isinstance(manifest.get('payloads'), dict):
+            raise formencode.api.Invalid(self.message('invalidstructure', state), None, state)
+        for etag, payload in manifest['payloads'].items():
+            if not isinstance(payload, dict) or \
+                    zip_file.getinfo('payloads/%s' % (etag)).file_size != payload.get('size'):
+                raise formencode.api.Invalid(self.message('invalidstructure', state), None, state)
+
     def _validate_python(self, value, state):
         """Checks that the uploaded "content.json" file is actually valid. Checks that the
         JSON data is catually a ``dict`` and that it has the minium fields "title" and "type".
@@ -1193,6 +1321,460 @@ class ImportPartSchema(CSRFSchema):
     """The file to import."""
 
 
+def part_from_data(data, parent_id):
+    """Creates a new :class:`~wte.models.Part` from the ``data`` exported by
+    :func:`~wte.views.part.export`, without its children or
+    :class:`~wte.models.Asset`. Old part types are converted to the current
+    part types.
+
+    :param data: The part data
+    :type data: ``dict``
+    :param parent_id: The id of the parent part or ``None``
+    :type parent_id: ``int``
+    :return: The new part, which is not added to the database session
+    :rtype: :class:`~wte.models.Part`
+    """
+    part_type = data['type']
+    if part_type == 'task':
+        part_type = 'page'
+    elif part_type in ['tutorial', 'exercise']:
+        part_type = 'part'
+    part = Part(parent_id=parent_id,
+                type=part_type,
+                title=data['title'],
+                status='available' if part_type == 'page' else 'unavailable')
+    if 'order' in data:
+        try:
+            part.order = int(data['order'])
+        except ValueError:
+            part.order = 0
+    if 'content' in data:
+        part.content = data['content']
+    if part_type == 'part' and 'display_mode' in data:
+        part.display_mode = data['display_mode']
+    elif part_type == 'part':
+        part.display_mode = 'three_pane_html'
+    if 'label' in data:
+        part.label = data['label']
+    else:
+        if data['type'] in ['tutorial', 'exercise', 'page', 'task']:
+            part.label = data['type'].title()
+    return part
+
+
+def asset_from_data(tmpl, zip_file, errors, etag=None):
+    """Reads the :class:`~wte.models.Asset` described by the exported
+    ``tmpl`` from the ``zip_file``. In archives using the current
+    :data:`~wte.views.part.EXPORT_FORMAT`, the data is read from the payload
+    with the asset's etag and is checked against that etag. If the etag
+    is the same as the given ``etag``, then the data is not read. In archives
+    using the format 1, the data is read from the asset's position.
+
+    :param tmpl: The exported asset data
+    :type tmpl: ``dict``
+    :param zip_file: The archive containing the asset's data
+    :type zip_file: :class:`~zipfile.ZipFile`
+    :param errors: The list to add an error message to, if the asset's data
+                   cannot be read
+    :type errors: ``list``
+    :param etag: The etag computed from the existing asset's data
+    :type etag: `unicode`
+    :return: The column values of the asset or ``None`` if the ``tmpl`` is
+             incomplete or the data cannot be read. The values only contain
+             the ``data`` and ``etag`` if the data was read
+    :rtype: ``dict``
+    """
+    if 'filename' in tmpl and 'mimetype' in tmpl and 'type' in tmpl and ('id' in tmpl or 'etag' in tmpl):
+        values = {'filename': tmpl['filename'],
+                  'mimetype': tmpl['mimetype'],
+                  'type': tmpl['type'],
+                  'order': None}
+        if 'order' in tmpl:
+            try:
+                values['order'] = int(tmpl['order'])
+            except (TypeError, ValueError):
+                values['order'] = 0
+        if etag and tmpl.get('etag') == etag:
+            return values
+        try:
+            if 'etag' in tmpl:
+                data = zip_file.read('payloads/%s' % (tmpl['etag']))
+            else:
+                data = zip_file.read('assets/%i' % (tmpl['id']))
+        except Exception:
+            errors.append('The file "%s" could not be imported' % (tmpl['filename']))
+            return None
+        values['data'] = data
+        values['etag'] = hashlib.sha512(data).hexdigest()
+        if 'etag' in tmpl and values['etag'] != tmpl['etag']:
+            errors.append('The file "%s" could not be imported' % (tmpl['filename']))
+            return None
+        return values
+    return None
+
+
+def insert_parts(dbsession, trees, zip_file, id_mapping, errors):
+    """Inserts the exported parts ``trees``, together with their children and
+    their :class:`~wte.models.Asset`. The parts are inserted in bulk, one
+    level of the trees at a time, and each asset's data is read from the
+    ``zip_file`` and inserted one asset at a time, so that at most one asset
+    is held in memory. The cross-references in the parts' content are not
+    updated.
+
+    :param dbsession: The database session to insert with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param trees: The part data to insert, each with the id of the parent to
+                  insert it into
+    :type trees: ``list`` of (``dict``, ``int``) ``tuple``
+    :param zip_file: The archive containing the assets' data
+    :type zip_file: :class:`~zipfile.ZipFile`
+    :param id_mapping: The mapping from exported to new part ids, which is
+                       updated with the inserted parts
+    :type id_mapping: ``dict``
+    :param errors: The list to add error messages to
+    :type errors: ``list``
+    :return: The inserted root parts and the (id, content) of all inserted
+             parts that have content
+    :rtype: (``list``, ``list``) ``tuple``
+    """
+    links = []
+    contents = []
+    roots = None
+    level = trees
+    while level:
+        parts = [part_from_data(part_data, parent_id) for part_data, parent_id in level]
+        dbsession.bulk_save_objects(parts, return_defaults=True)
+        if roots is None:
+            roots = parts
+        next_level = []
+        for (part_data, _), part in zip(level, parts):
+            if 'id' in part_data:
+                id_mapping[str(part_data['id'])] = part.id
+            if part.content:
+                contents.append((part.id, part.content))
+            for tmpl in part_data.get('assets', []):
+                values = asset_from_data(tmpl, zip_file, errors)
+                if values is not None:
+                    result = dbsession.execute(Asset.__table__.insert().values(**values))
+                    links.append({'part_id': part.id, 'asset_id': result.inserted_primary_key[0]})
+            for child in part_data.get('children', []):
+                next_level.append((child, part.id))
+        level = next_level
+    if links:
+        dbsession.execute(parts_assets.insert(), links)
+    return roots or [], contents
+
+
+def update_crossrefs(dbsession, contents, id_mapping):
+    """Updates the cross-references in the inserted parts' ``contents`` to
+    the new part ids in the ``id_mapping``.
+
+    :param dbsession: The database session to update with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param contents: The (id, content) of the inserted parts
+    :type contents: ``list``
+    :param id_mapping: The mapping from exported to new part ids
+    :type id_mapping: ``dict``
+    """
+    updates = []
+    for part_id, content in contents:
+        new_content = re.sub(CROSSREF_PATTERN, lambda m: crossref_replace(m, id_mapping), content)
+        if new_content != content:
+            updates.append({'id': part_id, 'content': new_content})
+    if updates:
+        dbsession.bulk_update_mappings(Part, updates)
+
+
+def import_part(dbsession, data, zip_file, parent_id, user):
+    """Imports the :class:`~wte.models.Part` ``data`` exported by
+    :func:`~wte.views.part.export`, together with its children and their
+    :class:`~wte.models.Asset` (see :func:`~wte.views.part.insert_parts`).
+    The cross-references in the parts' content are updated to the new part
+    ids. The content is not compiled.
+
+    Assets that cannot be read from the ``zip_file`` are skipped and an
+    error message is returned for each of them.
+
+    :param dbsession: The database session to import with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param data: The part data to import
+    :type data: ``dict``
+    :param zip_file: The archive containing the assets' data
+    :type zip_file: :class:`~zipfile.ZipFile`
+    :param parent_id: The id of the parent to import into or ``None``
+    :type parent_id: ``int``
+    :param user: The user that becomes the owner of an imported module
+    :type user: :class:`~wte.models.User`
+    :return: The id of the imported part and the error messages
+    :rtype: (``int``, ``list``) ``tuple``
+    """
+    errors = []
+    id_mapping = {}
+    roots, contents = insert_parts(dbsession, [(data, parent_id)], zip_file, id_mapping, errors)
+    update_crossrefs(dbsession, contents, id_mapping)
+    if roots[0].type == 'module':
+        dbsession.bulk_insert_mappings(UserPartRole, [{'user_id': user.id, 'part_id': roots[0].id, 'role': 'owner'}])
+    mark_changed(dbsession)
+    return roots[0].id, errors
+
+
+def update_part(dbsession, part, data, zip_file, inline_images=False):
+    """Updates the existing ``part`` and its children from the :class:`~wte.models.Part`
+    ``data`` exported by :func:`~wte.views.part.export`, applying only the
+    changes.
+
+    The exported children are matched to the existing children of the same
+    type by their title and, if no child has the same title, by their order.
+    The title, label, display mode, order, and content of matched parts are
+    updated if they differ. Their :class:`~wte.models.Asset` are matched by
+    filename and the data of an asset is only replaced if its etag differs.
+    The etags of the existing assets are computed from their data, as the
+    stored etags are not guaranteed to match it. If the archive contains the
+    assets' etags, then the data of unchanged assets is not read.
+    Exported parts that cannot be matched are inserted and existing parts
+    that are no longer in the export are made unavailable instead of being
+    deleted, so that the progress and files of the students are kept. The
+    status of matched parts is not changed.
+
+    Assets that cannot be read from the ``zip_file`` are not changed and an
+    error message is returned for each of them. If ``inline_images`` is
+    ``True``, then the parts that may embed an image asset that was added,
+    changed, or removed are also compiled (see
+    :func:`~wte.views.part.image_users`).
+
+    :param dbsession: The database session to update with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param part: The part to update
+    :type part: :class:`~wte.models.Part`
+    :param data: The part data to update from
+    :type data: ``dict``
+    :param zip_file: The archive containing the assets' data
+    :type zip_file: :class:`~zipfile.ZipFile`
+    :param inline_images: Whether images are embedded into the content
+    :type inline_images: ``boolean``
+    :return: The ids of the parts whose content needs to be compiled and the
+             error messages
+    :rtype: (``list``, ``list``) ``tuple``
+    """
+    def match_children(data, existing):
+        targets = [part_from_data(child_data, existing.id) for child_data in data.get('children', [])]
+        remaining = list(existing.children)
+        matches = [None] * len(targets)
+        for attr in ('title', 'order'):
+            for idx, target in enumerate(targets):
+                if matches[idx] is None:
+                    for child in remaining:
+                        if child.type == target.type and getattr(child, attr) == getattr(target, attr):
+                            matches[idx] = child
+                            remaining.remove(child)
+                            break
+        return zip(data.get('children', []), targets, matches)
+
+    def update_assets(data, existing):
+        current = {}
+        for asset in metadata[existing.id]:
+            current.setdefault(asset.filename, []).append(asset)
+        for tmpl in data.get('assets', []):
+            asset = current[tmpl['filename']].pop(0) if current.get(tmpl.get('filename')) else None
+            etag = etags[asset.id] if asset is not None else None
+            values = asset_from_data(tmpl, zip_file, errors, etag)
+            if values is None:
+                continue
+            if asset is None:
+                result = dbsession.execute(Asset.__table__.insert().values(**values))
+                links.append({'part_id': existing.id, 'asset_id': result.inserted_primary_key[0]})
+                if values['mimetype'].startswith('image/'):
+                    images.append((existing.id, values['filename']))
+            else:
+                if values.get('etag', etag) == etag:
+                    # The data is unchanged, but the stored etag may not match it
+                    values.pop('data', None)
+                    values['etag'] = etag
+                for key in ['filename', 'mimetype', 'type', 'order', 'etag']:
+                    if key in values and getattr(asset, key) == values[key]:
+                        del values[key]
+                if values:
+                    dbsession.execute(Asset.__table__.update().where(Asset.id == asset.id).values(**values))
+                    if asset.mimetype.startswith('image/') or values.get('mimetype', '').startswith('image/'):
+                        images.append((existing.id, asset.filename))
+                        images.append((existing.id, values.get('filename', asset.filename)))
+        for assets in current.values():
+            for asset in assets:
+                removed_links.append((existing.id, asset.id))
+                if asset.mimetype.startswith('image/'):
+                    images.append((existing.id, asset.filename))
+
+    def update(data, existing, target):
+        matched.add(existing.id)
+        if 'id' in data:
+            id_mapping[str(data['id'])] = existing.id
+        for key in ['title', 'label', 'display_mode', 'order']:
+            if getattr(existing, key) != getattr(target, key):
+                updates.setdefault(existing.id, {'id': existing.id})[key] = getattr(target, key)
+        if existing.title != target.title:
+            retitled.add(str(existing.id))
+        contents.append((existing, target.content))
+        update_assets(data, existing)
+        for child_data, child_target, child in match_children(data, existing):
+            if child is None:
+                new_trees.append((child_data, existing.id))
+            else:
+                update(child_data, child, child_target)
+
+    errors = []
+    links = []
+    id_mapping = {}
+    updates = {}
+    contents = []
+    new_trees = []
+    matched = set()
+    retitled = set()
+    removed_links = []
+    images = []
+    parts = load_part_tree(dbsession, part)
+    metadata = asset_metadata(dbsession, parts)
+    etags = asset_etags([asset.id for assets in metadata.values() for asset in assets])
+    update(data, part, part_from_data(data, part.parent_id))
+    new_parts, new_contents = insert_parts(dbsession, new_trees, zip_file, id_mapping, errors)
+    update_crossrefs(dbsession, new_contents, id_mapping)
+    compile_ids = set([part_id for part_id, _ in new_contents])
+    # References to parts outside the exported part are exported as "external", so these are ignored when
+    # comparing the content
+    own_ids = dict([(str(tree_part.id), tree_part.id) for tree_part in parts])
+    for existing, content in contents:
+        if content:
+            content = re.sub(CROSSREF_PATTERN, lambda m: crossref_replace(m, id_mapping), content)
+        current = existing.content
+        if current:
+            current = re.sub(CROSSREF_PATTERN, lambda m: crossref_replace(m, own_ids), current)
+        if content != current:
+            updates.setdefault(existing.id, {'id': existing.id})['content'] = content
+            if content:
+                compile_ids.add(existing.id)
+            else:
+                updates[existing.id]['compiled_content'] = None
+                updates[existing.id]['requires_typesetting'] = False
+        elif content and retitled:
+            for match in re.finditer(CROSSREF_PATTERN, content):
+                if match.group(1) in retitled:
+                    compile_ids.add(existing.id)
+    if inline_images:
+        compile_ids.update(image_users(parts, images))
+    for removed in parts:
+        if removed.id not in matched and removed.parent_id in matched and removed.status != 'unavailable':
+            updates[removed.id] = {'id': removed.id, 'status': 'unavailable'}
+    if updates:
+        dbsession.bulk_update_mappings(Part, list(updates.values()))
+    if links:
+        dbsession.execute(parts_assets.insert(), links)
+    if removed_links:
+        for part_id, asset_id in removed_links:
+            dbsession.execute(parts_assets.delete().where(and_(parts_assets.c.part_id == part_id,
+                                                               parts_assets.c.asset_id == asset_id)))
+        asset_ids = [asset_id for _, asset_id in removed_links]
+        linked = set([row.asset_id for row in dbsession.query(parts_assets.c.asset_id).
+                      filter(parts_assets.c.asset_id.in_(asset_ids))])
+        unlinked = [asset_id for asset_id in asset_ids if asset_id not in linked]
+        if unlinked:
+            dbsession.execute(Asset.__table__.delete().where(Asset.id.in_(unlinked)))
+    mark_changed(dbsession)
+    return list(compile_ids), errors
+
+
+def compile_imported_parts(request, dbsession, parts, errors):
+    """Compiles the content of the imported or updated ``parts`` and updates
+    their :class:`~wte.models.Quiz`. The parts must have been committed, as
+    they are compiled in the compiler pool (see
+    :func:`~wte.text_formatter.compile_parts`).
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param dbsession: The database session to update with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param parts: The parts to compile
+    :type parts: ``list`` of :class:`~wte.models.Part`
+    :param errors: The list to add an error message to for each part whose
+                   content cannot be compiled
+    :type errors: ``list``
+    """
+    for compiled_part, result in compile_parts(parts, request):
+        if isinstance(result, Exception):
+            errors.append('The content of "%s" could not be compiled: %s' % (compiled_part.title, result))
+        else:
+            compiled_part.compiled_content, quizzes = result
+            compiled_part.requires_typesetting = requires_typesetting(compiled_part.compiled_content)
+            sync_quizzes(dbsession, compiled_part, quizzes)
+
+
+def inline_images_enabled(request):
+    """Returns whether small images are embedded into the compiled content
+    as data URIs (see the "prerender.inline_images_max_size" setting).
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :rtype: ``boolean``
+    """
+    return get_config_setting(request, 'prerender.inline_images_max_size', target_type='int', default=0) > 0
+
+
+def image_users(parts, images):
+    """Returns the ids of the ``parts`` whose compiled content may embed one
+    of the ``images``. An image :class:`~wte.models.Asset` of a
+    :class:`~wte.models.Part` can be referenced from that part and all its
+    descendants, so these are returned if their content contains the image's
+    filename.
+
+    :param parts: The parts to check, including their parents
+    :type parts: ``list`` of :class:`~wte.models.Part`
+    :param images: The (part id, filename) of the images
+    :type images: ``list`` of ``tuple``
+    :return: The ids of the parts that may embed the images
+    :rtype: ``set``
+    """
+    children = {}
+    for tree_part in parts:
+        children.setdefault(tree_part.parent_id, []).append(tree_part)
+    ids = set()
+    for part_id, filename in images:
+        level = [tree_part for tree_part in parts if tree_part.id == part_id]
+        while level:
+            for tree_part in level:
+                if tree_part.content and filename in tree_part.content:
+                    ids.add(tree_part.id)
+            level = [child for tree_part in level for child in children.get(tree_part.id, [])]
+    return ids
+
+
+def recompile_image_users(request, part_id, filenames):
+    """Recompiles the content of the parts that may embed the images with
+    the ``filenames`` of the :class:`~wte.models.Part` with the ``part_id``
+    (see :func:`~wte.views.part.image_users`), so that the data URIs of
+    embedded images are updated when the images are added, changed, or
+    deleted. Does nothing if images are not embedded. Errors are shown to the
+    user.
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param part_id: The id of the part that the images belong to
+    :type part_id: ``int``
+    :param filenames: The filenames of the images
+    :type filenames: ``list``
+    """
+    if not inline_images_enabled(request):
+        return
+    dbsession = DBSession()
+    errors = []
+    with transaction.manager:
+        part = dbsession.query(Part).filter(Part.id == part_id).first()
+        if part is None:
+            return
+        parts = load_part_tree(dbsession, part)
+        ids = image_users(parts, [(part_id, filename) for filename in filenames])
+        compile_imported_parts(request, dbsession, [tree_part for tree_part in parts if tree_part.id in ids], errors)
+    for error in errors:
+        request.session.flash(error, queue='error')
+
+
 @view_config(route_name='part.import', renderer='wte:templates/part/import.kajiki')
 @current_user()
 @require_logged_in()
@@ -1208,68 +1790,6 @@ def import_file(request):
     * `exercise` -- "edit" permission on the parent :class:`~wte.models.Part`
     * `task` -- "edit" permission on the parent :class:`~wte.models.Part`
     """
-    def recursive_import(data, zip_file, id_mapping):
-        part_type = data['type']
-        if part_type == 'task':
-            part_type = 'page'
-        elif part_type in ['tutorial', 'exercise']:
-            part_type = 'part'
-        part = Part(type=part_type,
-                    title=data['title'],
-                    status='available' if part_type == 'page' else 'unavailable')
-        if 'id' in data:
-            id_mapping[str(data['id'])] = part
-        if 'order' in data:
-            try:
-                part.order = int(data['order'])
-            except ValueError:
-                part.order = 0
-        if 'content' in data:
-            part.content = data['content']
-        if part_type == 'part' and 'display_mode' in data:
-            part.display_mode = data['display_mode']
-        elif part_type == 'part':
-            part.display_mode = 'three_pane_html'
-        if 'label' in data:
-            part.label = data['label']
-        else:
-            if data['type'] in ['tutorial', 'exercise', 'page', 'task']:
-                part.label = data['type'].title()
-        if 'assets' in data:
-            for tmpl in data['assets']:
-                if 'filename' in tmpl and 'mimetype' in tmpl and 'id' in tmpl and 'type' in tmpl:
-                    try:
-                        content = zip_file.open('assets/%i' % (tmpl['id']))
-                        asset = Asset(filename=tmpl['filename'],
-                                      mimetype=tmpl['mimetype'],
-                                      data=content.read(),
-                                      type=tmpl['type'])
-                        if 'order' in tmpl:
-                            try:
-                                asset.order = int(tmpl['order'])
-                            except ValueError:
-                                asset.order = 0
-                        part.all_assets.append(asset)
-                    except:
-                        pass
-        if 'children' in data:
-            for child in data['children']:
-                child_part = recursive_import(child, zip_file, id_mapping)
-                part.children.append(child_part)
-                child_part.parent = part
-        return part
-
-    def fix_references(part, dbsession, id_mapping):
-        dbsession.add(part)
-        if part.content:
-            part.content = re.sub(CROSSREF_PATTERN, lambda m: crossref_replace(m, id_mapping), part.content)
-            part.compiled_content = compile_rst(part.content,
-                                                request,
-                                                part=part)
-        if part.children:
-            for child in part.children:
-                fix_references(child, dbsession, id_mapping)
-
     dbsession = DBSession()
     parent = dbsession.query(Part).\
         filter(Part.id == request.params['parent_id']).first()\
@@ -1287,24 +1807,22 @@ def import_file(request):
             params = ImportPartSchema().to_python(request.params, State(parent=parent,
                                                                         request=request))
             with transaction.manager:
-                if parent:
-                    dbsession.add(parent)
-                id_mapping = {}
-                part = recursive_import(params['file'][0], params['file'][1], id_mapping)
-                dbsession.add(part)
-                params['file'][1].close()
-                if part.type == 'module':
-                    part.users.append(UserPartRole(user=request.current_user,
-                                                   role='owner'))
-                if parent:
-                    parent.children.append(part)
+                part_id, errors = import_part(dbsession,
+                                              params['file'][0],
+                                              params['file'][1],
+                                              parent.id if parent else None,
+                                              request.current_user)
+            params['file'][1].close()
             with transaction.manager:
-                for key, value in list(id_mapping.items()):
-                    dbsession.add(value)
-                    id_mapping[key] = value.id
-                fix_references(part, dbsession, id_mapping)
-            dbsession.add(part)
-            raise HTTPSeeOther(request.route_url('part.view', pid=part.id))
+                part = dbsession.query(Part).filter(Part.id == part_id).first()
+                compile_imported_parts(request,
+                                       dbsession,
+                                       [tree_part for tree_part in load_part_tree(dbsession, part)
+                                        if tree_part.content],
+                                       errors)
+            for error in errors:
+                request.session.flash(error, queue='error')
+            raise HTTPSeeOther(request.route_url('part.view', pid=part_id))
         except formencode.Invalid as e:
             return {'errors': e.error_dict,
                     'valuse': request.params,
@@ -1314,50 +1832,96 @@ def import_file(request):
             'help': ['user', 'teacher', 'import_export.html']}
 
 
-# Todo: Add a download launch page for non-JS users
-@view_config(route_name='part.download')
-@require_method('POST')
+@view_config(route_name='part.update', renderer='wte:templates/part/update.kajiki')
 @current_user()
 @require_logged_in()
-def download(request):
-    """Handles the ``/parts/{pid}/download`` URL, providing the UI and backend
-    for downloading a :class:`~wte.models.Part`.
+def update_from_file(request):
+    """Handles the ``/parts/{pid}/update`` URL, providing the UI and
+    backend for updating an existing :class:`~wte.models.Part` from a file
+    exported by :func:`~wte.views.part.export` (see
+    :func:`~wte.views.part.update_part`). Only the content that changed is
+    compiled.
 
-    The difference between exporting (:func:`~wte.views.part.export`) and
-    downloading is that exporting creates an archive that can be imported into
-    another WTE instance, while downloading creates an HTML version for
-    offline viewing.
+    Requires that the user has "edit" rights on the :class:`~wte.models.Part`.
     """
-    def download_part(base_path, part, body_zip, parents=None):
-        response = render_to_response('wte:templates/part/download.kajiki',
-                                      {'part': part,
-                                       'parents': parents},
-                                      request=request)
-        body_zip.writestr('%s/%s.html' % (base_path, part.id), response.body)
-        for child in part.children:
-            if child.allow('view', request.current_user):
-                download_part(base_path, child, body_zip, parents + [part] if parents else [part])
-        for asset in part.assets:
-            body_zip.writestr('%s/%s/assets/%s' % (base_path, part.id, asset.filename),
-                              asset.data if asset.data else '')
-        for template in part.templates:
-            template_data = template.data if template.data else native_str('')
-            body_zip.writestr('%s/%s/%s' % (base_path, part.id, template.filename), template_data)
     dbsession = DBSession()
     part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
     if part:
-        if part.allow('view', request.current_user):
-            body = BytesIO()
-            body_zip = ZipFile(body, 'w')
-            for target, source in [('%s/_static/application.min.css', 'static/css/application.min.css'),
-                                   ('%s/_static/foundation-icons.eot', 'static/css/foundation-icons.eot'),
-                                   ('%s/_static/foundation-icons.svg', 'static/css/foundation-icons.svg'),
-                                   ('%s/_static/foundation-icons.ttf', 'static/css/foundation-icons.ttf'),
-                                   ('%s/_static/foundation-icons.woff', 'static/css/foundation-icons.woff'),
-                                   ('%s/_static/libraries.min.js', 'static/js/libraries.min.js')]:
-                body_zip.writestr(target % part.title.replace('/', '_'),
-                                  resource_string('wte', source))
-            index_html = '''<!DOCTYPE html>
+        if part.allow('edit', request.current_user):
+            crumbs = create_part_crumbs(request,
+                                        part,
+                                        {'title': 'Update',
+                                         'url': request.current_route_url()})
+            if request.method == 'POST':
+                try:
+                    params = ImportPartSchema().to_python(request.params, State(parent=part.parent,
+                                                                                request=request))
+                    with transaction.manager:
+                        part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
+                        compile_ids, errors = update_part(dbsession, part, params['file'][0], params['file'][1],
+                                                          inline_images=inline_images_enabled(request))
+                    params['file'][1].close()
+                    with transaction.manager:
+                        part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
+                        compile_imported_parts(request,
+                                               dbsession,
+                                               [tree_part for tree_part in load_part_tree(dbsession, part)
+                                                if tree_part.id in compile_ids],
+                                               errors)
+                    for error in errors:
+                        request.session.flash(error, queue='error')
+                    raise HTTPSeeOther(request.route_url('part.view', pid=request.matchdict['pid']))
+                except formencode.Invalid as e:
+                    return {'errors': e.error_dict,
+                            'values': request.params,
+                            'part': part,
+                            'crumbs': crumbs,
+                            'help': ['user', 'teacher', 'import_export.html']}
+            return {'part': part,
+                    'crumbs': crumbs,
+                    'help': ['user', 'teacher', 'import_export.html']}
+        else:
+            unauthorised_redirect(request)
+    else:
+        raise HTTPNotFound()
+
+
+def download_entries(request, part):
+    """Returns the entries of the archive for viewing the ``part`` offline,
+    in the form expected by :func:`~wte.archive.zip_stream`. Only the parts
+    that the current user may view are included. The pages are rendered
+    immediately, while the data of the :class:`~wte.models.Asset` is only
+    fetched while the entries are consumed.
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param part: The part to download
+    :type part: :class:`~wte.models.Part`
+    :return: The archive entries
+    :rtype: generator of ``tuple``
+    """
+    def visible_parts(part, parents=None):
+        parts = [(part, parents)]
+        for child in part.children:
+            if child.allow('view', request.current_user):
+                parts.extend(visible_parts(child, parents + [part] if parents else [part]))
+        return parts
+
+    def entries(pages, assets):
+        for target, source in [('%s/_static/application.min.css', 'static/css/application.min.css'),
+                               ('%s/_static/foundation-icons.eot', 'static/css/foundation-icons.eot'),
+                               ('%s/_static/foundation-icons.svg', 'static/css/foundation-icons.svg'),
+                               ('%s/_static/foundation-icons.ttf', 'static/css/foundation-icons.ttf'),
+                               ('%s/_static/foundation-icons.woff', 'static/css/foundation-icons.woff'),
+                               ('%s/_static/libraries.min.js', 'static/js/libraries.min.js')]:
+            yield target % base_path, static_entry(source), ZIP_DEFLATED
+        for page in pages:
+            yield page
+        for entry in asset_entries(assets):
+            yield entry
+
+    base_path = part.title.replace('/', '_')
+    index_html = '''<!DOCTYPE html>
 <html>
   <head>
     <title>%(title)s</title>
@@ -1370,15 +1934,158 @@ def download(request):
     <p>The main content can be found <a href="%(url)s">here</a></p>
   </body>
 </html>''' % {'title': part.title, 'url': '%s.html' % part.id}
-            if IS_PYTHON2:
-                index_html = index_html.encode('utf-8')
-            body_zip.writestr('%s/index.html' % (part.title.replace('/', '_')), index_html)
-            download_part(part.title.replace('/', '_'), part, body_zip)
-            body_zip.close()
-            return Response(body=body.getvalue(),
-                            headers=[('Content-Type', 'application/zip'),
-                                     ('Content-Disposition',
-                                      native_str('attachment; filename="%s.zip"' % (part.title.replace('/', '_'))))])
+    dbsession = DBSession()
+    load_part_tree(dbsession, part)
+    parts = visible_parts(part)
+    visible = set([visible_part.id for visible_part, _ in parts])
+    metadata = asset_metadata(dbsession, [visible_part for visible_part, _ in parts])
+    bodies = render_download_pages(request,
+                                   part,
+                                   [(visible_part.id, [parent.id for parent in parents] if parents else None)
+                                    for visible_part, parents in parts],
+                                   visible,
+                                   get_config_setting(request, 'archive.render_threads', target_type='int',
+                                                      default=1))
+    pages = [('%s/index.html' % base_path, index_html, ZIP_DEFLATED)]
+    assets = {}
+    for (visible_part, _), body in zip(parts, bodies):
+        pages.append(('%s/%s.html' % (base_path, visible_part.id), body, ZIP_DEFLATED))
+        for asset in metadata[visible_part.id]:
+            if asset.type == 'asset':
+                filename = '%s/%s/assets/%s' % (base_path, visible_part.id, asset.filename)
+            else:
+                filename = '%s/%s/%s' % (base_path, visible_part.id, asset.filename)
+            assets.setdefault(asset.id, (asset.mimetype, asset.etag, asset.size, []))[3].append(filename)
+    return entries(pages, assets)
+
+
+def load_part_tree(dbsession, part):
+    """Loads all descendants of the ``part`` with one query per level of
+    the tree and one query for their templates, instead of loading the
+    ``children`` and ``templates`` of each :class:`~wte.models.Part`
+    separately when they are first accessed.
+
+    :param dbsession: The database session to load the parts with
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param part: The part to load the descendants of
+    :type part: :class:`~wte.models.Part`
+    :return: The ``part`` and all its descendants, in the same order as
+             :func:`~wte.views.part.get_all_parts`
+    :rtype: ``list``
+    """
+    parts = {part.id: part}
+    level = [part]
+    while level:
+        children = dict([(parent.id, []) for parent in level])
+        ids = list(children.keys())
+        for offset in range(0, len(ids), 100):
+            for child in dbsession.query(Part).filter(Part.parent_id.in_(ids[offset:offset + 100])).\
+                    order_by(Part.order):
+                children[child.parent_id].append(child)
+        level = []
+        for parent_id, parent_children in children.items():
+            set_committed_value(parts[parent_id], 'children', parent_children)
+            for child in parent_children:
+                set_committed_value(child, 'parent', parts[parent_id])
+                parts[child.id] = child
+                level.append(child)
+    templates = dict([(part_id, []) for part_id in parts.keys()])
+    ids = list(templates.keys())
+    for offset in range(0, len(ids), 100):
+        query = dbsession.query(parts_assets.c.part_id, Asset).\
+            join(Asset, Asset.id == parts_assets.c.asset_id).\
+            filter(and_(parts_assets.c.part_id.in_(ids[offset:offset + 100]),
+                        Asset.type == 'template')).\
+            order_by(Asset.order)
+        for part_id, template in query:
+            templates[part_id].append(template)
+    for part_id, part_templates in templates.items():
+        set_committed_value(parts[part_id], 'templates', part_templates)
+    return get_all_parts(part)
+
+
+def render_download_pages(request, part, pages, visible, threads):
+    """Renders the pages for viewing the ``part`` offline. The pages are
+    rendered concurrently by up to ``threads`` threads, each of which loads
+    the ``part``'s tree (see :func:`~wte.views.part.load_part_tree`) with its
+    own database session.
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param part: The part that is downloaded
+    :type part: :class:`~wte.models.Part`
+    :param pages: The id of the part and the ids of its parents for each page
+    :type pages: ``list`` of ``tuple``
+    :param visible: The ids of the parts that the current user may view
+    :type visible: ``set``
+    :param threads: The maximum number of threads to render with
+    :type threads: ``int``
+    :return: The rendered pages, in the same order as the ``pages``
+    :rtype: ``list`` of ``bytes``
+    """
+    def render_page(parts, page_request, part_id, parent_ids):
+        return render_to_response('wte:templates/part/download.kajiki',
+                                  {'part': parts[part_id],
+                                   'parents': [parts[parent_id] for parent_id in parent_ids]
+                                   if parent_ids else None,
+                                   'visible': visible},
+                                  request=page_request).body
+
+    def render_pages():
+        dbsession = DBSession()
+        try:
+            parts = dict([(tree_part.id, tree_part)
+                          for tree_part in load_part_tree(dbsession, dbsession.query(Part).get(part.id))])
+            page_request = Request.blank(request.path, base_url=request.application_url)
+            page_request.registry = request.registry
+            while not errors:
+                with lock:
+                    index = remaining.pop() if remaining else None
+                if index is None:
+                    break
+                results[index] = render_page(parts, page_request, *pages[index])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            transaction.abort()
+            DBSession.remove()
+
+    threads = min(threads, len(pages))
+    if threads <= 1:
+        parts = dict([(tree_part.id, tree_part) for tree_part in get_all_parts(part)])
+        return [render_page(parts, request, part_id, parent_ids) for part_id, parent_ids in pages]
+    results = [None] * len(pages)
+    remaining = list(reversed(range(len(pages))))
+    errors = []
+    lock = Lock()
+    workers = [Thread(target=render_pages) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+@view_config(route_name='part.download')
+@require_method('POST')
+@current_user()
+@require_logged_in()
+def download(request):
+    """Handles the ``/parts/{pid}/download`` URL, providing the UI and backend
+    for downloading a :class:`~wte.models.Part`.
+
+    The difference between exporting (:func:`~wte.views.part.export`) and
+    downloading is that exporting creates an archive that can be imported into
+    another WTE instance, while downloading creates an HTML version for
+    offline viewing.
+    """
+    dbsession = DBSession()
+    part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
+    if part:
+        if part.allow('view', request.current_user):
+            return archive_response(request, part, 'download')
         else:
             unauthorised_redirect(request)
     else:
@@ -1435,6 +2142,322 @@ def reset_files(request):
         raise HTTPNotFound()
 
 
+def progress_entries(request, part):
+    """Returns the entries of the archive containing the current user's
+    files for the ``part``, in the form expected by
+    :func:`~wte.archive.zip_stream`. The data of the files and of the
+    ``part``'s :class:`~wte.models.Asset` is only fetched while the entries
+    are consumed.
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param part: The part to download the files for
+    :type part: :class:`~wte.models.Part`
+    :return: The archive entries
+    :rtype: generator of ``tuple``
+    """
+    dbsession = DBSession()
+    basepath = part.title
+    parent = part.parent
+    while parent:
+        basepath = '%s/%s' % (parent.title, basepath)
+        parent = parent.parent
+    basepath = '%s/' % (basepath)
+    assets = {}
+    for asset in progress_files(dbsession, request.current_user, part):
+        assets.setdefault(asset.id, (asset.mimetype, asset.etag, asset.size, []))[3].\
+            append('%s%s' % (basepath, asset.filename))
+    for asset in asset_metadata(dbsession, [part])[part.id]:
+        if asset.type == 'asset':
+            assets.setdefault(asset.id, (asset.mimetype, asset.etag, asset.size, []))[3].\
+                append('%s/assets/%s' % (basepath, asset.filename))
+    return asset_entries(assets)
+
+
+def progress_files(dbsession, user, part):
+    """Loads the metadata of the files in the ``user``'s
+    :class:`~wte.models.UserPartProgress` for the ``part`` without loading
+    the files' data.
+
+    :param dbsession: The database session to use
+    :type dbsession: :class:`~sqlalchemy.orm.session.Session`
+    :param user: The user to load the files for
+    :type user: :class:`~wte.models.User`
+    :param part: The part to load the files for
+    :type part: :class:`~wte.models.Part`
+    :return: The ``id``, ``filename``, ``mimetype``, ``etag``, and ``size`` of
+             each file
+    :rtype: ``list``
+    """
+    return dbsession.query(Asset.id, Asset.filename, Asset.mimetype, Asset.etag,
+                           func.length(Asset.data).label('size')).\
+        join(progress_assets, progress_assets.c.asset_id == Asset.id).\
+        join(UserPartProgress, UserPartProgress.id == progress_assets.c.progress_id).\
+        filter(and_(UserPartProgress.user_id == user.id,
+                    UserPartProgress.part_id == part.id)).\
+        order_by(Asset.order).all()
+
+
+def cohort_progress_entries(part, batch_size=BATCH_SIZE):
+    """Returns the entries of the archive containing the files of all students
+    for the ``part``, in the form expected by :func:`~wte.archive.zip_stream`.
+    For a module, the files for all its parts are included. The files of each
+    student are stored in a directory named after the student's e-mail
+    address, followed by the titles of the part that the files belong to.
+    Files that are identical to the template they were created from, based on
+    their etags, are not included.
+
+    The files are only fetched while the entries are consumed, using a
+    separate database connection. They are fetched in batches of
+    ``batch_size`` files, ordered by their id, with each batch starting
+    after the last id of the previous batch, so that the memory used does not
+    depend on the number of students. The data of large files is read in
+    chunks (see :class:`~wte.archive.BlobReader`).
+
+    :param part: The part to download the files for
+    :type part: :class:`~wte.models.Part`
+    :param batch_size: The number of files to fetch per query
+    :type batch_size: ``int``
+    :return: The archive entries
+    :rtype: generator of ``tuple``
+    """
+    def entries(root_id, paths, templates):
+        table = Asset.__table__
+        progress = UserPartProgress.__table__
+        roles = UserPartRole.__table__
+        users = User.__table__
+        size = func.length(table.c.data)
+        query = select([table.c.id, table.c.filename, table.c.mimetype, table.c.etag, size.label('size'),
+                        case([(size <= CHUNK_SIZE, table.c.data)], else_=null()).label('data'),
+                        progress.c.part_id, users.c.email]).\
+            select_from(table.join(progress_assets, progress_assets.c.asset_id == table.c.id).
+                        join(progress, progress.c.id == progress_assets.c.progress_id).
+                        join(users, users.c.id == progress.c.user_id).
+                        join(roles, and_(roles.c.user_id == progress.c.user_id,
+                                         roles.c.part_id == root_id,
+                                         roles.c.role == 'student'))).\
+            where(progress.c.part_id.in_(list(paths.keys()))).\
+            order_by(table.c.id).\
+            limit(batch_size)
+        with DBSession.get_bind().connect() as connection:
+            last_id = 0
+            while True:
+                rows = connection.execute(query.where(table.c.id > last_id)).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    last_id = row.id
+                    template = templates.get((row.part_id, row.filename))
+                    if template and template[1] == row.size:
+                        etag = row.etag
+                        if etag is None and row.data is not None:
+                            etag = hashlib.sha512(row.data).hexdigest()
+                        if etag == template[0]:
+                            continue
+                    filename = '%s/%s/%s' % (row.email, paths[row.part_id], row.filename)
+                    if row.size is not None and row.size > CHUNK_SIZE:
+                        yield filename, BlobReader(connection, row.id, row.size), compress_type(row.mimetype)
+                    else:
+                        yield filename, row.data or b'', compress_type(row.mimetype)
+
+    if part.type == 'module':
+        parts = list(part.children)
+    elif part.type == 'page':
+        parts = [part.parent]
+    else:
+        parts = [part]
+    paths = {}
+    for progress_part in parts:
+        path = progress_part.title
+        parent = progress_part.parent
+        while parent:
+            path = '%s/%s' % (parent.title, path)
+            parent = parent.parent
+        paths[progress_part.id] = path
+    templates = {}
+    missing = {}
+    for part_id, assets in asset_metadata(DBSession(), parts).items():
+        for asset in assets:
+            if asset.type == 'template':
+                templates[(part_id, asset.filename)] = (asset.etag, asset.size)
+                if asset.etag is None:
+                    missing[asset.id] = (part_id, asset.filename)
+    if missing:
+        for asset_id, etag in asset_etags(list(missing.keys())).items():
+            templates[missing[asset_id]] = (etag, templates[missing[asset_id]][1])
+    return entries(part.root().id, paths, templates)
+
+
+ARCHIVE_PERMISSIONS = {'export': 'edit',
+                       'download': 'view',
+                       'progress': 'view'}
+"""The kinds of archive and the permission on the :class:`~wte.models.Part`
+required to create them."""
+
+
+def archive_entries(kind, request, part):
+    """Returns the entries of the archive of the given ``kind`` for the
+    ``part``. See :func:`~wte.views.part.export_entries`,
+    :func:`~wte.views.part.download_entries`, and
+    :func:`~wte.views.part.progress_entries`.
+    """
+    if kind == 'export':
+        return export_entries(request, part)
+    elif kind == 'download':
+        return download_entries(request, part)
+    elif kind == 'progress':
+        return progress_entries(request, part)
+
+
+def archive_filename(kind, part):
+    """Returns the filename under which the archive of the given ``kind``
+    for the ``part`` is sent to the user.
+
+    :return: The archive filename
+    :rtype: `unicode`
+    """
+    if kind == 'progress':
+        filename = part.title
+        parent = part.parent
+        while parent:
+            filename = '%s - %s' % (parent.title, filename)
+            parent = parent.parent
+        return '%s.zip' % (filename.replace('/', '_'))
+    else:
+        return '%s.zip' % (part.title.replace('/', '_'))
+
+
+def archive_role(part, user):
+    """Returns the role that determines which children of the ``part`` the
+    ``user`` can view, so that all users with the same role can share the
+    same download archive.
+
+    :return: The role, either "tutor", "student", or "guest"
+    :rtype: `unicode`
+    """
+    root = part.root()
+    if user.has_permission('admin.modules.view') or root.has_role(['owner', 'tutor'], user):
+        return 'tutor'
+    elif root.has_role('student', user):
+        return 'student'
+    else:
+        return 'guest'
+
+
+def archive_key(dbsession, request, kind, part):
+    """Returns the key that identifies the archive of the given ``kind`` for
+    the ``part`` in the :class:`~wte.jobs.ArchiveQueue`. The key contains the
+    ``kind``, the id of the ``part``, the role (or for the user's own files
+    the user id), and the version of the archive's content.
+
+    :return: The archive key
+    :rtype: `unicode`
+    """
+    if kind == 'progress':
+        role = 'user%i' % request.current_user.id
+        parts = [part]
+        parent = part.parent
+        while parent:
+            parts.append(parent)
+            parent = parent.parent
+        extra = [tuple(row) for row in progress_files(dbsession, request.current_user, part)]
+    else:
+        role = 'edit' if kind == 'export' else archive_role(part, request.current_user)
+        parts = load_part_tree(dbsession, part)
+        extra = [request.application_url] if kind == 'download' else [EXPORT_FORMAT]
+    content_version = archive_version(parts, asset_metadata(dbsession, parts), kind, role, version(), extra)
+    return '%s-%s-%s-%s' % (kind, part.id, role, content_version)
+
+
+def cached_archive_response(path, checksum, headers):
+    """Returns the response that sends the cached archive at ``path``. The
+    archive's ``checksum`` is sent as a strong ETag and in the ``Digest`` and
+    ``Repr-Digest`` headers. Range requests are answered with the requested
+    part of the archive, so that interrupted downloads can be resumed. The
+    archive is sent using the :class:`~webob.static.FileIter`, which seeks to
+    the start of the requested part instead of reading the archive up to it.
+
+    :param path: The path of the cached archive
+    :type path: `unicode`
+    :param checksum: The hex-encoded SHA-256 checksum of the archive
+    :type checksum: `unicode`
+    :param headers: The additional headers to send
+    :type headers: ``list`` of ``tuple``
+    :return: The response
+    :rtype: :class:`~pyramid.response.Response`
+    """
+    in_file = open(path, 'rb')
+    stat = os.fstat(in_file.fileno())
+    response = Response(app_iter=FileIter(in_file), headerlist=headers, conditional_response=True)
+    response.content_length = stat.st_size
+    response.last_modified = stat.st_mtime
+    response.etag = checksum
+    response.accept_ranges = 'bytes'
+    digest = base64.b64encode(binascii.unhexlify(checksum)).decode('ascii')
+    response.headers['Digest'] = native_str('sha-256=%s' % digest)
+    response.headers['Repr-Digest'] = native_str('sha-256=:%s:' % digest)
+    return response
+
+
+def archive_response(request, part, kind):
+    """Returns the response for the archive of the given ``kind`` for the
+    ``part``. If archives are not cached, then the archive is streamed to the
+    user while it is built. Otherwise the cached archive is sent if it
+    exists (see :func:`~wte.views.part.cached_archive_response`). If it does
+    not, then a job to build it is submitted to the :data:`~wte.jobs.QUEUE`.
+    In both cases the user is sent to the ``part.archive`` URL, which shows
+    the job's status until the archive is ready and then sends the archive,
+    so that the download has a URL at which it can be resumed.
+    """
+    filename = archive_filename(kind, part)
+    headers = [('Content-Type', 'application/zip'),
+               ('Content-Disposition', native_str('attachment; filename="%s"' % filename))]
+    if jobs.QUEUE is None:
+        return Response(app_iter=zip_stream(archive_entries(kind, request, part)), headerlist=headers)
+    key = archive_key(DBSession(), request, kind, part)
+    status, detail = jobs.QUEUE.status(key)
+    if status is None or (status == 'failed' and request.method == 'POST'):
+        jobs.QUEUE.submit(key, kind, request, part)
+        status, detail = jobs.QUEUE.status(key)
+    if request.matched_route.name == 'part.archive' and request.method != 'POST' and status == 'ready':
+        return cached_archive_response(detail, jobs.QUEUE.checksum(key), headers)
+    if request.matched_route.name != 'part.archive' or request.method == 'POST':
+        raise HTTPSeeOther(request.route_url('part.archive', pid=part.id, kind=kind))
+    return render_to_response('wte:templates/part/archive.kajiki',
+                              {'part': part,
+                               'kind': kind,
+                               'status': status,
+                               'message': detail,
+                               'crumbs': create_part_crumbs(request,
+                                                            part,
+                                                            {'title': 'Export' if kind == 'export' else 'Download',
+                                                             'url': request.current_route_url()})},
+                              request=request)
+
+
+@view_config(route_name='part.archive')
+@current_user()
+@require_logged_in()
+def archive(request):
+    """Handles the ``/parts/{pid}/archive/{kind}`` URL, which shows the status
+    of the job that builds the archive of the given kind, until the archive
+    is ready and then sends the archive. Failed jobs are restarted via a POST
+    request.
+
+    Requires the same rights on the :class:`~wte.models.Part` as creating the
+    archive (see :data:`~wte.views.part.ARCHIVE_PERMISSIONS`).
+    """
+    dbsession = DBSession()
+    part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
+    if part and request.matchdict['kind'] in ARCHIVE_PERMISSIONS:
+        if part.allow(ARCHIVE_PERMISSIONS[request.matchdict['kind']], request.current_user):
+            return archive_response(request, part, request.matchdict['kind'])
+        else:
+            unauthorised_redirect(request)
+    else:
+        raise HTTPNotFound()
+
+
 @view_config(route_name='part.progress.download')
 @current_user()
 @require_logged_in()
@@ -1451,26 +2474,37 @@ def download_part_progress(request):
     if part:
         if part.allow('view', request.current_user):
             progress = get_user_part_progress(dbsession, request.current_user, part)
-            basepath = progress.part.title
-            filename = progress.part.title
-            parent = progress.part.parent
-            while parent:
-                basepath = '%s/%s' % (parent.title, basepath)
-                filename = '%s - %s' % (parent.title, filename)
-                parent = parent.parent
-            basepath = '%s/' % (basepath)
-            filename = '%s.zip' % (filename)
-            body = BytesIO()
-            zipfile = ZipFile(body, mode='w')
-            for user_file in progress.files:
-                zipfile.writestr('%s%s' % (basepath, user_file.filename), user_file.data)
-            for asset in progress.part.assets:
-                zipfile.writestr('%s/assets/%s' % (basepath, asset.filename), asset.data)
-            zipfile.close()
-            return Response(body=body.getvalue(),
+            if progress is None:
+                raise HTTPNotFound()
+            return archive_response(request, progress.part, 'progress')
+        else:
+            unauthorised_redirect(request)
+    else:
+        raise HTTPNotFound()
+
+
+@view_config(route_name='part.progress.download_all')
+@current_user()
+@require_logged_in()
+def download_all_progress(request):
+    """Handles the ``/parts/{pid}/progress/download_all`` URL, sending back
+    an archive with the files of all students for the :class:`~wte.models.Part`
+    (see :func:`~wte.views.part.cohort_progress_entries`). The archive is
+    streamed to the user while it is built.
+
+    Requires that the user has "progress" rights on the
+    :class:`~wte.models.Part`.
+    """
+    dbsession = DBSession()
+    part = dbsession.query(Part).filter(Part.id == request.matchdict['pid']).first()
+    if part:
+        if part.allow('progress', request.current_user):
+            filename = archive_filename('progress', part)
+            filename = '%s - Students.zip' % (filename[:-4])
+            return Response(app_iter=zip_stream(cohort_progress_entries(part)),
                             headerlist=[('Content-Type', 'application/zip'),
-                                        ('Content-Disposition', 'attachment; filename="%s"' %
-                                         (filename.replace('/', '_')))])
+                                        ('Content-Disposition',
+                                         native_str('attachment; filename="%s"' % filename))])
         else:
             unauthorised_redirect(request)
     else:
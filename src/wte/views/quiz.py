@@ -23,7 +23,7 @@ from pywebtools.pyramid.auth.views import current_user
 from pywebtools.pyramid.decorators import require_method
 from pywebtools.sqlalchemy import DBSession
 from sqlalchemy import and_
-from xml.etree import ElementTree
+from zope.sqlalchemy import mark_changed
 
 from wte.models import Quiz, QuizAnswer, Part
 
@@ -39,44 +39,58 @@ def init(config):
     config.add_route('quiz.check_answers', '/parts/{pid}/quiz/check_answers')
 
 
-def extract_quizzes(dbsession, part):
-    """Extracts the :class:`~wte.models.Quiz` from the compiled HTML content
-    of a :class:`~wte.models.Part`. Either updates the :class:`~wte.models.Quiz`
-    or creates a new one if none exists with the given quiz name.
+def sync_quizzes(dbsession, part, quizzes):
+    """Synchronises the :class:`~wte.models.Quiz` of a :class:`~wte.models.Part`
+    with the ``quizzes`` metadata generated by :func:`~wte.text_formatter.compile_rst`.
+    Existing :class:`~wte.models.Quiz` are updated, new ones are created, and those
+    that are no longer in the ``quizzes`` are deleted together with their
+    :class:`~wte.models.QuizAnswer`. All changes are made using bulk operations.
 
     :param dbsession: The class:`~pywebtools.sqlalchemy.DBSession` to use for database access
     :type dbsession: :class:`~pywebtools.sqlalchemy.DBSession`
-    :param part: The :class:`~wte.models.Part` to extract the quizzes from
+    :param part: The :class:`~wte.models.Part` to synchronise the quizzes for
     :type part: :class:`~wte.models.Part`
+    :param quizzes: The quiz metadata
+    :type quizzes: ``list``
     """
-    try:
-        dom = ElementTree.fromstring('<div>%s</div>' % part.compiled_content)
-        quiz_names = []
-        for form in dom.findall(".//form[@class='quiz']"):
-            quiz_name = form.attrib['data-quiz-id']
-            quiz_names.append(quiz_name)
-            quiz = dbsession.query(Quiz).filter(and_(Quiz.part_id == part.id,
-                                                     Quiz.name == quiz_name)).first()
-            if quiz is None:
-                quiz = Quiz(part_id=part.id,
-                            name=quiz_name)
-                dbsession.add(quiz)
-            quiz_title = form.find("./div[@class='title']")
-            if quiz_title is not None:
-                quiz.title = quiz_title.text.strip()
-            questions = []
-            for question in dom.findall(".//section[@class='question']"):
-                question_data = {'name': question.attrib['data-question-id']}
-                question_title = question.find("./div[@class='title']")
-                if question_title is not None:
-                    question_data['title'] = question_title.text.strip()
-                questions.append(question_data)
-            quiz.questions = json.dumps(questions)
-        for quiz in dbsession.query(Quiz).filter(Quiz.part_id == part.id):
-            if quiz.name not in quiz_names:
-                dbsession.delete(quiz)
-    except:
-        pass
+    existing = dict([(name, (qid, title, questions)) for qid, name, title, questions in
+                     dbsession.query(Quiz.id, Quiz.name, Quiz.title, Quiz.questions).
+                     filter(Quiz.part_id == part.id)])
+    inserts = []
+    updates = []
+    names = set()
+    for quiz in quizzes:
+        if quiz['name'] in names:
+            continue
+        names.add(quiz['name'])
+        questions = json.dumps(quiz['questions'])
+        if quiz['name'] in existing:
+            qid, title, old_questions = existing[quiz['name']]
+            if quiz['title'] is None:
+                # Quizzes without a title keep any previous title
+                quiz_title = title
+            else:
+                quiz_title = quiz['title']
+            if quiz_title != title or questions != old_questions:
+                updates.append({'id': qid,
+                                'title': quiz_title,
+                                'questions': questions})
+        else:
+            inserts.append({'part_id': part.id,
+                            'name': quiz['name'],
+                            'title': quiz['title'],
+                            'questions': questions})
+    if inserts:
+        dbsession.bulk_insert_mappings(Quiz, inserts)
+    if updates:
+        dbsession.bulk_update_mappings(Quiz, updates)
+    if inserts or updates:
+        # Bulk operations do not mark the session as changed
+        mark_changed(dbsession)
+    stale_ids = [qid for name, (qid, _, _) in existing.items() if name not in names]
+    if stale_ids:
+        dbsession.query(QuizAnswer).filter(QuizAnswer.quiz_id.in_(stale_ids)).delete(synchronize_session=False)
+        dbsession.query(Quiz).filter(Quiz.id.in_(stale_ids)).delete(synchronize_session=False)
 
 
 class SetAnswersSchema(CSRFSchema):
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+u"""
+############################
+Unit tests for :mod:`kajiki`
+############################
+"""
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+u"""
+##################################
+Unit tests for :mod:`kajiki.cache`
+##################################
+"""
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from kajiki import XMLTemplate
+from kajiki.cache import BytecodeCache
+
+SOURCE = u'<p>Hello ${name}</p>'
+OPTIONS = ('xml', None, False, None, True)
+
+
+def with_cache(test):
+    u"""Calls the ``test`` with a :class:`~kajiki.cache.BytecodeCache` in a
+    temporary directory, which is removed afterwards."""
+    def wrapper():
+        directory = tempfile.mkdtemp()
+        try:
+            test(BytecodeCache(os.path.join(directory, 'cache')))
+        finally:
+            shutil.rmtree(directory)
+    wrapper.__name__ = test.__name__
+    wrapper.__doc__ = test.__doc__
+    return wrapper
+
+
+def compiled(source):
+    u"""Returns the compiled form of the ``source`` as stored in the cache."""
+    from kajiki import template
+    from kajiki.xml_template import _Compiler, _Parser, expand
+
+    doc = _Parser('test.html', source).parse()
+    expand(doc)
+    return template.compile_ir(_Compiler('test.html', doc).compile())
+
+
+@with_cache
+def cache_hit_test(cache):
+    u"""Test that a template is stored in the cache and loaded from it."""
+    eq_(None, cache.load('test.html', SOURCE, OPTIONS))
+    eq_(u'<p>Hello World</p>', XMLTemplate(SOURCE, filename='test.html', bytecode_cache=cache)(
+        {'name': 'World'}).render())
+    ok_(cache.load('test.html', SOURCE, OPTIONS) is not None)
+    # Replace the entry to show that the template is not compiled again
+    cache.store('test.html', SOURCE, OPTIONS, compiled(u'<p>Cached ${name}</p>'))
+    eq_(u'<p>Cached World</p>', XMLTemplate(SOURCE, filename='test.html', bytecode_cache=cache)(
+        {'name': 'World'}).render())
+
+
+@with_cache
+def cache_invalidation_test(cache):
+    u"""Test that the cache entry is not used if the template source, the
+    compilation options, or the generated code version change."""
+    import kajiki.cache
+
+    cache.store('test.html', SOURCE, OPTIONS, compiled(SOURCE))
+    ok_(cache.load('test.html', SOURCE, OPTIONS) is not None)
+    eq_(None, cache.load('test.html', SOURCE + u' ', OPTIONS))
+    eq_(None, cache.load('test.html', SOURCE, ('xml', 'html5', False, None, True)))
+    eq_(None, cache.load('other.html', SOURCE, OPTIONS))
+    version = kajiki.cache.CODEGEN_VERSION
+    kajiki.cache.CODEGEN_VERSION = version + 1
+    try:
+        eq_(None, BytecodeCache(cache.directory).load('test.html', SOURCE, OPTIONS))
+    finally:
+        kajiki.cache.CODEGEN_VERSION = version
+    ok_(BytecodeCache(cache.directory).load('test.html', SOURCE, OPTIONS) is not None)
+
+
+@with_cache
+def corrupt_cache_test(cache):
+    u"""Test that corrupt cache files are ignored and replaced."""
+    cache.store('test.html', SOURCE, OPTIONS, compiled(SOURCE))
+    path = cache._path('test.html', OPTIONS)
+    with open(path, 'rb') as f:
+        truncated = f.read()[:20]
+    for data in [b'', b'\x00garbage', truncated]:
+        with open(path, 'wb') as f:
+            f.write(data)
+        eq_(None, cache.load('test.html', SOURCE, OPTIONS))
+        eq_(u'<p>Hello World</p>', XMLTemplate(SOURCE, filename='test.html', bytecode_cache=cache)(
+            {'name': 'World'}).render())
+        ok_(cache.load('test.html', SOURCE, OPTIONS) is not None)
+
+
+@with_cache
+def atomic_write_test(cache):
+    u"""Test that an entry that cannot be written leaves the existing entry
+    and no temporary files behind."""
+    cache.store('test.html', SOURCE, OPTIONS, compiled(SOURCE))
+    cache.store('test.html', SOURCE, OPTIONS, (object(),))
+    eq_([os.path.basename(cache._path('test.html', OPTIONS))], os.listdir(cache.directory))
+    eq_(u'<p>Hello World</p>', XMLTemplate(SOURCE, filename='test.html', bytecode_cache=cache)(
+        {'name': 'World'}).render())
+    cache.clear()
+    eq_([], os.listdir(cache.directory))
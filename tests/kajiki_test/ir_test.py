@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+u"""
+###############################
+Unit tests for :mod:`kajiki.ir`
+###############################
+"""
+from nose.tools import eq_, ok_
+
+from kajiki import XMLTemplate
+from kajiki.util import html_escape
+
+
+def render(source, context=None, mode=None):
+    u"""Compiles the ``source`` and returns the rendered output and the
+    generated Python code."""
+    template = XMLTemplate(source, mode=mode)(context or {})
+    return template.render(), template.py_text
+
+
+def fold_constants_test():
+    u"""Test that ``py:if`` with a literal test is replaced by the branch that
+    is taken, including nested and empty branches."""
+    html, code = render(u'<div><p py:if="False">a</p><p py:else="">b</p>'
+                        u'<py:if test="1"><i py:if="None">c</i><i py:else="">d</i></py:if>'
+                        u'<py:if test="0">e</py:if></div>')
+    eq_(u'<div><p>b</p><i>d</i></div>', html)
+    ok_(u'if ' not in code)
+    html, code = render(u'<div><py:def function="empty()"><py:if test="False">x</py:if></py:def>'
+                        u'${empty()}</div>')
+    eq_(u'<div></div>', html)
+
+
+def non_constant_test():
+    u"""Test that ``py:if`` tests that are not literals are evaluated when the
+    template is rendered."""
+    source = u'<div><p py:if="flag">a</p><p py:else="">b</p><p py:if="[]">c</p></div>'
+    eq_(u'<div><p>a</p></div>', render(source, {'flag': True})[0])
+    eq_(u'<div><p>b</p></div>', render(source, {'flag': False})[0])
+
+
+def static_attributes_test():
+    u"""Test that attributes without expressions are rendered at compile time
+    and attributes with expressions when the template is rendered."""
+    html, code = render(u'<a href="x&amp;y" class="" title="${title}" data-x="a ${title} b">l</a>',
+                        {'title': u'T'})
+    eq_(u'<a class="" data-x="a T b" href="x&amp;y" title="T">l</a>', html)
+    ok_(u'yield \'<a class=""\'' in code)
+    ok_(u'yield \' href="x&amp;y"\'' in code)
+    ok_(u"render_attrs({'title':self.__kj__.collect((title,))}" in code)
+    eq_(u'<a>l</a>', render(u'<a title="${title}">l</a>', {'title': None})[0])
+    eq_(u'<!DOCTYPE html><input checked type="checkbox">',
+        render(u'<input checked="checked" type="checkbox"/>', mode='html5')[0])
+
+
+def attribute_escape_test():
+    u"""Test that static and expression attribute values are escaped the same
+    way, using :func:`~kajiki.util.html_escape`."""
+    value = u'<"&\'>'
+    eq_(u'&lt;&quot;&amp;\'&gt;', html_escape(value))
+    html = render(u'<a title="&lt;&quot;&amp;\'&gt;" alt="${value}">l</a>', {'value': value})[0]
+    eq_(u'<a alt="&lt;&quot;&amp;\'&gt;" title="&lt;&quot;&amp;\'&gt;">l</a>', html)
+    eq_(u'plain', html_escape(u'plain'))
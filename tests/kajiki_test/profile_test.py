@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+u"""
+####################################
+Unit tests for :mod:`kajiki.profile`
+####################################
+"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from kajiki import XMLTemplate
+from kajiki.profile import TemplateProfiler, active
+from kajiki.template import TplFunc
+
+SOURCE = (u'<table>\n<py:def function="cell(value)"><td>${value}</td></py:def>\n'
+          u'<tr py:for="value in range(3)">${cell(value)}</tr>\n</table>')
+OUTPUT = u'<table>\n\n<tr><td>0</td></tr><tr><td>1</td></tr><tr><td>2</td></tr>\n</table>'
+
+
+def with_profiling(test):
+    u"""Calls the ``test`` with profiling switched on and switches it off
+    afterwards."""
+    def wrapper():
+        TplFunc.profiling = True
+        try:
+            test()
+        finally:
+            TplFunc.profiling = False
+    wrapper.__name__ = test.__name__
+    wrapper.__doc__ = test.__doc__
+    return wrapper
+
+
+@with_profiling
+def profiler_test():
+    u"""Test that the :class:`~kajiki.profile.TemplateProfiler` records the
+    calls of the template functions and the template lines they yield
+    from, without changing the output."""
+    template = XMLTemplate(SOURCE, filename='test.html')
+    with TemplateProfiler() as profiler:
+        ok_(active() is profiler)
+        eq_(OUTPUT, template().render())
+    eq_(None, active())
+    eq_({'__main__': 1, 'cell': 3}, dict((name, calls) for (filename, _, name), (calls, _)
+                                         in profiler.functions.items()))
+    eq_(set(['test.html']), set(filename for filename, _ in profiler.lines))
+    ok_(sum(count for count, _ in profiler.lines.values()) > 3)
+    ok_(profiler.elapsed > 0)
+
+
+@with_profiling
+def inactive_profiler_test():
+    u"""Test that nothing is recorded if profiling is switched off or no
+    profiler is active."""
+    template = XMLTemplate(SOURCE, filename='test.html')
+    eq_(OUTPUT, template().render())
+    TplFunc.profiling = False
+    with TemplateProfiler() as profiler:
+        eq_(OUTPUT, template().render())
+    eq_({}, profiler.functions)
+    eq_({}, profiler.lines)
+
+
+@with_profiling
+def report_test():
+    u"""Test that :meth:`~kajiki.profile.TemplateProfiler.report` lists the
+    functions and lines that took the most time, limited to ``limit``
+    entries each."""
+    template = XMLTemplate(SOURCE, filename='test.html')
+    with TemplateProfiler() as profiler:
+        template().render()
+    report = profiler.report().split('\n')
+    ok_(re.match(r'^Total: \d+\.\d\d ms$', report[0]))
+    eq_(['ms', 'calls', 'function'], report[1].split())
+    header = [line.split() for line in report].index(['ms', 'yields', 'line'])
+    functions = report[2:header]
+    eq_(2, len(functions))
+    for line in functions:
+        ok_(re.match(r'^ +\d+\.\d\d +\d+  test\.html:\d+\((__main__|cell)\)$', line), line)
+    lines = report[header + 1:]
+    eq_(len(profiler.lines), len(lines))
+    for line in lines:
+        ok_(re.match(r'^ +\d+\.\d\d +\d+  test\.html:\d+$', line), line)
+    times = [float(line.split()[0]) for line in functions]
+    eq_(sorted(times, reverse=True), times)
+    eq_(5, len(profiler.report(limit=1).split('\n')))
+
+
+class ListHandler(logging.Handler):
+    u"""A logging handler that stores the formatted messages."""
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ProfiledRequest(object):
+    u"""A request that only provides the path."""
+    path_qs = '/profiled?page=1'
+
+
+def loader_profile_test():
+    u"""Test that the :class:`~kajiki.integration.pyramid.PyramidKajikiLoader`
+    logs a profile report for each render if profiling is enabled."""
+    from kajiki.integration.pyramid import PyramidKajikiLoader
+
+    directory = tempfile.mkdtemp()
+    handler = ListHandler()
+    logger = logging.getLogger('kajiki.profile')
+    logger.addHandler(handler)
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        path = os.path.join(directory, 'test.kajiki')
+        with open(path, 'w') as out_file:
+            out_file.write(SOURCE)
+        loader = PyramidKajikiLoader(mode='xml', profile=True)
+        eq_(OUTPUT, loader({}, {'renderer_name': path, 'request': ProfiledRequest()}))
+        eq_(1, len(handler.messages))
+        ok_(handler.messages[0].startswith('Rendered %s for /profiled?page=1\nTotal: ' % path))
+        ok_('(cell)' in handler.messages[0])
+    finally:
+        TplFunc.profiling = False
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        shutil.rmtree(directory)
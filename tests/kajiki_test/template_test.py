@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+u"""
+#####################################
+Unit tests for :mod:`kajiki.template`
+#####################################
+"""
+from nose.tools import eq_, ok_
+
+from kajiki import MockLoader, XMLTemplate
+from kajiki.template import _Template
+from kajiki.util import flattener, literal
+
+
+def extends_loader():
+    u"""Returns a :class:`~kajiki.loader.MockLoader` with a chain of
+    templates that extend each other."""
+    return MockLoader({
+        'base.html': XMLTemplate(u'<div><py:block name="title">base title</py:block> '
+                                 u'<py:block name="content">base content</py:block></div>'),
+        'middle.html': XMLTemplate(u'<py:extends href="base.html">'
+                                   u'<py:block name="title">middle title</py:block></py:extends>'),
+        'child.html': XMLTemplate(u'<py:extends href="middle.html">'
+                                  u'<py:block name="content">child ${parent_block()}</py:block></py:extends>'),
+        'upper.html': XMLTemplate(u'<py:extends href="middle.html">'
+                                  u'<py:block name="title">upper ${parent_block()}</py:block></py:extends>'),
+        'grandchild.html': XMLTemplate(u'<py:extends href="upper.html">'
+                                       u'<py:block name="title">grandchild ${parent_block()}</py:block>'
+                                       u'<py:block name="content">grandchild ${parent_block()}</py:block>'
+                                       u'</py:extends>'),
+    })
+
+
+def parent_block_inherited_test():
+    u"""Test that ``parent_block()`` reaches a block that the parent template
+    inherits from its own parent."""
+    loader = extends_loader()
+    eq_(u'<div>middle title child base content</div>', loader.import_('child.html')().render())
+
+
+def parent_block_chain_test():
+    u"""Test ``parent_block()`` through four levels of ``py:extends``."""
+    loader = extends_loader()
+    eq_(u'<div>grandchild upper middle title grandchild base content</div>',
+        loader.import_('grandchild.html')().render())
+
+
+def parent_block_repeated_render_test():
+    u"""Test that rendering a template again gives the same result."""
+    loader = extends_loader()
+    template = loader.import_('child.html')
+    eq_(template().render(), template().render())
+
+
+class Html(str):
+    u"""A string that is already HTML, like :class:`markupsafe.Markup`."""
+
+    def __html__(self):
+        return self
+
+
+class Plain(str):
+    u"""A string subclass without ``__html__``."""
+
+
+class HtmlNumber(int):
+    u"""A number that renders itself as HTML."""
+
+    def __html__(self):
+        return u'<b>%i</b>' % self
+
+
+class HtmlObject(object):
+    u"""An object that renders itself as HTML."""
+
+    def __html__(self):
+        return u'<i>object</i>'
+
+
+class Flattened(flattener):
+    u"""A :class:`~kajiki.util.flattener` subclass."""
+
+
+def escape_test():
+    u"""Test that :meth:`~kajiki.template._Template._escape` escapes strings
+    and other values and that subclasses of ``str`` and ``int`` reach their
+    ``__html__`` method."""
+    escape = _Template._escape
+    eq_(u'&lt;a href=&quot;x&quot;&gt;&amp;\'', escape(u'<a href="x">&\''))
+    eq_(u'plain', escape(u'plain'))
+    eq_(u'<b>html</b>', escape(Html(u'<b>html</b>')))
+    eq_(u'&lt;b&gt;plain&lt;/b&gt;', escape(Plain(u'<b>plain</b>')))
+    eq_(u'42', escape(42))
+    eq_(u'<b>42</b>', escape(HtmlNumber(42)))
+    eq_(u'True', escape(True))
+    eq_(u'1.5', escape(1.5))
+    eq_(u'<i>object</i>', escape(HtmlObject()))
+    eq_(None, escape(None))
+    value = literal(u'<br/>')
+    ok_(escape(value) is value)
+    value = Flattened(iter([u'<br/>']))
+    ok_(escape(value) is value)
+
+
+def escape_render_test():
+    u"""Test that expressions and attributes are escaped the same way as by
+    :meth:`~kajiki.template._Template._escape` when rendering."""
+    template = XMLTemplate(u'<p title="${plain}">${html}${plain}${number}${html_number}${br}</p>')
+    eq_(u'<p title="&lt;p&gt;"><b>html</b>&lt;p&gt;7<b>8</b><br/></p>',
+        template({'html': Html(u'<b>html</b>'), 'plain': Plain(u'<p>'), 'number': 7,
+                  'html_number': HtmlNumber(8), 'br': literal(u'<br/>')}).render())
+
+
+def shared_globals_test():
+    u"""Test that the globals shared by all instances of a template are not
+    changed by rendering and that each instance only sees its own context."""
+    template = XMLTemplate(u'<p><py:def function="show()">${defined(\'x\')} ${value_of(\'x\', \'none\')}'
+                           u'</py:def>${show()}<py:with vars="y = 1">${y}</py:with></p>')
+    first = template({'x': u'first'})
+    second = template({})
+    eq_(u'<p>False none1</p>', second.render())
+    eq_(u'<p>True first1</p>', first.render())
+    eq_(u'<p>True third1</p>', template({'x': u'third'}).render())
+    shared = template._shared_globals()
+    ok_('x' not in shared)
+    ok_('y' not in shared)
+    ok_('show' not in shared)
+    ok_(first.show is not second.show)
+
+
+def shared_helpers_test():
+    u"""Test that imports, switches, and extends work when a template is
+    rendered repeatedly."""
+    loader = MockLoader({
+        'lib.html': XMLTemplate(u'<py:def function="greet(name)">Hello ${name}</py:def>'),
+        'page.html': XMLTemplate(u'<p><py:import href="lib.html" alias="lib"/>${lib.greet(who)}</p>'),
+        'base.html': XMLTemplate(u'<div><py:switch test="who"><py:case value="\'a\'">A</py:case>'
+                                 u'<py:else>other</py:else></py:switch> '
+                                 u'<py:block name="content">base</py:block></div>'),
+        'child.html': XMLTemplate(u'<py:extends href="base.html"><py:block name="content">child ${who}'
+                                  u'</py:block></py:extends>')})
+    page = loader.import_('page.html')
+    child = loader.import_('child.html')
+    for who, switched in [(u'a', u'A'), (u'b', u'other'), (u'a', u'A')]:
+        eq_(u'<p>Hello %s</p>' % who, page({'who': who}).render())
+        eq_(u'<div>%s child %s</div>' % (switched, who), child({'who': who}).render())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+u"""
+#################################
+Unit tests for :mod:`kajiki.util`
+#################################
+"""
+from nose.tools import eq_
+
+from kajiki import XMLTemplate
+from kajiki.util import flattener
+
+
+def nested(depth, leaf):
+    u"""Returns a :class:`~kajiki.util.flattener` that nests ``depth``
+    flatteners around the ``leaf`` chunk, with chunks before and after each
+    nested flattener."""
+    result = flattener(iter([leaf]))
+    for idx in range(depth):
+        result = flattener(iter([u'<%i>' % idx, None, result, u'</%i>' % idx]))
+    return result
+
+
+def accumulate_str_test():
+    u"""Test that :meth:`~kajiki.util.flattener.accumulate_str` joins the
+    chunks of nested flatteners in order and skips ``None``."""
+    eq_(u'<1><0>x</0></1>', nested(2, u'x').accumulate_str())
+    eq_(u'', flattener(iter([])).accumulate_str())
+    eq_(u'', flattener(iter([None, flattener(iter([None]))])).accumulate_str())
+    eq_(u'ab', flattener(flattener(iter([u'a', flattener(iter([])), u'b']))).accumulate_str())
+
+
+def accumulate_non_str_test():
+    u"""Test that :meth:`~kajiki.util.flattener.accumulate_str` converts
+    chunks that are not strings."""
+    eq_(u'a42b1.5', flattener(iter([u'a', 42, flattener(iter([u'b', 1.5]))])).accumulate_str())
+
+
+def deep_nesting_test():
+    u"""Test that deeply nested flatteners are flattened without recursion
+    and that iterating yields the same chunks."""
+    depth = 5000
+    expected = u''.join(u'<%i>' % idx for idx in reversed(range(depth))) + u'x' + \
+        u''.join(u'</%i>' % idx for idx in range(depth))
+    eq_(expected, nested(depth, u'x').accumulate_str())
+    eq_(expected, u''.join(nested(depth, u'x')))
+
+
+def render_nested_defs_test():
+    u"""Test that templates that nest ``py:def`` calls render the same way
+    when rendered and when iterated."""
+    template = XMLTemplate(u'<table><py:def function="cell(value)"><td>${value}</td></py:def>'
+                           u'<py:def function="row(values)"><tr><py:for each="value in values">${cell(value)}'
+                           u'</py:for></tr></py:def><py:for each="values in rows">${row(values)}</py:for>'
+                           u'<caption title="${cell(1)}">${None}</caption></table>')
+    instance = template({'rows': [[1, u'<b>'], [None, 2.5]]})
+    eq_(u'<table><tr><td>1</td><td>&lt;b&gt;</td></tr><tr><td></td><td>2.5</td></tr>'
+        u'<caption title="&lt;td&gt;1&lt;/td&gt;"></caption></table>', instance.render())
+    eq_(instance.render(), u''.join(template({'rows': [[1, u'<b>'], [None, 2.5]]})))
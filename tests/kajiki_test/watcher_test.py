@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+u"""
+####################################
+Unit tests for :mod:`kajiki.watcher`
+####################################
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import eq_, ok_
+
+from kajiki import MockLoader, XMLTemplate
+from kajiki.watcher import InotifyWatcher, PollingWatcher, _libc_inotify, watcher
+
+
+def with_directory(test):
+    u"""Calls the ``test`` with a temporary directory, which is removed
+    afterwards."""
+    def wrapper():
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    wrapper.__name__ = test.__name__
+    wrapper.__doc__ = test.__doc__
+    return wrapper
+
+
+def write(filename, text):
+    u"""Writes the ``text`` to the file ``filename``."""
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def wait_for(condition, timeout=5):
+    u"""Waits until the ``condition`` returns ``True`` or the ``timeout``
+    has passed and returns the result of the ``condition``."""
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def check_watcher(directory, create):
+    u"""Checks that the watcher returned by ``create`` reports changes to the
+    watched files only, including files that are replaced."""
+    changed = []
+    watched = os.path.join(directory, 'watched.html')
+    other = os.path.join(directory, 'other.html')
+    write(watched, u'first')
+    write(other, u'first')
+    file_watcher = create(changed.append)
+    file_watcher.watch(watched)
+    time.sleep(0.1)
+    write(other, u'second')
+    write(watched, u'second')
+    ok_(wait_for(lambda: watched in changed))
+    eq_(set([watched]), set(changed))
+    del changed[:]
+    write(other + '.tmp', u'third')
+    os.utime(other + '.tmp', (time.time() + 10, time.time() + 10))
+    os.rename(other + '.tmp', watched)
+    ok_(wait_for(lambda: watched in changed))
+
+
+@with_directory
+def inotify_watcher_test(directory):
+    u"""Test that the :class:`~kajiki.watcher.InotifyWatcher` reports changed
+    files."""
+    libc = _libc_inotify()
+    if libc is None:  # pragma: no cover
+        return
+    ok_(isinstance(watcher(lambda filename: None), InotifyWatcher))
+    check_watcher(directory, lambda callback: InotifyWatcher(callback, libc))
+
+
+@with_directory
+def polling_watcher_test(directory):
+    u"""Test that the :class:`~kajiki.watcher.PollingWatcher` reports changed
+    files."""
+    check_watcher(directory, lambda callback: PollingWatcher(callback, 0.02))
+
+
+class CountingLoader(MockLoader):
+    u"""A :class:`~kajiki.loader.MockLoader` that counts the imports."""
+
+    def __init__(self, modules):
+        super(CountingLoader, self).__init__(modules)
+        self.imports = []
+
+    def import_(self, name, *args, **kwargs):
+        self.imports.append(name)
+        return super(CountingLoader, self).import_(name, *args, **kwargs)
+
+
+def loader_generation_test():
+    u"""Test that :meth:`~kajiki.loader.Loader.discard` removes the template
+    and changes the generation."""
+    loader = MockLoader({'base.html': XMLTemplate(u'<p>base</p>')})
+    eq_(0, loader.generation)
+    loader.discard('base.html')
+    eq_({}, loader.modules)
+    eq_(1, loader.generation)
+    loader.discard('missing.html')
+    eq_(2, loader.generation)
+
+
+def template_load_memo_test():
+    u"""Test that templates memoise the templates they extend until the
+    generation of the loader changes, unless imports are not cached."""
+    loader = CountingLoader({
+        'base.html': XMLTemplate(u'<div><py:block name="content">base</py:block></div>'),
+        'child.html': XMLTemplate(u'<py:extends href="base.html"><py:block name="content">child'
+                                  u'</py:block></py:extends>')})
+    child = loader.import_('child.html')
+    del loader.imports[:]
+    eq_(u'<div>child</div>', child().render())
+    eq_(u'<div>child</div>', child().render())
+    eq_(['base.html'], loader.imports)
+    loader.generation = loader.generation + 1
+    eq_(u'<div>child</div>', child().render())
+    eq_(['base.html', 'base.html'], loader.imports)
+    loader.cache_imports = False
+    child().render()
+    child().render()
+    eq_(4, len(loader.imports))
+
+
+@with_directory
+def reload_test(directory):
+    u"""Test that the :class:`~kajiki.integration.pyramid.PyramidKajikiLoader`
+    reloads changed templates and the templates that extend them."""
+    from kajiki.integration.pyramid import PyramidKajikiLoader
+
+    base = os.path.join(directory, 'base.kajiki')
+    child = os.path.join(directory, 'child.kajiki')
+    write(base, u'<div><py:block name="content">base</py:block> first</div>')
+    write(child, u'<py:extends href="%s"><py:block name="content">child</py:block></py:extends>' % base)
+    loader = PyramidKajikiLoader(auto_reload=True, mode='xml', reload_interval=0.02)
+    eq_(u'<div>base first</div>', loader.import_(base)().render())
+    child_template = loader.import_(child)
+    eq_(u'<div>child first</div>', child_template().render())
+    generation = loader.generation
+    write(base, u'<div><py:block name="content">base</py:block> second</div>')
+    ok_(wait_for(lambda: loader.generation != generation))
+    eq_(u'<div>base second</div>', loader.import_(base)().render())
+    ok_(loader.import_(child) is child_template)
+    eq_(u'<div>child second</div>', child_template().render())
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+u"""
+#########################################
+Unit tests for :mod:`kajiki.xml_template`
+#########################################
+"""
+from nose.tools import eq_, ok_
+from xml.sax import SAXParseException
+
+from kajiki import XMLTemplate
+
+
+def render(source, mode=None):
+    u"""Compiles and renders the ``source``."""
+    return XMLTemplate(source, mode=mode)().render()
+
+
+def parse_error(source):
+    u"""Returns the :class:`~xml.sax.SAXParseException` raised when compiling
+    the ``source``."""
+    try:
+        XMLTemplate(source, filename='test.html')
+    except SAXParseException as e:
+        return e
+    ok_(False, 'Must not reach this line')
+
+
+def entities_test():
+    u"""Test that HTML entities are resolved in text and attribute values,
+    while XML entities and character references keep working."""
+    eq_(u'<p>a—b\xa0c &amp; &lt; \xa9 \xa9</p>', render(u'<p>a&mdash;b&nbsp;c &amp; &lt; &copy; &#169;</p>'))
+    eq_(u'<p title="a—b &amp; &lt; …">x</p>', render(u'<p title="a&mdash;b &amp; &lt; &hellip;">x</p>'))
+    eq_(u'<!DOCTYPE html><div>…</div>', render(u'<!DOCTYPE html>\n<div>&hellip;</div>', mode='html5'))
+    eq_(u'<p>no entities</p>', render(u'<p>no entities</p>'))
+
+
+def cdata_entities_test():
+    u"""Test that entities in CDATA sections are not resolved."""
+    eq_(u'<!DOCTYPE html><script>a &amp;&mdash; b</script>',
+        render(u'<script><![CDATA[a &amp;&mdash; b]]></script>', mode='html5'))
+
+
+def undefined_entity_test():
+    u"""Test that unknown entities raise an error at their position."""
+    error = parse_error(u'<div>\n  <p>a &nosuch; b</p></div>')
+    eq_(u'test.html:2:7: undefined entity &nosuch;', str(error))
+    eq_((2, 7), (error.getLineNumber(), error.getColumnNumber()))
+    eq_('test.html', error.getSystemId())
+
+
+def error_position_test():
+    u"""Test that XML errors report the line and column in the template,
+    including templates that start with a doctype."""
+    error = parse_error(u'<div>\n<p>\n</div>')
+    eq_(u'test.html:3:2: mismatched tag', str(error))
+    error = parse_error(u'<!DOCTYPE html>\n<div>\n<p></div>')
+    eq_((3, 5), (error.getLineNumber(), error.getColumnNumber()))
+    error = parse_error(u'<div>\n  <p>&nosuch;</p>\n</div>')
+    eq_((2, 5), (error.getLineNumber(), error.getColumnNumber()))
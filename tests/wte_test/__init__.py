@@ -8,7 +8,16 @@ This module also contains some generic objects for use in testing the WTE.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from urllib import urlencode
+import os
+import tempfile
+
+from pywebtools.sqlalchemy import DBSession
+from sqlalchemy import create_engine
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
 
 
 class TestRequest(object):
@@ -58,3 +67,26 @@ class TestSession(object):
                 self.queues[queue] = [message]
         else:
             self.queues[''] = message
+
+
+DB_FILE = None
+
+
+def setup_database():
+    u"""Creates an empty database in a temporary file. A file is used, as
+    asset data is fetched using separate connections."""
+    global DB_FILE
+    from wte.models import Base
+
+    handle, DB_FILE = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    DBSession.configure(bind=create_engine('sqlite:///%s' % DB_FILE))
+    Base.metadata.create_all(DBSession.get_bind())
+
+
+def teardown_database():
+    u"""Removes the temporary database."""
+    engine = DBSession.get_bind()
+    DBSession.remove()
+    engine.dispose()
+    os.unlink(DB_FILE)
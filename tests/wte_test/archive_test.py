@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+u"""
+#################################
+Unit tests for :mod:`wte.archive`
+#################################
+"""
+import hashlib
+import io
+import transaction
+import zipfile
+import zlib
+
+from nose.tools import eq_, ok_, with_setup
+from pywebtools.sqlalchemy import DBSession
+
+from wte_test import setup_database, teardown_database
+
+
+def entry_cache_test():
+    u"""Test that the :class:`~wte.archive.EntryCache` removes the least
+    recently used entries and does not cache large entries."""
+    from wte.archive import EntryCache, compress_data
+
+    cache = EntryCache(8 * 10)
+    entries = [compress_data((b'%i' % idx) * 10, 0) for idx in range(9)]
+    for idx in range(8):
+        cache.put(idx, entries[idx])
+    eq_(entries[0], cache.get(0))
+    cache.put(8, entries[8])
+    eq_(None, cache.get(1))
+    eq_(entries[0], cache.get(0))
+    eq_(entries[8], cache.get(8))
+    cache.put(9, compress_data(b'x' * 11, 0))
+    eq_(None, cache.get(9))
+    eq_(80, cache.size)
+
+
+def zip_entries():
+    u"""Returns archive entries of all supported data types."""
+    from wte.archive import ZIP_DEFLATED, ZIP_STORED, compress_data
+
+    return [('stored.txt', b'stored' * 10, ZIP_STORED),
+            ('deflated.txt', u'deflated \xfc' * 50, ZIP_DEFLATED),
+            (u'empty \xfc.txt', None, ZIP_STORED),
+            ('compressed.txt', compress_data(b'compressed' * 30, ZIP_DEFLATED), ZIP_STORED),
+            ('chunked.txt', [b'chunk', b'ed'], ZIP_DEFLATED)]
+
+
+def check_archive(data):
+    u"""Checks that the archive ``data`` contains the :func:`zip_entries`
+    and returns the :class:`~zipfile.ZipFile`."""
+    from wte.archive import ZIP_DEFLATED, ZIP_STORED, directory_info
+
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    eq_(None, archive.testzip())
+    eq_([('stored.txt', ZIP_STORED), ('deflated.txt', ZIP_DEFLATED), (u'empty \xfc.txt', ZIP_STORED),
+         ('compressed.txt', ZIP_DEFLATED), ('chunked.txt', ZIP_DEFLATED)],
+        [(info.filename, info.compress_type) for info in archive.infolist()])
+    eq_(b'stored' * 10, archive.read('stored.txt'))
+    eq_((u'deflated \xfc' * 50).encode('utf-8'), archive.read('deflated.txt'))
+    eq_(b'', archive.read(u'empty \xfc.txt'))
+    eq_(b'compressed' * 30, archive.read('compressed.txt'))
+    eq_(b'chunked', archive.read('chunked.txt'))
+    eq_(5, directory_info(io.BytesIO(data))[0])
+    return archive
+
+
+def zip_stream_test():
+    u"""Test that :func:`~wte.archive.zip_stream` generates archives with
+    stored and deflated entries that :mod:`zipfile` can read."""
+    from wte.archive import zip_stream
+
+    data = b''.join(zip_stream(zip_entries(), chunk_size=16))
+    archive = check_archive(data)
+    eq_([20] * 5, [info.extract_version for info in archive.infolist()])
+    ok_(b'PK\006\006' not in data)
+
+
+def zip_stream_zip64_test():
+    u"""Test that :func:`~wte.archive.zip_stream` uses the ZIP64 extensions
+    for entries, sizes, and offsets above the limit."""
+    from wte import archive
+
+    limit = archive.ZIP64_LIMIT
+    archive.ZIP64_LIMIT = 10
+    try:
+        data = b''.join(archive.zip_stream(zip_entries(), chunk_size=16))
+    finally:
+        archive.ZIP64_LIMIT = limit
+    zip_archive = check_archive(data)
+    eq_([45] * 5, [info.extract_version for info in zip_archive.infolist()])
+    ok_(b'PK\006\006' in data)
+    ok_(b'PK\006\007' in data)
+
+
+def create_assets(*data):
+    u"""Creates an asset for each of the (data, etag) pairs and returns their
+    ids."""
+    from wte.models import Asset
+
+    dbsession = DBSession()
+    with transaction.manager:
+        assets = [Asset(filename='asset%i.css' % idx, mimetype='text/css', type='asset', order=1, data=value,
+                        etag=etag) for idx, (value, etag) in enumerate(data)]
+        dbsession.add_all(assets)
+        dbsession.flush()
+        return [asset.id for asset in assets]
+
+
+def entry_data(asset_id, etag, size):
+    u"""Returns the uncompressed data of the archive entry of the asset."""
+    from wte.archive import asset_entries
+
+    ((filename, entry, _),) = list(asset_entries({asset_id: ('text/css', etag, size, ['asset.css'])}))
+    return zlib.decompress(entry.data, -15)
+
+
+@with_setup(setup_database, teardown_database)
+def asset_entries_cache_test():
+    u"""Test that :func:`~wte.archive.asset_entries` caches the compressed data
+    of assets whose etag matches their data and does not use it for another
+    asset with the same etag."""
+    from wte import archive
+
+    archive.init({})
+    etag = hashlib.sha512(b'first').hexdigest()
+    first_id, other_id = create_assets((b'first', etag), (b'other', etag))
+    eq_(b'first', entry_data(first_id, etag, 5))
+    eq_(1, len(archive.ENTRY_CACHE._entries))
+    eq_(b'other', entry_data(other_id, etag, 5))
+    eq_(1, len(archive.ENTRY_CACHE._entries))
+    with transaction.manager:
+        DBSession().execute(archive.Asset.__table__.delete())
+    eq_(b'first', entry_data(first_id, etag, 5))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+u"""
+##############################
+Unit tests for :mod:`wte.jobs`
+##############################
+"""
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from nose.tools import eq_, ok_, with_setup
+from pyramid.httpexceptions import HTTPSeeOther
+from pywebtools.sqlalchemy import DBSession
+
+import wte_test
+from wte_test import TestRequest, setup_database, teardown_database
+from wte_test.views_part_test import create_module
+
+
+class MissingPart(object):
+    u"""A part that does not exist in the database."""
+    id = 999
+
+
+def with_queue(workers, timeout=600):
+    u"""Calls the test with an :class:`~wte.jobs.ArchiveQueue` with the given
+    number of ``workers``, which uses a temporary cache directory, a request,
+    and the module created by :func:`~wte_test.views_part_test.create_module`.
+    The queue and the cache directory are removed afterwards."""
+    def decorator(test):
+        def wrapper():
+            from wte.jobs import ArchiveQueue
+            from wte.models import Part
+
+            module_id, user = create_module()
+            cache_dir = tempfile.mkdtemp()
+            queue = ArchiveQueue({'sqlalchemy.url': 'sqlite:///%s' % wte_test.DB_FILE}, cache_dir,
+                                 workers=workers, timeout=timeout)
+            request = TestRequest(application_url='http://localhost', current_user=user)
+            try:
+                test(queue, request, DBSession().query(Part).get(module_id))
+            finally:
+                queue.shutdown()
+                shutil.rmtree(cache_dir)
+        wrapper.__name__ = test.__name__
+        wrapper.__doc__ = test.__doc__
+        return with_setup(setup_database, teardown_database)(wrapper)
+    return decorator
+
+
+def wait_for(queue, key, timeout=60):
+    u"""Polls the status of the job with the given ``key`` until it is no
+    longer pending and returns the status."""
+    end = time.time() + timeout
+    while queue.status(key)[0] == 'pending' and time.time() < end:
+        time.sleep(0.05)
+    return queue.status(key)
+
+
+def check_markers(queue):
+    u"""Checks the status reported for the marker files written by jobs that
+    were started by other processes."""
+    eq_((None, None), queue.status('export-1-other'))
+    with open(queue.path('export-1-other', '.pending'), 'w'):
+        pass
+    eq_(('pending', None), queue.status('export-1-other'))
+    os.utime(queue.path('export-1-other', '.pending'), (time.time() - 700, time.time() - 700))
+    eq_(('failed', 'The archive could not be created in time'), queue.status('export-1-other'))
+
+
+def check_resubmit(queue, request, part):
+    u"""Checks that :func:`~wte.views.part.archive_response` submits a failed
+    job again for POST requests."""
+    from wte import jobs
+    from wte.views.part import archive_key, archive_response
+
+    key = archive_key(DBSession(), request, 'export', part)
+    with open(queue.path(key, '.error'), 'w') as out_file:
+        out_file.write('Broken')
+    eq_(('failed', 'Broken'), queue.status(key))
+    request.method = 'POST'
+    request.matched_route = TestRequest(name='part.archive')
+    jobs.QUEUE = queue
+    try:
+        archive_response(request, part, 'export')
+        ok_(False, 'Must not reach this line')
+    except HTTPSeeOther as e:
+        eq_('http://part.archive', e.location)
+    finally:
+        jobs.QUEUE = None
+    eq_('ready', wait_for(queue, key)[0])
+    ok_(not os.path.exists(queue.path(key, '.error')))
+
+
+@with_queue(workers=0)
+def inline_queue_test(queue, request, part):
+    u"""Test that an :class:`~wte.jobs.ArchiveQueue` without worker processes
+    builds the archives when they are submitted and records failed jobs."""
+    queue.submit('export-1-a', 'export', request, part)
+    eq_(('ready', queue.path('export-1-a')), queue.status('export-1-a'))
+    ok_(os.path.exists(queue.path('export-1-a', '.sha256')))
+    queue.submit('export-999-a', 'export', request, MissingPart())
+    status, message = queue.status('export-999-a')
+    eq_('failed', status)
+    ok_(message)
+    ok_(not os.path.exists(queue.path('export-999-a', '.pending')))
+    check_markers(queue)
+    check_resubmit(queue, request, part)
+    queue.submit('export-1-b', 'export', request, part)
+    ok_(os.path.exists(queue.path('export-1-b')))
+    ok_(not os.path.exists(queue.path('export-1-a')))
+    ok_(not os.path.exists(queue.path('export-1-a', '.sha256')))
+
+
+@with_queue(workers=1)
+def worker_queue_test(queue, request, part):
+    u"""Test that an :class:`~wte.jobs.ArchiveQueue` with one worker process
+    reports jobs as pending until they are ready or have failed."""
+    queue.submit('export-1-a', 'export', request, part)
+    eq_(('pending', None), queue.status('export-1-a'))
+    eq_(('ready', queue.path('export-1-a')), wait_for(queue, 'export-1-a'))
+    queue.submit('export-999-a', 'export', request, MissingPart())
+    status, message = wait_for(queue, 'export-999-a')
+    eq_('failed', status)
+    ok_(message)
+    check_markers(queue)
+    check_resubmit(queue, request, part)
+
+
+@with_queue(workers=1, timeout=2)
+def timeout_test(queue, request, part):
+    u"""Test that a job that takes longer than the timeout is recorded as
+    failed when its status is requested, that the worker process is stopped
+    and replaced, and that the other jobs are run by the new worker
+    process."""
+    queue.submit('export-1-slow', 'export', request, part)
+    executor = queue._executor
+    processes = list(executor._processes.values())
+    for process in processes:
+        os.kill(process.pid, signal.SIGSTOP)
+    time.sleep(1)
+    queue.submit('export-1-waiting', 'export', request, part)
+    eq_(('pending', None), queue.status('export-1-slow'))
+    eq_(('failed', 'The archive could not be created in time'), wait_for(queue, 'export-1-slow'))
+    ok_(queue._executor is not executor)
+    eq_(('ready', queue.path('export-1-waiting')), wait_for(queue, 'export-1-waiting'))
+    ok_(queue._executor is not None)
+    ok_(queue._executor is not executor)
+    for process in processes:
+        process.join(5)
+        ok_(not process.is_alive())
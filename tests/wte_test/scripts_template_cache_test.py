@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+u"""
+################################################
+Unit tests for :mod:`wte.scripts.template_cache`
+################################################
+"""
+import os
+import shutil
+import tempfile
+
+from argparse import Namespace
+from nose.tools import eq_, ok_
+
+OPTIONS = ('xml', 'html5', False, None, True)
+
+
+def with_templates(test):
+    u"""Calls the ``test`` with a temporary directory that contains a
+    ``templates`` directory with two templates and a file that is not a
+    template and a ``broken`` directory with a template that cannot be
+    compiled. The directory is removed afterwards."""
+    def wrapper():
+        directory = tempfile.mkdtemp()
+        try:
+            for filename, text in [('templates/page.kajiki', u'<p>Page ${1 + 1}</p>'),
+                                   ('templates/sub/part.kajiki', u'<div>Part</div>'),
+                                   ('templates/notes.txt', u'<p>Not a template'),
+                                   ('broken/broken.kajiki', u'<p>Broken')]:
+                path = os.path.join(directory, filename)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as out_file:
+                    out_file.write(text)
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    wrapper.__name__ = test.__name__
+    wrapper.__doc__ = test.__doc__
+    return wrapper
+
+
+def source(path):
+    u"""Returns the source of the template at ``path``."""
+    with open(path) as in_file:
+        return in_file.read()
+
+
+def write_configuration(directory, clear=False):
+    u"""Writes a configuration file that caches the templates in the
+    ``directory`` and returns the arguments for
+    :func:`~wte.scripts.template_cache.compile_templates`."""
+    configuration = os.path.join(directory, 'test.ini')
+    with open(configuration, 'w') as out_file:
+        out_file.write(u'[app:main]\nuse = call:wte:main\nkajiki.cache_dir = %s\nkajiki.packages = %s %s\n' %
+                       (os.path.join(directory, 'cache'), os.path.join(directory, 'templates'),
+                        os.path.join(directory, 'broken')))
+    return Namespace(configuration=configuration, clear=clear)
+
+
+@with_templates
+def find_templates_test(directory):
+    u"""Test that :func:`~kajiki.integration.pyramid.find_templates` finds the
+    templates in all sub-directories in a stable order."""
+    from kajiki.integration.pyramid import find_templates
+
+    templates = os.path.join(directory, 'templates')
+    eq_([os.path.join(templates, 'page.kajiki'), os.path.join(templates, 'sub', 'part.kajiki')],
+        list(find_templates(templates)))
+    eq_([os.path.join(templates, 'notes.txt')], list(find_templates(templates, ['.txt'])))
+    ok_(len(list(find_templates('wte:templates'))) > 0)
+
+
+@with_templates
+def compile_templates_test(directory):
+    u"""Test that :func:`~wte.scripts.template_cache.compile_templates` stores
+    all templates that can be compiled in the template cache, including the
+    application's templates, and that it clears the cache first if requested."""
+    from kajiki.cache import BytecodeCache
+    from kajiki.integration.pyramid import find_templates
+    from wte.scripts.template_cache import compile_templates
+
+    cache = BytecodeCache(os.path.join(directory, 'cache'))
+    cache.store('other.kajiki', u'<p>Other</p>', OPTIONS, (None,))
+    compile_templates(write_configuration(directory))
+    for path in [os.path.join(directory, 'templates', 'page.kajiki'),
+                 os.path.join(directory, 'templates', 'sub', 'part.kajiki')] + list(find_templates('wte:templates')):
+        ok_(cache.load(path, source(path), OPTIONS) is not None, path)
+    broken = os.path.join(directory, 'broken', 'broken.kajiki')
+    eq_(None, cache.load(broken, source(broken), OPTIONS))
+    count = len(os.listdir(cache.directory))
+    eq_(len(list(find_templates('wte:templates'))) + 3, count)
+    compile_templates(write_configuration(directory, clear=True))
+    eq_(count - 1, len(os.listdir(cache.directory)))
+
+
+@with_templates
+def preload_test(directory):
+    u"""Test that :meth:`~kajiki.integration.pyramid.PyramidKajikiLoader.preload`
+    loads all templates."""
+    from kajiki.integration.pyramid import PyramidKajikiLoader
+
+    loader = PyramidKajikiLoader(mode='html5')
+    eq_(2, loader.preload([os.path.join(directory, 'templates')]))
+    page = os.path.join(directory, 'templates', 'page.kajiki')
+    eq_(set([page, os.path.join(directory, 'templates', 'sub', 'part.kajiki')]), set(loader.modules))
+    eq_(u'<!DOCTYPE html><p>Page 2', loader.modules[page]().render())
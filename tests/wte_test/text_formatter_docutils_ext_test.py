@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+u"""
+#####################################################
+Unit tests for :mod:`wte.text_formatter.docutils_ext`
+#####################################################
+"""
+from nose.tools import eq_, ok_
+
+
+class CountingLexer(object):
+    u"""Wraps a :class:`~pygments.lexer.Lexer` and counts how often it is used
+    to highlight."""
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.options = lexer.options
+        self.count = 0
+
+    def get_tokens(self, text):
+        self.count = self.count + 1
+        return self.lexer.get_tokens(text)
+
+
+def highlight_cache_hit_test():
+    u"""Test that the :class:`~wte.text_formatter.docutils_ext.HighlightCache`
+    only highlights the same code once."""
+    from wte.text_formatter.docutils_ext import HighlightCache, get_formatter, get_lexer
+
+    cache = HighlightCache()
+    lexer = CountingLexer(get_lexer('python'))
+    formatter = get_formatter(nowrap=True)
+    first = cache.highlight(u'print("Hello")', 'python', lexer, formatter)
+    ok_('Hello' in first)
+    eq_(first, cache.highlight(u'print("Hello")', 'python', lexer, formatter))
+    eq_(1, lexer.count)
+    cache.highlight(u'print("World")', 'python', lexer, formatter)
+    eq_(2, lexer.count)
+
+
+def highlight_cache_key_test():
+    u"""Test that the :class:`~wte.text_formatter.docutils_ext.HighlightCache`
+    keys the entries by the language and the lexer and formatter options."""
+    from wte.text_formatter.docutils_ext import HighlightCache, get_formatter, get_lexer
+
+    cache = HighlightCache()
+    code = u'  print("Hello")\n\n'
+    plain = cache.highlight(code, 'python', get_lexer('python'), get_formatter(nowrap=True))
+    stripped = cache.highlight(code, 'python', get_lexer('python', {'stripall': True}), get_formatter(nowrap=True))
+    ok_(plain != stripped)
+    text = cache.highlight(code, 'text', get_lexer('text'), get_formatter(nowrap=True))
+    ok_(text not in (plain, stripped))
+    block = cache.highlight(code, 'python', get_lexer('python'), get_formatter(linenos=False))
+    numbered = cache.highlight(code, 'python', get_lexer('python'), get_formatter(linenos='inline'))
+    ok_(block != numbered)
+    eq_(5, len(cache._entries))
+
+
+def highlight_cache_eviction_test():
+    u"""Test that the :class:`~wte.text_formatter.docutils_ext.HighlightCache`
+    evicts the least recently used entries."""
+    from wte.text_formatter.docutils_ext import HighlightCache, get_formatter, get_lexer
+
+    cache = HighlightCache(max_size=2)
+    lexer = CountingLexer(get_lexer('python'))
+    formatter = get_formatter(nowrap=True)
+    cache.highlight(u'a = 1', 'python', lexer, formatter)
+    cache.highlight(u'b = 2', 'python', lexer, formatter)
+    cache.highlight(u'a = 1', 'python', lexer, formatter)
+    cache.highlight(u'c = 3', 'python', lexer, formatter)
+    eq_(3, lexer.count)
+    cache.highlight(u'a = 1', 'python', lexer, formatter)
+    eq_(3, lexer.count)
+    cache.highlight(u'b = 2', 'python', lexer, formatter)
+    eq_(4, lexer.count)
+    cache.resize(1)
+    eq_(1, len(cache._entries))
+    cache.resize(0)
+    cache.highlight(u'b = 2', 'python', lexer, formatter)
+    eq_(5, lexer.count)
+    eq_(0, len(cache._entries))
+
+
+def code_role_test():
+    u"""Test that ``code-language_name`` roles are highlighted for languages
+    that Pygments knows and remain unknown roles for other languages."""
+    from docutils.parsers.rst import roles
+    from wte.text_formatter import compile_rst, docutils_ext
+
+    docutils_ext.init({})
+    body, _ = compile_rst(u'Call :code-python:`print("Hello")` here', None)
+    ok_('<span class="source">' in body)
+    ok_('<span class="nb">print</span>' in body)
+    body, _ = compile_rst(u'Call :code-Python:`print("Hello")` here', None)
+    ok_('<span class="nb">print</span>' in body)
+    body, _ = compile_rst(u'.. default-role:: code-javascript\n\nCall `alert("Hello")` here', None)
+    ok_('<span class="source">alert' in body)
+    body, _ = compile_rst(u'Call :code-nosuchlanguage:`print("Hello")` here', None)
+    ok_('Unknown interpreted text role &quot;code-nosuchlanguage&quot;' in body)
+    ok_('code-nosuchlanguage' not in roles._roles)
+    ok_(roles.role is not None and roles.role.__module__ == 'docutils.parsers.rst.roles')
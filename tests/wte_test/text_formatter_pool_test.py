@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+u"""
+#############################################
+Unit tests for :mod:`wte.text_formatter.pool`
+#############################################
+"""
+import time
+
+from nose.tools import eq_, ok_
+
+from wte_test import TestRequest
+
+SETTINGS = {'sqlalchemy.url': 'sqlite://'}
+SLOW_TEXT = u'Paragraph *text*\n\n' * 60000
+
+
+def create_pool(**kwargs):
+    u"""Creates a :class:`~wte.text_formatter.pool.CompilerPool` that uses the
+    test settings."""
+    from wte.text_formatter.pool import CompilerPool
+
+    return CompilerPool(SETTINGS, **kwargs)
+
+
+def compile_test():
+    u"""Test that the :class:`~wte.text_formatter.pool.CompilerPool` compiles
+    text in a worker process and aborts jobs that exceed the CPU time limit."""
+    from wte.text_formatter.pool import CompilationError
+
+    pool = create_pool(workers=1, cpu_limit=1)
+    request = TestRequest(application_url='http://localhost')
+    try:
+        body, quizzes = pool.compile(u'Some *text*', request)
+        eq_(u'<p>Some <em>text</em></p>\n', body)
+        eq_([], quizzes)
+        try:
+            pool.compile(SLOW_TEXT, request)
+            ok_(False, 'Must not reach this line')
+        except CompilationError as e:
+            ok_(u'took more than 1 seconds' in e.message)
+        eq_(u'<p>Next</p>\n', pool.compile(u'Next', request)[0])
+        eq_({}, pool._pending)
+    finally:
+        pool.shutdown()
+
+
+def timeout_test():
+    u"""Test that a job that takes longer than the timeout from when it is
+    started stops and replaces the worker processes, releases the job's place
+    in the queue, and that the other jobs are compiled by the new worker
+    processes."""
+    from wte.text_formatter.pool import CompilationError
+
+    pool = create_pool(workers=1, queue_size=1, cpu_limit=0, timeout=1)
+    request = TestRequest(application_url='http://localhost')
+    try:
+        future = pool.submit(SLOW_TEXT, request)
+        waiting = pool.submit(u'Waiting', request)
+        executor = future.executor
+        processes = list(executor._processes.values())
+        start = time.time()
+        try:
+            pool.result(future)
+            ok_(False, 'Must not reach this line')
+        except CompilationError as e:
+            ok_(u'took more than 1 seconds' in e.message)
+        # Starting the worker process is not part of the timeout
+        ok_(time.time() - start >= 1)
+        ok_(future.job_id not in pool._pending)
+        for process in processes:
+            process.join(5)
+            ok_(not process.is_alive())
+        ok_(pool._executor is not executor)
+        eq_(u'<p>Waiting</p>\n', pool.result(waiting)[0])
+        eq_(u'<p>Next</p>\n', pool.compile(u'Next', request)[0])
+        eq_({}, pool._pending)
+    finally:
+        pool.shutdown()
+
+
+def queue_full_test():
+    u"""Test that jobs are rejected if too many jobs are waiting, except for
+    jobs that are not limited by the queue size."""
+    from wte.text_formatter.pool import CompilationError
+
+    pool = create_pool(workers=1, queue_size=1)
+    request = TestRequest(application_url='http://localhost')
+    try:
+        futures = [pool.submit(u'First', request), pool.submit(u'Second', request)]
+        try:
+            pool.submit(u'Third', request)
+            ok_(False, 'Must not reach this line')
+        except CompilationError as e:
+            ok_(u'busy' in e.message)
+        futures.append(pool.submit(u'Third', request, limit_queue=False))
+        eq_([u'<p>First</p>\n', u'<p>Second</p>\n', u'<p>Third</p>\n'],
+            [pool.result(future)[0] for future in futures])
+        eq_({}, pool._pending)
+        eq_(u'<p>Fourth</p>\n', pool.compile(u'Fourth', request)[0])
+    finally:
+        pool.shutdown()
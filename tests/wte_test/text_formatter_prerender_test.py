@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+u"""
+##################################################
+Unit tests for :mod:`wte.text_formatter.prerender`
+##################################################
+"""
+import hashlib
+import transaction
+
+from nose.tools import eq_, ok_, with_setup
+from pywebtools.sqlalchemy import DBSession
+
+from wte_test import TestRequest, TestSession, setup_database, teardown_database
+
+
+def inline_math_test():
+    u"""Test that inline TeX formulas are rendered into inline MathML."""
+    from wte.text_formatter.prerender import prerender, requires_typesetting
+
+    html = prerender(u'<p>The formula \\(a^2 + b^2\\) is inline.</p>')
+    ok_(html.startswith(u'<p>The formula <span class="math"><math'))
+    ok_(u'display="block"' not in html and u'mode="display"' not in html)
+    ok_(u'<msup>' in html)
+    ok_(html.endswith(u'</math></span> is inline.</p>'))
+    eq_(False, requires_typesetting(html))
+
+
+def block_math_test():
+    u"""Test that block TeX formulas in either notation are rendered into
+    block MathML."""
+    from wte.text_formatter.prerender import prerender, requires_typesetting
+
+    for source in [u'<p>\\[\\frac{1}{2}\\]</p>', u'<p>$$\\frac{1}{2}$$</p>']:
+        html = prerender(source)
+        ok_(html.startswith(u'<p><span class="math display"><math'))
+        # Older docutils versions use the MathML 2 "mode" attribute
+        ok_(u'display="block"' in html or u'mode="display"' in html)
+        ok_(u'<mfrac>' in html)
+        eq_(False, requires_typesetting(html))
+
+
+def math_skip_test():
+    u"""Test that formulas that cannot be parsed and formulas in code are not
+    rendered, and that entities in formulas are unescaped."""
+    from wte.text_formatter.prerender import prerender, requires_typesetting
+
+    eq_(u'<p>\\(\\nosuchcommand{x}\\)</p>', prerender(u'<p>\\(\\nosuchcommand{x}\\)</p>'))
+    eq_(True, requires_typesetting(u'<p>\\(\\nosuchcommand{x}\\)</p>'))
+    eq_(u'<pre>\\(x\\)</pre>', prerender(u'<pre>\\(x\\)</pre>'))
+    eq_(False, requires_typesetting(u'<pre>\\(x\\)</pre>'))
+    ok_(u'<mo>&lt;</mo>' in prerender(u'<p>\\(a &lt; b\\)</p>'))
+
+
+def create_page(image):
+    u"""Creates a module with the ``image`` and a page that shows the image
+    and returns the ids of the module, the image asset, and the page."""
+    from wte.models import Asset, Part
+
+    dbsession = DBSession()
+    with transaction.manager:
+        module = Part(type='module', title='Module', status='available', order=1, content='No image')
+        page = Part(type='page', title='Page', status='available', order=1, content=':asset:`image.png`')
+        module.children.append(page)
+        asset = Asset(filename='image.png', mimetype='image/png', type='asset', order=1, data=image,
+                      etag=hashlib.sha512(image).hexdigest())
+        module.all_assets.append(asset)
+        dbsession.add(module)
+        dbsession.flush()
+        return module.id, asset.id, page.id
+
+
+def compile_page(page_id):
+    u"""Compiles the content of the page and returns it."""
+    from wte.models import Part
+    from wte.text_formatter import compile_rst
+
+    page = DBSession().query(Part).get(page_id)
+    return compile_rst(page.content, TestRequest(), part=page)[0]
+
+
+@with_setup(setup_database, teardown_database)
+def inline_images_test():
+    u"""Test that images no larger than the "prerender.inline_images_max_size"
+    setting are embedded as data URIs and larger images are linked."""
+    from wte import text_formatter
+
+    _, _, page_id = create_page(b'small')
+    text_formatter.init({'compiler.workers': '0', 'prerender.inline_images_max_size': '5'})
+    try:
+        ok_(u'src="data:image/png;base64,c21hbGw="' in compile_page(page_id))
+        text_formatter.init({'compiler.workers': '0', 'prerender.inline_images_max_size': '4'})
+        ok_(u'src="http://asset.view"' in compile_page(page_id))
+    finally:
+        text_formatter.init({'compiler.workers': '0'})
+
+
+@with_setup(setup_database, teardown_database)
+def recompile_image_users_test():
+    u"""Test that :func:`~wte.views.part.recompile_image_users` updates the
+    data URIs of the parts that show a changed image."""
+    from pywebtools.pyramid.util import CACHED_SETTINGS
+    from wte import text_formatter
+    from wte.models import Asset, Part
+    from wte.views.part import recompile_image_users
+
+    settings = {'compiler.workers': '0', 'prerender.inline_images_max_size': '100'}
+    module_id, asset_id, page_id = create_page(b'first')
+    text_formatter.init(settings)
+    CACHED_SETTINGS.clear()
+    try:
+        request = TestRequest(registry=TestRequest(settings=settings), session=TestSession())
+        dbsession = DBSession()
+        with transaction.manager:
+            asset = dbsession.query(Asset).get(asset_id)
+            asset.data = b'second'
+            asset.etag = hashlib.sha512(asset.data).hexdigest()
+        recompile_image_users(request, module_id, ['image.png'])
+        page = dbsession.query(Part).get(page_id)
+        ok_(u'src="data:image/png;base64,c2Vjb25k"' in page.compiled_content)
+        eq_(None, dbsession.query(Part).get(module_id).compiled_content)
+        eq_({'': []}, request.session.queues)
+    finally:
+        text_formatter.init({'compiler.workers': '0'})
+        CACHED_SETTINGS.clear()
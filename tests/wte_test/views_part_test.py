@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+u"""
+####################################
+Unit tests for :mod:`wte.views.part`
+####################################
+"""
+import hashlib
+import json
+import os
+import tempfile
+import transaction
+
+from io import BytesIO
+from nose.tools import eq_, ok_, with_setup
+from pywebtools.sqlalchemy import DBSession
+from zipfile import ZipFile
+
+from wte_test import setup_database, teardown_database
+
+
+def create_module():
+    u"""Creates a module with a page and assets, and returns the module's id
+    and the user who owns it. The module's assets have the same size, but
+    different data, while the page's asset has the same data as one of the
+    module's assets."""
+    from wte.models import Asset, Part, User
+
+    dbsession = DBSession()
+    with transaction.manager:
+        user = User(email='owner@example.com', display_name='Owner', password='password')
+        module = Part(type='module', title='Module', status='available', order=1, display_mode='text_only',
+                      content='See :crossref:`2`')
+        page = Part(type='page', title='Page', status='available', order=1, content='A page')
+        module.children.append(page)
+        for part, filename, data in [(module, 'first.css', b'first'), (module, 'other.css', b'other'),
+                                     (page, 'copy.css', b'first')]:
+            part.all_assets.append(Asset(filename=filename, mimetype='text/css', type='asset', order=1,
+                                         data=data, etag=hashlib.sha512(data).hexdigest()))
+        dbsession.add(user)
+        dbsession.add(module)
+        dbsession.flush()
+        module_id = module.id
+    return module_id, dbsession.query(User).first()
+
+
+def assets_of(part):
+    u"""Returns the filename and data of the ``part``'s assets."""
+    return sorted((asset.filename, asset.data) for asset in part.assets)
+
+
+@with_setup(setup_database, teardown_database)
+def export_import_test():
+    u"""Test that a module exported by :func:`~wte.views.part.export_entries`
+    is imported by :func:`~wte.views.part.import_part` with all its parts
+    and assets."""
+    from wte.archive import zip_stream
+    from wte.models import Part
+    from wte.views.part import export_entries, import_part
+
+    module_id, user = create_module()
+    dbsession = DBSession()
+    module = dbsession.query(Part).get(module_id)
+    zip_file = ZipFile(BytesIO(b''.join(zip_stream(export_entries(None, module)))))
+    manifest = json.loads(zip_file.read('manifest.json').decode('utf-8'))
+    eq_(2, len(manifest['payloads']))
+    with transaction.manager:
+        imported_id, errors = import_part(dbsession, json.loads(zip_file.read('content.json').decode('utf-8')),
+                                          zip_file, None, user)
+    eq_([], errors)
+    module = dbsession.query(Part).get(module_id)
+    imported = dbsession.query(Part).get(imported_id)
+    eq_('Module', imported.title)
+    eq_(assets_of(module), assets_of(imported))
+    eq_(1, len(imported.children))
+    eq_('Page', imported.children[0].title)
+    eq_(assets_of(module.children[0]), assets_of(imported.children[0]))
+    eq_('See :crossref:`%i`' % imported.children[0].id, imported.content)
+
+
+@with_setup(setup_database, teardown_database)
+def update_test():
+    u"""Test that :func:`~wte.views.part.update_part` replaces the data of
+    the assets that differ from the exported data, including an asset whose
+    stored etag does not match its data."""
+    from wte.archive import zip_stream
+    from wte.models import Asset, Part
+    from wte.views.part import export_entries, update_part
+
+    module_id, _ = create_module()
+    dbsession = DBSession()
+    module = dbsession.query(Part).get(module_id)
+    zip_file = ZipFile(BytesIO(b''.join(zip_stream(export_entries(None, module)))))
+    data = json.loads(zip_file.read('content.json').decode('utf-8'))
+    with transaction.manager:
+        for asset in dbsession.query(Asset).filter(Asset.filename.in_(['first.css', 'copy.css'])):
+            asset.data = b'changed'
+            asset.etag = hashlib.sha512(asset.data).hexdigest()
+        dbsession.query(Asset).filter(Asset.filename == 'other.css').one().data = b'stale etag'
+    with transaction.manager:
+        module = dbsession.query(Part).get(module_id)
+        _, errors = update_part(dbsession, module, data, zip_file)
+    eq_([], errors)
+    module = dbsession.query(Part).get(module_id)
+    eq_([('first.css', b'first'), ('other.css', b'other')], assets_of(module))
+    eq_([('copy.css', b'first')], assets_of(module.children[0]))
+    for asset in dbsession.query(Asset):
+        eq_(hashlib.sha512(asset.data).hexdigest(), asset.etag)
+
+
+def convert_archive(entries, **settings):
+    u"""Creates a ZIP file with the ``entries`` and converts it using the
+    :class:`~wte.views.part.ImportPartConverter` with the import ``settings``.
+    Each entry is a (filename, data, compression type) ``tuple``."""
+    from pywebtools.formencode import State
+    from pywebtools.pyramid.util import CACHED_SETTINGS
+    from wte.views.part import ImportPartConverter
+    from wte_test import TestRequest
+
+    buffer = BytesIO()
+    with ZipFile(buffer, 'w') as zip_file:
+        for filename, data, compression in entries:
+            zip_file.writestr(filename, data, compression)
+    buffer.seek(0)
+    CACHED_SETTINGS.clear()
+    try:
+        request = TestRequest(registry=TestRequest(settings=dict([('import.%s' % key, str(value))
+                                                                  for key, value in settings.items()])))
+        return ImportPartConverter().to_python(TestRequest(file=buffer), State(parent=None, request=request))
+    finally:
+        CACHED_SETTINGS.clear()
+
+
+def import_limits_test():
+    u"""Test that the :class:`~wte.views.part.ImportPartConverter` rejects ZIP
+    files that exceed the import limits and accepts them if the limits are
+    raised."""
+    import formencode
+    from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+    content = ('content.json', json.dumps({'type': 'module', 'title': 'Module'}), ZIP_DEFLATED)
+    large = b'\0' * 2 * 1024 * 1024
+    nested = '{"type": "module", "title": "Module", "children": %s%s}' % ('[' * 40, ']' * 40)
+    padded = '{"type": "module", "title": "Module"%s}' % (' ' * 2 * 1024 * 1024)
+    for entries, limits, relaxed in [([content] + [('assets/%i' % idx, b'', ZIP_STORED) for idx in range(5)],
+                                      {'max_entries': 5}, {'max_entries': 6}),
+                                     ([content, ('assets/1', large, ZIP_DEFLATED)], {}, {'max_ratio': 10000}),
+                                     ([content, ('assets/1', large, ZIP_STORED)], {'max_size': 1}, {'max_size': 3}),
+                                     ([('content.json', nested, ZIP_DEFLATED)], {}, {'max_json_depth': 50}),
+                                     ([('content.json', padded, ZIP_STORED)], {'max_json_size': 1},
+                                      {'max_json_size': 3})]:
+        try:
+            convert_archive(entries, **limits)
+            ok_(False, 'Must not reach this line')
+        except formencode.Invalid:
+            pass
+        data, zip_file = convert_archive(entries, **relaxed)
+        eq_('Module', data['title'])
+        zip_file.close()
+
+
+class ReadCounter(object):
+    u"""Wraps a file and counts the bytes read from it."""
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.wrapped.read(size)
+        self.count = self.count + len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+
+def cached_archive_test():
+    u"""Test that :func:`~wte.views.part.cached_archive_response` answers
+    conditional and range requests and only reads the requested range."""
+    from webob import Request
+    from wte.views.part import cached_archive_response
+
+    data = os.urandom(200000)
+    checksum = hashlib.sha256(data).hexdigest()
+    handle, path = tempfile.mkstemp(suffix='.zip')
+    os.write(handle, data)
+    os.close(handle)
+
+    def get(**headers):
+        response = cached_archive_response(path, checksum, [('Content-Type', 'application/zip')])
+        response.app_iter.file = ReadCounter(response.app_iter.file)
+        counter = response.app_iter.file
+        return Request.blank('/', headers=headers).get_response(response), counter
+
+    try:
+        response, _ = get()
+        eq_(200, response.status_int)
+        eq_(data, response.body)
+        eq_(checksum, response.etag)
+        eq_('bytes', response.accept_ranges)
+        response, counter = get(Range='bytes=150000-150099')
+        eq_(206, response.status_int)
+        eq_(data[150000:150100], response.body)
+        eq_(100, counter.count)
+        response, counter = get(Range='bytes=-10', **{'If-Range': '"%s"' % checksum})
+        eq_(206, response.status_int)
+        eq_(data[-10:], response.body)
+        eq_(10, counter.count)
+        response, _ = get(Range='bytes=-10', **{'If-Range': '"changed"'})
+        eq_(200, response.status_int)
+        eq_(data, response.body)
+        response, _ = get(Range='bytes=300000-')
+        eq_(416, response.status_int)
+        response, _ = get(**{'If-None-Match': '"%s"' % checksum})
+        eq_(304, response.status_int)
+    finally:
+        os.unlink(path)
+
+
+@with_setup(setup_database, teardown_database)
+def update_images_test():
+    u"""Test that :func:`~wte.views.part.update_part` compiles the parts that
+    show a changed image if images are embedded."""
+    from wte.archive import zip_stream
+    from wte.models import Asset, Part
+    from wte.views.part import export_entries, update_part
+
+    module_id, _ = create_module()
+    dbsession = DBSession()
+    with transaction.manager:
+        module = dbsession.query(Part).get(module_id)
+        module.children[0].content = ':asset:`image.png`'
+        module.all_assets.append(Asset(filename='image.png', mimetype='image/png', type='asset', order=2,
+                                       data=b'image', etag=hashlib.sha512(b'image').hexdigest()))
+    module = dbsession.query(Part).get(module_id)
+    page_id = module.children[0].id
+    zip_file = ZipFile(BytesIO(b''.join(zip_stream(export_entries(None, module)))))
+    data = json.loads(zip_file.read('content.json').decode('utf-8'))
+    with transaction.manager:
+        dbsession.query(Asset).filter(Asset.filename == 'image.png').one().data = b'changed'
+    for inline_images, compiled in [(False, []), (True, [page_id])]:
+        with transaction.manager:
+            module = dbsession.query(Part).get(module_id)
+            compile_ids, errors = update_part(dbsession, module, data, zip_file, inline_images=inline_images)
+        eq_([], errors)
+        eq_(compiled, compile_ids)
+        with transaction.manager:
+            dbsession.query(Asset).filter(Asset.filename == 'image.png').one().data = b'changed'
+
+
+def create_download_module():
+    u"""Creates a module with three pages, the first of which is not available
+    and the last of which has a child page, and an owner and a student of the
+    module. Returns the module's id and the ids of the owner and the
+    student."""
+    from wte.models import Asset, Part, User, UserPartRole
+
+    dbsession = DBSession()
+    with transaction.manager:
+        owner = User(email='owner@example.com', display_name='Owner', password='password')
+        student = User(email='student@example.com', display_name='Student', password='password')
+        module = Part(type='module', title='Module', status='available', order=1, display_mode='text_only',
+                      content='Module', compiled_content='<p>Module</p>')
+        for idx in range(3):
+            module.children.append(Part(type='page', title='Page %i' % idx, order=idx, content='Page',
+                                        status='available' if idx > 0 else 'unavailable',
+                                        compiled_content='<p>Page %i</p>' % idx))
+        module.children[2].children.append(Part(type='page', title='Sub-page', status='available', order=1,
+                                                content='Sub-page', compiled_content='<p>Sub-page</p>'))
+        module.children[1].all_assets.append(Asset(filename='page.css', mimetype='text/css', type='asset',
+                                                   order=1, data=b'page', etag=hashlib.sha512(b'page').hexdigest()))
+        dbsession.add_all([owner, student, module,
+                           UserPartRole(user=owner, part=module, role='owner'),
+                           UserPartRole(user=student, part=module, role='student')])
+        dbsession.flush()
+        return module.id, owner.id, student.id
+
+
+def download_request(user_id):
+    u"""Returns a request for the user with the ``user_id``, which has a
+    registry that can render the download pages, and the function that
+    closes the request."""
+    from pyramid.config import Configurator
+    from pyramid.request import Request
+    from pyramid.scripting import prepare
+    from wte import views
+    from wte.models import User
+    from wte_test import DB_FILE
+
+    settings = {'sqlalchemy.url': 'sqlite:///%s' % DB_FILE}
+    config = Configurator(settings=settings)
+    config.include('kajiki.integration.pyramid')
+    views.init(config, settings)
+    config.commit()
+    request = Request.blank('/', base_url='http://localhost')
+    env = prepare(request=request, registry=config.registry)
+    request.current_user = DBSession().query(User).get(user_id)
+    request.current_user.logged_in = True
+    return request, env['closer']
+
+
+@with_setup(setup_database, teardown_database)
+def load_part_tree_test():
+    u"""Test that :func:`~wte.views.part.load_part_tree` loads the children
+    and templates of all parts, so that no queries are needed to access
+    them."""
+    from sqlalchemy import event
+    from wte.models import Part
+    from wte.views.part import get_all_parts, load_part_tree
+
+    module_id, _, _ = create_download_module()
+    dbsession = DBSession()
+    module = dbsession.query(Part).get(module_id)
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    engine = dbsession.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        parts = load_part_tree(dbsession, module)
+        loading = len(statements)
+        titles = [(part.title, [child.title for child in part.children], part.templates) for part in parts]
+        eq_(loading, len(statements))
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    eq_(['Module', 'Page 0', 'Page 1', 'Page 2', 'Sub-page'], [title for title, _, _ in titles])
+    eq_(['Page 0', 'Page 1', 'Page 2'], titles[0][1])
+    eq_(['Sub-page'], titles[3][1])
+    eq_([[]] * 5, [templates for _, _, templates in titles])
+    dbsession.expire_all()
+    eq_([part.id for part in get_all_parts(dbsession.query(Part).get(module_id))], [part.id for part in parts])
+
+
+@with_setup(setup_database, teardown_database)
+def download_entries_test():
+    u"""Test that :func:`~wte.views.part.download_entries` only includes the
+    parts that the user may view and their assets."""
+    from pywebtools.pyramid.util import CACHED_SETTINGS
+    from wte.archive import zip_stream
+    from wte.models import Part
+    from wte.views.part import download_entries
+
+    module_id, owner_id, student_id = create_download_module()
+    for user_id, titles in [(owner_id, ['Module', 'Page 0', 'Page 1', 'Page 2', 'Sub-page']),
+                            (student_id, ['Module', 'Page 1', 'Page 2', 'Sub-page'])]:
+        request, closer = download_request(user_id)
+        CACHED_SETTINGS.clear()
+        try:
+            module = DBSession().query(Part).get(module_id)
+            parts = dict((part.id, part.title) for part in [module] + module.children + module.children[2].children)
+            page_css = 'Module/%i/assets/page.css' % module.children[1].id
+            zip_file = ZipFile(BytesIO(b''.join(zip_stream(download_entries(request, module)))))
+        finally:
+            CACHED_SETTINGS.clear()
+            closer()
+        filenames = zip_file.namelist()
+        pages = [filename for filename in filenames if filename.endswith('.html') and filename != 'Module/index.html']
+        eq_(titles, sorted(parts[int(filename[7:-5])] for filename in pages))
+        ok_('Module/_static/application.min.css' in filenames)
+        eq_(b'page', zip_file.read(page_css))
+        module_page = zip_file.read('Module/%i.html' % module_id).decode('utf-8')
+        eq_(user_id == owner_id, 'Page 0' in module_page)
+        ok_('Page 1' in module_page)
+
+
+@with_setup(setup_database, teardown_database)
+def render_download_pages_test():
+    u"""Test that :func:`~wte.views.part.render_download_pages` renders the
+    same pages in the same order with one or more threads."""
+    from wte.models import Part
+    from wte.views.part import load_part_tree, render_download_pages
+
+    module_id, owner_id, _ = create_download_module()
+    request, closer = download_request(owner_id)
+    try:
+        dbsession = DBSession()
+        module = dbsession.query(Part).get(module_id)
+        parts = load_part_tree(dbsession, module)
+        pages = [(part.id, [parent.id for parent in [part.parent] if parent]) for part in parts]
+        visible = set(part.id for part in parts)
+        single = render_download_pages(request, module, pages, visible, 1)
+        eq_(5, len(single))
+        for part, body in zip(parts, single):
+            ok_(('<title>%s</title>' % part.title).encode('utf-8') in body)
+        eq_(single, render_download_pages(request, module, pages, visible, 3))
+        eq_(single, render_download_pages(request, module, pages, visible, 10))
+    finally:
+        closer()
+
+
+def import_archive():
+    u"""Returns the exported data and the archive of a module that uses the
+    old part types, refers to its parts by their exported ids, and has an
+    asset whose payload is missing and an asset whose payload does not match
+    its etag."""
+    good = hashlib.sha512(b'good').hexdigest()
+    bad = hashlib.sha512(b'bad').hexdigest()
+    data = {'id': 1, 'type': 'module', 'title': 'Module', 'content': 'See :crossref:`3` and :crossref:`99`',
+            'assets': [{'filename': 'good.css', 'mimetype': 'text/css', 'type': 'asset', 'order': 1,
+                        'etag': good},
+                       {'filename': 'missing.css', 'mimetype': 'text/css', 'type': 'asset', 'order': 2,
+                        'etag': hashlib.sha512(b'missing').hexdigest()}],
+            'children': [{'id': 2, 'type': 'tutorial', 'title': 'Tutorial', 'order': 1,
+                          'content': 'Next is :crossref:`4`',
+                          'children': [{'id': 3, 'type': 'task', 'title': 'Task', 'order': 1, 'content': 'Task',
+                                        'assets': [{'filename': 'copy.css', 'mimetype': 'text/css',
+                                                    'type': 'asset', 'order': 1, 'etag': good},
+                                                   {'filename': 'bad.css', 'mimetype': 'text/css',
+                                                    'type': 'asset', 'order': 2, 'etag': bad}]}]},
+                         {'id': 4, 'type': 'page', 'title': 'Page', 'order': 2, 'content': 'Back to :crossref:`1`'}]}
+    buffer = BytesIO()
+    with ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr('payloads/%s' % good, b'good')
+        zip_file.writestr('payloads/%s' % bad, b'changed')
+    buffer.seek(0)
+    return data, ZipFile(buffer)
+
+
+@with_setup(setup_database, teardown_database)
+def bulk_import_test():
+    u"""Test that :func:`~wte.views.part.import_part` inserts the whole tree
+    with its assets, links the assets in one statement, rewrites the
+    cross-references, reports the assets that cannot be read, and makes the
+    user the owner of an imported module only."""
+    from sqlalchemy import event
+    from wte.models import Asset, Part, User, UserPartRole
+    from wte.views.part import get_all_parts, import_part
+
+    _, user = create_module()
+    dbsession = DBSession()
+    user = dbsession.query(User).first()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = dbsession.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        with transaction.manager:
+            data, zip_file = import_archive()
+            module_id, errors = import_part(dbsession, data, zip_file, None, user)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    eq_(['The file "missing.css" could not be imported', 'The file "bad.css" could not be imported'], errors)
+    eq_(1, len([statement for statement in statements if statement.startswith('INSERT INTO parts_assets')]))
+    module = dbsession.query(Part).get(module_id)
+    tutorial, task, page = [part for part in get_all_parts(module)][1:]
+    eq_([('Module', 'module'), ('Tutorial', 'part'), ('Task', 'page'), ('Page', 'page')],
+        [(part.title, part.type) for part in [module, tutorial, task, page]])
+    eq_('See :crossref:`%i` and :crossref:`external`' % task.id, module.content)
+    eq_('Next is :crossref:`%i`' % page.id, tutorial.content)
+    eq_('Back to :crossref:`%i`' % module.id, page.content)
+    eq_([('good.css', b'good')], assets_of(module))
+    eq_([('copy.css', b'good')], assets_of(task))
+    for asset in module.assets + task.assets:
+        eq_(hashlib.sha512(asset.data).hexdigest(), asset.etag)
+    eq_([('owner', user.id)], [(role.role, role.user_id) for role in
+                               dbsession.query(UserPartRole).filter(UserPartRole.part_id == module_id)])
+    with transaction.manager:
+        data, zip_file = import_archive()
+        data = data['children'][0]
+        tutorial_id, errors = import_part(dbsession, data, zip_file, module_id, user)
+    eq_(['The file "bad.css" could not be imported'], errors)
+    tutorial = dbsession.query(Part).get(tutorial_id)
+    eq_(module_id, tutorial.parent_id)
+    eq_(['Task'], [child.title for child in tutorial.children])
+    eq_(0, dbsession.query(UserPartRole).filter(UserPartRole.part_id == tutorial_id).count())
+    eq_(4, dbsession.query(Asset).filter(Asset.filename.in_(['good.css', 'copy.css'])).count())
+
+
+@with_setup(setup_database, teardown_database)
+def compile_imported_parts_test():
+    u"""Test that :func:`~wte.views.part.compile_imported_parts` compiles the
+    content of the imported parts and reports the parts that cannot be
+    compiled."""
+    from wte.models import Part, User
+    from wte.views.part import compile_imported_parts, import_part
+    from wte_test import TestRequest
+
+    _, user = create_module()
+    dbsession = DBSession()
+    with transaction.manager:
+        data, zip_file = import_archive()
+        module_id, _ = import_part(dbsession, data, zip_file, None, dbsession.query(User).first())
+    errors = []
+    request = TestRequest(application_url='http://localhost', registry=TestRequest(settings={}))
+    with transaction.manager:
+        module = dbsession.query(Part).get(module_id)
+        parts = [module] + module.children
+        for part, content in zip(parts, ['Module *text*', 'Tutorial text', None]):
+            part.content = content
+        compile_imported_parts(request, dbsession, parts, errors)
+    eq_(1, len(errors))
+    ok_(errors[0].startswith('The content of "Page" could not be compiled: '))
+    module = dbsession.query(Part).get(module_id)
+    eq_('<p>Module <em>text</em></p>\n', module.compiled_content)
+    eq_('<p>Tutorial text</p>\n', module.children[0].compiled_content)
+    eq_(None, module.children[1].compiled_content)
+
+
+def create_cohort():
+    u"""Creates a module with a part that has a template and a page, three
+    students and a tutor, and their files for the part. Returns the ids of
+    the module, the part, and the page and the large file's data."""
+    from wte.archive import CHUNK_SIZE
+    from wte.models import Asset, Part, User, UserPartProgress, UserPartRole
+
+    template = b'print("template")'
+    large = b'x' * (CHUNK_SIZE * 2 + 10)
+    dbsession = DBSession()
+    with transaction.manager:
+        module = Part(type='module', title='Module', status='available', order=1)
+        part = Part(type='part', title='Part', status='available', order=1, display_mode='three_pane_html')
+        page = Part(type='page', title='Page', status='available', order=1)
+        module.children.append(part)
+        part.children.append(page)
+        part.all_assets.append(Asset(filename='code.py', mimetype='text/x-python', type='template', order=1,
+                                     data=template, etag=hashlib.sha512(template).hexdigest()))
+        dbsession.add(module)
+        files = {'unchanged@example.com': [('code.py', template, hashlib.sha512(template).hexdigest())],
+                 'no-etag@example.com': [('code.py', template, None), ('notes.txt', b'notes', None)],
+                 'changed@example.com': [('code.py', b'print("changed")', None), ('large.bin', large, None),
+                                         ('empty.txt', b'', None)],
+                 'tutor@example.com': [('code.py', b'print("tutor")', None)]}
+        for email, user_files in sorted(files.items()):
+            user = User(email=email, display_name=email, password='password')
+            dbsession.add(UserPartRole(user=user, part=module,
+                                       role='tutor' if email.startswith('tutor') else 'student'))
+            dbsession.add(UserPartProgress(user=user, part=part,
+                                           files=[Asset(filename=filename, mimetype='application/octet-stream',
+                                                        type='file', order=idx, data=data, etag=etag)
+                                                  for idx, (filename, data, etag) in enumerate(user_files)]))
+        dbsession.flush()
+        return module.id, part.id, page.id, large
+
+
+@with_setup(setup_database, teardown_database)
+def cohort_progress_entries_test():
+    u"""Test that :func:`~wte.views.part.cohort_progress_entries` includes
+    the students' files that differ from their templates, fetching them in
+    batches and reading large files separately."""
+    from sqlalchemy import event
+    from wte.archive import zip_stream
+    from wte.models import Part
+    from wte.views.part import cohort_progress_entries
+
+    module_id, part_id, page_id, large = create_cohort()
+    expected = {'changed@example.com/Module/Part/code.py': b'print("changed")',
+                'changed@example.com/Module/Part/large.bin': large,
+                'changed@example.com/Module/Part/empty.txt': b'',
+                'no-etag@example.com/Module/Part/notes.txt': b'notes'}
+    dbsession = DBSession()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = dbsession.get_bind()
+    for target_id, batch_size, batches in [(module_id, 2, 4), (part_id, 100, 2), (page_id, 6, 2)]:
+        part = dbsession.query(Part).get(target_id)
+        entries = cohort_progress_entries(part, batch_size=batch_size)
+        del statements[:]
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            zip_file = ZipFile(BytesIO(b''.join(zip_stream(entries))))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        eq_(sorted(expected.keys()), sorted(zip_file.namelist()))
+        for filename, data in expected.items():
+            eq_(data, zip_file.read(filename))
+        eq_(batches, len([statement for statement in statements if 'JOIN progress_assets' in statement]))
+        eq_(1, len([statement for statement in statements if 'substr' in statement.lower()]))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+u"""
+####################################
+Unit tests for :mod:`wte.views.quiz`
+####################################
+"""
+import json
+import transaction
+
+from nose.tools import eq_, with_setup
+from pywebtools.sqlalchemy import DBSession
+
+from wte_test import setup_database, teardown_database
+
+QUIZZES = u'''
+.. quiz:: first
+   :title: First quiz
+
+   .. quiz-question:: q1
+      :question: Is this right?
+
+      [x] Yes
+      No
+
+   .. quiz-question:: q2
+
+      [x] Maybe
+
+.. quiz:: second
+
+   .. quiz-question:: q1
+
+      [x] Yes
+
+.. quiz:: first
+   :title: Duplicate quiz
+
+   .. quiz-question:: q3
+
+      [x] Yes
+'''
+
+
+def create_page():
+    u"""Creates a page and a user and returns their ids."""
+    from wte.models import Part, User
+
+    dbsession = DBSession()
+    with transaction.manager:
+        user = User(email='student@example.com', display_name='Student', password='password')
+        page = Part(type='page', title='Page', status='available', order=1)
+        dbsession.add(user)
+        dbsession.add(page)
+        dbsession.flush()
+        return page.id, user.id
+
+
+def quizzes_of(part_id):
+    u"""Returns the name, title, and questions of the quizzes of the part."""
+    from wte.models import Quiz
+
+    return sorted((quiz.name, quiz.title, json.loads(quiz.questions))
+                  for quiz in DBSession().query(Quiz).filter(Quiz.part_id == part_id))
+
+
+def sync(part_id, quizzes):
+    u"""Synchronises the quizzes of the part with the ``quizzes`` metadata."""
+    from wte.models import Part
+    from wte.views.quiz import sync_quizzes
+
+    dbsession = DBSession()
+    with transaction.manager:
+        sync_quizzes(dbsession, dbsession.query(Part).get(part_id), quizzes)
+
+
+def compile_quiz_metadata_test():
+    u"""Test that :func:`~wte.text_formatter.compile_rst` returns the metadata
+    of the quizzes in the compiled text."""
+    from wte.text_formatter import compile_rst, docutils_ext
+
+    docutils_ext.init({})
+    body, quizzes = compile_rst(QUIZZES, None)
+    eq_(3, body.count('<form'))
+    eq_([{'name': 'first', 'title': 'First quiz', 'questions': [{'name': 'q1', 'title': 'Is this right?'},
+                                                                {'name': 'q2'}]},
+         {'name': 'second', 'title': None, 'questions': [{'name': 'q1'}]},
+         {'name': 'first', 'title': 'Duplicate quiz', 'questions': [{'name': 'q3'}]}], quizzes)
+
+
+@with_setup(setup_database, teardown_database)
+def sync_quizzes_test():
+    u"""Test that :func:`~wte.views.quiz.sync_quizzes` inserts new quizzes,
+    skipping quizzes with a duplicate name, updates changed quizzes, and
+    deletes removed quizzes together with their answers."""
+    from wte.models import Quiz, QuizAnswer
+    from wte.text_formatter import compile_rst, docutils_ext
+
+    docutils_ext.init({})
+    part_id, user_id = create_page()
+    sync(part_id, compile_rst(QUIZZES, None)[1])
+    eq_([('first', 'First quiz', [{'name': 'q1', 'title': 'Is this right?'}, {'name': 'q2'}]),
+         ('second', None, [{'name': 'q1'}])], quizzes_of(part_id))
+    dbsession = DBSession()
+    with transaction.manager:
+        for quiz in dbsession.query(Quiz):
+            dbsession.add(QuizAnswer(user_id=user_id, quiz_id=quiz.id, question='q1', attempts=1))
+    first_id = dbsession.query(Quiz.id).filter(Quiz.name == 'first').scalar()
+    sync(part_id, [{'name': 'first', 'title': None, 'questions': [{'name': 'q1'}]},
+                   {'name': 'third', 'title': 'Third quiz', 'questions': []}])
+    eq_([('first', 'First quiz', [{'name': 'q1'}]), ('third', 'Third quiz', [])], quizzes_of(part_id))
+    eq_(first_id, dbsession.query(Quiz.id).filter(Quiz.name == 'first').scalar())
+    eq_([first_id], [answer.quiz_id for answer in dbsession.query(QuizAnswer)])
+    sync(part_id, [{'name': 'first', 'title': 'Renamed', 'questions': [{'name': 'q1'}]}])
+    eq_([('first', 'Renamed', [{'name': 'q1'}])], quizzes_of(part_id))
+    eq_(1, dbsession.query(QuizAnswer).count())
+    sync(part_id, [])
+    eq_([], quizzes_of(part_id))
+    eq_(0, dbsession.query(QuizAnswer).count())